@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+This is a script to benchmark baseline_run against simulated devices.
+It starts baseline_sim in the background, runs a baseline against all of
+the simulated devices and reports devices per minute, the p50/p99
+device times and the peak memory of the run.
+USAGE: baseline_bench -n 200 -l 0.5
+johntishey@gmail.com - 2024
+"""
+
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from baseline_run import get_baseline
+from utils.baseline_utils import load_config
+from utils.device_sim import device_address
+
+
+def arguments():
+    """
+    Grab arguments from cli
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks baseline_run against simulated devices.")
+    parser.add_argument("-n", "--count", help="Number of devices (default 50)", type=int, default=50)
+    parser.add_argument("-c", "--config", help="Alternate config file", required=False)
+    parser.add_argument("-e", "--engine", help="Collection engine", choices=["threads", "async"], required=False)
+    parser.add_argument("-o", "--os", help="Comma-seperated OS types for the simulator", required=False)
+    parser.add_argument("-p", "--port", help="Simulator SSH port (default 2222)", type=int, default=2222)
+    parser.add_argument("-l", "--latency", help="Average seconds per command (default 0)", type=float, default=0.0)
+    parser.add_argument("-s", "--size", help="Output size multiplier (default 1)", type=float, default=1.0)
+    parser.add_argument(
+        "-f", "--failure-rate", help="Chance (0-1) of a command dropping the session", type=float, default=0.0
+    )
+    parser.add_argument(
+        "-t",
+        "--typeahead",
+        help="Simulator handling of commands sent before the prompt (default echo)",
+        choices=["echo", "drop", "early"],
+        default="echo",
+    )
+    parser.add_argument("-k", "--keep", action="count", default=0, help="Keep the benchmark logs and telemetry")
+    args = vars(parser.parse_args())
+    if not args["config"]:
+        args["config"] = os.path.dirname(os.path.realpath(__file__)) + "/configs/config.yml"
+    return args
+
+
+def _start_simulator(args, work_dir):
+    """Start baseline_sim in the background and wait for it to listen"""
+    command = [
+        sys.executable,
+        os.path.dirname(os.path.realpath(__file__)) + "/baseline_sim.py",
+        f"--count={args['count']}",
+        f"--port={args['port']}",
+        f"--latency={args['latency']}",
+        f"--size={args['size']}",
+        f"--failure-rate={args['failure_rate']}",
+        f"--typeahead={args['typeahead']}",
+        f"--write-override={work_dir}/os_type_override.txt",
+    ]
+    if args["os"]:
+        command.append(f"--os={args['os']}")
+    simulator = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = simulator.stdout.readline()
+    if not line.startswith("Simulating"):
+        simulator.kill()
+        print(f"ERROR: Simulator did not start: {line.strip()}")
+        exit(1)
+    print(line.strip())
+    return simulator
+
+
+def run_benchmark(args):
+    """
+    Runs the benchmark and prints the results
+        :param args: (dict) Arguments from the cli
+    """
+    work_dir = tempfile.mkdtemp(prefix="baseline_bench.")
+    simulator = _start_simulator(args, work_dir)
+    try:
+        # Same config as a real run, but logs, caches and telemetry go to the work folder
+        cfg = load_config(args["config"])
+        os.makedirs(f"{work_dir}/mops")
+        cfg.update(
+            {
+                "mop_path": f"{work_dir}/mops",
+                "os_override_file": f"{work_dir}/os_type_override.txt",
+                "os_cache_file": f"{work_dir}/os_type_cache.json",
+                "history_file": f"{work_dir}/collection_history.json",
+                "telemetry_path": work_dir,
+                "ssh_port": args["port"],
+                "telemetry": True,
+            }
+        )
+        cfg_file = f"{work_dir}/config.yml"
+        with open(cfg_file, "w", encoding="utf-8") as f:
+            yaml.safe_dump(cfg, f)
+        devices = ",".join(device_address(i) for i in range(args["count"]))
+        start = time.time()
+        get_baseline(devices, "before", "bench", cfg_file, engine=args["engine"], preflight=False)
+        wall = time.time() - start
+        with open(f"{work_dir}/.bench_before_telemetry.json", encoding="utf-8") as f:
+            summary = json.load(f)
+    finally:
+        simulator.terminate()
+        simulator.wait()
+    complete = summary["devices"].get("complete", 0)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+    print(f"Devices:            {complete}/{args['count']} complete")
+    print(f"Run time:           {wall:.1f}s")
+    print(f"Devices per minute: {complete / wall * 60:.1f}")
+    print(f"Device time p50:    {summary['device_seconds']['0.5']:.2f}s")
+    print(f"Device time p99:    {summary['device_seconds']['0.99']:.2f}s")
+    print(f"Worker utilization: {summary['worker_utilization']:.0%}")
+    print(f"Peak RSS:           {peak_rss_mb:.1f} MB")
+    if args["keep"]:
+        print(f"Logs and telemetry kept in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    run_benchmark(arguments())
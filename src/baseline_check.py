@@ -16,13 +16,21 @@ import yaml
 import logging
 import argparse
 import colorama
+import itertools
 
 from utils.baseline_utils import get_os
 from utils.baseline_utils import nokia_classis_or_mdcli
 from utils.baseline_utils import normalize_config_paths
+from utils.log_io import open_log
+from utils.log_io import strip_compression_suffix
+from utils.route_table import load_routes
+from utils.route_table import ROUTES_SUFFIX
 from utils import the_extractorator
 from utils import the_differentiator
 from utils import the_recyclanator
+from utils import check_pool
+from utils import result_cache
+from utils import testfile_catalog
 
 
 def arguments():
@@ -42,8 +50,9 @@ def arguments():
     c.add_argument("-b", "--before", help='Keyword to identify "Before" files', metavar="PRE")
     c.add_argument("-d", "--dev", help="Run baseline checks on a specific device only", metavar="DEV",)
     c.add_argument("-f", "--file", help="Specify a different config file (default=config.yml)")
+    c.add_argument("-J", "--jobs", type=int, help="Check devices in N worker processes (default=1)", metavar="N",)
     c.add_argument("-p", "--path", help="Explicit folder path where the baselines are located", metavar="PATH",)
-    c.add_argument("-o", "--override", action="count", default=0, help="Ignore previous log files and force new check",)
+    c.add_argument("-o", "--override", action="count", default=0, help="Ignore previous results and force new check",)
     # Output Options:
     o.add_argument("-l", "--log", action="count", default=0, help="Display no output, only log to file",)
     o.add_argument("-c", "--config", action="count", default=0, help="Display configuration diff only",)
@@ -55,7 +64,7 @@ def arguments():
     o.add_argument("-v", "--verbose", action="count", default=0, help="Display verbose output")
     args = vars(p.parse_args())
     tag1, tag2, stest, verbose, explicit_path = "", "", [], 20, ""
-    override, no_color = False, False
+    override, no_color, jobs = False, False, None
     cfg = os.path.dirname(os.path.realpath(__file__)) + "/configs/config.yml"
     mop = args["mop"]
     if args["before"]:
@@ -89,8 +98,10 @@ def arguments():
         explicit_path = args["path"]
     if args["no_color"]:
         no_color = True
+    if args["jobs"]:
+        jobs = args["jobs"]
     # fmt: on
-    return mop, tag1, tag2, stest, cfg, explicit_path, override, verbose, no_color
+    return mop, tag1, tag2, stest, cfg, explicit_path, override, verbose, no_color, jobs
 
 
 class Config(object):
@@ -109,6 +120,7 @@ class Config(object):
                 self.override,
                 self.verbose,
                 self.no_color,
+                jobs,
             ) = arguments()
         else:
             if kwargs.get("config"):
@@ -128,6 +140,7 @@ class Config(object):
                 "",
             )
             self.override, self.no_color = True, True
+            jobs = kwargs.get("jobs")
         if not os.path.exists(cfg_file):
             if os.path.exists(os.path.dirname(os.path.realpath(__file__)) + "/" + cfg_file):
                 cfg_file = os.path.dirname(os.path.realpath(__file__)) + "/" + cfg_file
@@ -137,6 +150,7 @@ class Config(object):
         with open(cfg_file, encoding="utf-8") as f:
             self.cfg = yaml.safe_load(f)
         self.cfg = normalize_config_paths(self.cfg)
+        self.jobs = jobs or self.cfg.get("check_jobs") or 1
         self.logger = logging.getLogger("BaselineCheck")
         self.mop_path = ""
         self.before_files = []
@@ -194,13 +208,22 @@ class Config(object):
         if os.path.exists(self.mop_path + "/BaselineParser.log") or os.path.exists(
             self.mop_path + "/BaselineCheck.log"
         ):
-            if self.override is False and self.verbose != 10 and self.verbose != 61:
+            # Without the result cache, reuse the log of the previous check
+            if (
+                self.override is False
+                and self.verbose != 10
+                and self.verbose != 61
+                and not result_cache.enabled(self.cfg)
+            ):
                 the_recyclanator.Run(self)
 
     def file_search(self):
         """Creates 2 sorted lists - before & after filenames"""
         file_list = os.listdir(self.mop_path)
         for _file in file_list:
+            # Skip hidden files, such as partial logs from a capture in progress
+            if _file.startswith("."):
+                continue
             f_part = _file.split("_")
             if len(f_part) > 3:
                 before_keywords = self.cfg["before_keywords"]
@@ -301,38 +324,39 @@ class Config(object):
     def get_routes(self):
         """create a dict of before/after routes
         x = {dev: {prefix: nexthop, ...}}"""
-        # TODO: Add route capture to baseline_run for this.
-        self.after_routes_list = {}
-        self.before_routes_list = {}
-        for _file in self.after_routes:
-            dev_name = _file.replace(self.routes_kw + self.after_kw + ".log", "")
-            dev_name = dev_name.replace(".routes." + self.after_kw + ".log", "")
-            dev_name = dev_name.replace(str(self.mop_number) + ".", "")
-            if dev_name != self.mop_number and not re.search("^[a-z]{4}[0-9]{2}\-[a-z]{2}$", dev_name):
-                self.after_routes_list[dev_name] = {}
-                with open(self.mop_path + "/" + _file, encoding="utf-8") as f:
-                    routes = f.readlines()
-                for line in routes:
-                    if "ERROR:" in line:
-                        self.before_routes_list[dev_name]["ERROR"] = "ERROR"
-                        break
-                    elif re.match("^[0-9]", line):
-                        self.after_routes_list[dev_name][line.split()[0]] = line.split()[-1]
-        self.before_routes_list = {}
-        for _file in self.before_routes:
-            dev_name = _file.replace(self.routes_kw + self.before_kw + ".log", "")
-            dev_name = dev_name.replace(".routes." + self.before_kw + ".log", "")
+        self.after_routes_list = self._read_routes(self.after_routes, self.after_kw)
+        self.before_routes_list = self._read_routes(self.before_routes, self.before_kw)
+
+    def _read_routes(self, files, key_word):
+        """Returns {dev: {prefix: nexthop, ...}} from the route files of a keyword.
+        baseline_run's compact .routes.bin files are loaded directly, older text
+        route files are parsed line by line."""
+        routes_list = {}
+        for _file in files:
+            file_name = strip_compression_suffix(_file)
+            if file_name.endswith(ROUTES_SUFFIX):
+                # <mop>_<device>_<keyword>_log.routes.bin, named like the hostnames of the logs
+                dev_name = ".".join(file_name.split("_")[1:-2])
+                try:
+                    routes_list[dev_name] = load_routes(self.mop_path + "/" + _file)
+                except Exception as e:
+                    print(f"ERROR reading routes {_file}: {str(e)}")
+                    routes_list[dev_name] = {"ERROR": "ERROR"}
+                continue
+            dev_name = file_name.replace(self.routes_kw + key_word + ".log", "")
+            dev_name = dev_name.replace(".routes." + key_word + ".log", "")
             dev_name = dev_name.replace(str(self.mop_number) + ".", "")
             if dev_name != self.mop_number and not re.search(r"^[a-z]{4}[0-9]{2}\-[a-z]{2}$", dev_name):
-                self.before_routes_list[dev_name] = {}
-                with open(self.mop_path + "/" + _file, encoding="utf-8") as f:
+                routes_list[dev_name] = {}
+                with open_log(self.mop_path + "/" + _file) as f:
                     routes = f.readlines()
                 for line in routes:
                     if "ERROR:" in line:
-                        self.before_routes_list[dev_name]["ERROR"] = "ERROR"
+                        routes_list[dev_name]["ERROR"] = "ERROR"
                         break
                     elif re.match("^[0-9]", line):
-                        self.before_routes_list[dev_name][line.split()[0]] = line.split()[-1]
+                        routes_list[dev_name][line.split()[0]] = line.split()[-1]
+        return routes_list
 
 
 class Device(object):
@@ -348,6 +372,12 @@ class Device(object):
         self.output = []
         self.skip_device = False
 
+    def __getstate__(self):
+        """Workers already have the config, it isn't sent again with each device"""
+        state = dict(self.__dict__)
+        state["config"] = None
+        return state
+
     def assign_values(self, host, i):
         """Assign device-specific values"""
         self.hostname = host
@@ -367,11 +397,98 @@ class Device(object):
         # commands and output can vary from Classic mode.  Still uses 'nokia_sros' in netmiko
         self.os_type = get_os(host, self.config.cfg)
         if self.os_type == "nokia_sros":
-            with open(self.files[0], "r", errors="replace", encoding="utf-8") as f:
-                baseline_text = f.readlines()
+            # Only the first lines are needed to find the prompt
+            with open_log(self.files[0]) as f:
+                baseline_text = "".join(itertools.islice(f, 10))
             self.os_type = nokia_classis_or_mdcli(self.hostname, baseline_text)
 
 
+def _check_device(CONFIG, i, hostname, device=None):
+    """
+    Extract, parse and compare the baselines of one device
+    Returns {hostname: failed tests} for JSON output, otherwise None
+        :param device: (Device) The device after assign_values, if it is already resolved
+    """
+    logger = CONFIG.logger
+    if device is None:
+        device = Device(config=CONFIG)
+        device.assign_values(hostname, i)
+    device.config = CONFIG
+    if device.skip_device is True:
+        return None
+    # Get commands and output from baseline files
+    logger.warning("\nRunning %s:", device.hostname)
+    logger.warning("-" * 64)
+
+    ###########################################################################
+    #  TEMP PATCH: Strip last domain names before continuing
+    if device.hostname[-4:] == ".net" or device.hostname[-4:] == ".com":
+        hostname = device.hostname.split(".")
+        del hostname[-1]
+        del hostname[-1]
+        device.hostname = ".".join(hostname)
+    ###########################################################################
+
+    device.output = the_extractorator.run(device)
+
+    # Execute the diff on the command output
+    if isinstance(device.output, dict):
+        output = the_differentiator.Run(device)
+        if CONFIG.verbose == 63:
+            return {device.hostname: output.json_output[device.hostname]}
+    else:
+        logger.error(CONFIG.PASS_COLOR + device.output + colorama.Style.RESET_ALL)
+    return None
+
+
+def _device_files(CONFIG, device):
+    """Returns the paths of every file the check of a device reads, for its result cache key"""
+    hostname = device.hostname
+    files = list(device.files)
+    # Flattened configs are matched on the hostname without the .net/.com domain, like the check
+    if hostname[-4:] in [".net", ".com"]:
+        hostname = ".".join(hostname.split(".")[:-2])
+    for _file in CONFIG.before_config + CONFIG.after_config:
+        if hostname in _file:
+            files.append(CONFIG.mop_path + "/" + _file)
+    files += [testfile.path for testfile in testfile_catalog.testfiles(CONFIG.cfg, device.os_type)]
+    return files
+
+
+def _cached_results(CONFIG, devices, cache):
+    """
+    Returns (log records, JSON output) of each device in order, from the result
+    cache or from a new check (in worker processes with --jobs)
+    """
+    keys, cached, resolved = {}, {}, {}
+    for i, hostname in devices:
+        # The device is resolved (files, OS type) once, for its key and its check
+        resolved[i] = Device(config=CONFIG)
+        resolved[i].assign_values(hostname, i)
+        keys[i] = cache.key(hostname, _device_files(CONFIG, resolved[i]))
+        if not CONFIG.override:
+            cached[i] = cache.load(hostname, keys[i])
+    todo = [(i, hostname, resolved[i]) for i, hostname in devices if cached.get(i) is None]
+    # Devices are checked in the cache's colors, the records are saved without them
+    colors = CONFIG.PASS_COLOR, CONFIG.FAIL_COLOR
+    CONFIG.PASS_COLOR, CONFIG.FAIL_COLOR = result_cache.COLORS["pass"], result_cache.COLORS["fail"]
+    try:
+        if CONFIG.jobs > 1 and len(todo) > 1:
+            checked = check_pool.check(CONFIG, todo, _check_device, CONFIG.jobs, cache.level)
+        else:
+            checked = (
+                check_pool.capture(CONFIG.logger, _check_device, CONFIG, device, cache.level) for device in todo
+            )
+        for i, hostname in devices:
+            if cached.get(i) is None:
+                records, device_json = next(checked)
+                cached[i] = cache.save(hostname, keys[i], records, device_json), device_json
+            yield cached[i]
+    finally:
+        CONFIG.PASS_COLOR, CONFIG.FAIL_COLOR = colors
+        cache.close()
+
+
 def _execute(ran_by, **kwargs):
     """
     Starts execution of the baseline_check
@@ -380,7 +497,8 @@ def _execute(ran_by, **kwargs):
     config_file = kwargs.get("config")
     before_kw = kwargs.get("before_kw")
     after_kw = kwargs.get("after_kw")
-    CONFIG = Config(ran_by, config=config_file, before_kw=before_kw, after_kw=after_kw)
+    jobs = kwargs.get("jobs")
+    CONFIG = Config(ran_by, config=config_file, before_kw=before_kw, after_kw=after_kw, jobs=jobs)
     CONFIG.folder_search()
     CONFIG.file_search()
     CONFIG.get_routes()
@@ -388,7 +506,7 @@ def _execute(ran_by, **kwargs):
     logger = CONFIG.logger
     json_output = {}
 
-    # One device at a time - copy the config, parse, and compare
+    devices = []
     for i, file_name in enumerate(CONFIG.before_files):
         hostname = ""
         file_name = file_name.split("_")
@@ -401,32 +519,29 @@ def _execute(ran_by, **kwargs):
                 hostname = word
         if CONFIG.stest and hostname not in CONFIG.stest:
             continue
-        device = Device(config=CONFIG)
-        device.assign_values(hostname, i)
-        if device.skip_device is True:
-            continue
-        # Get commands and output from baseline files
-        logger.warning("\nRunning %s:", device.hostname)
-        logger.warning("-" * 64)
-
-        ###########################################################################
-        #  TEMP PATCH: Strip last domain names before continuing
-        if device.hostname[-4:] == ".net" or device.hostname[-4:] == ".com":
-            hostname = device.hostname.split(".")
-            del hostname[-1]
-            del hostname[-1]
-            device.hostname = ".".join(hostname)
-        ###########################################################################
-
-        device.output = the_extractorator.run(device)
-
-        # Execute the diff on the command output
-        if isinstance(device.output, dict):
-            output = the_differentiator.Run(device)
-            if CONFIG.verbose == 63:
-                json_output[device.hostname] = output.json_output[device.hostname]
-        else:
-            logger.error(CONFIG.PASS_COLOR + device.output + colorama.Style.RESET_ALL)
+        devices.append((i, hostname))
+
+    if result_cache.enabled(CONFIG.cfg):
+        # Devices with unchanged baselines, testfiles and config are not checked again
+        cache = result_cache.ResultCache(CONFIG, [os.path.realpath(__file__)], check_pool.record_level(logger))
+        for records, device_json in _cached_results(CONFIG, devices, cache):
+            check_pool.replay(logger, records)
+            if device_json is not None:
+                json_output.update(device_json)
+    elif CONFIG.jobs > 1 and len(devices) > 1:
+        # Devices are checked in worker processes, the output is logged here in device order
+        for records, device_json in check_pool.check(
+            CONFIG, devices, _check_device, CONFIG.jobs, check_pool.record_level(logger)
+        ):
+            check_pool.replay(logger, records)
+            if device_json is not None:
+                json_output.update(device_json)
+    else:
+        # One device at a time - copy the config, parse, and compare
+        for i, hostname in devices:
+            device_json = _check_device(CONFIG, i, hostname)
+            if device_json is not None:
+                json_output.update(device_json)
     logger.debug(colorama.Style.RESET_ALL)
     # Update log file permissions
     try:
@@ -444,11 +559,13 @@ def module_run(mop, **kwargs):
     Returns a json structured object with the failed tests.
     MOP Keywords must be either pre/post or before/after.
     :param mop: MOP identifier to check.
+    :param jobs: Worker processes to check the devices in (default=cfg["check_jobs"] or 1)
     """
     config = kwargs.get("config")
     before_kw = kwargs.get("before_kw")
     after_kw = kwargs.get("after_kw")
-    json_output = _execute(mop, config=config, before_kw=before_kw, after_kw=after_kw)
+    jobs = kwargs.get("jobs")
+    json_output = _execute(mop, config=config, before_kw=before_kw, after_kw=after_kw, jobs=jobs)
     return json_output
 
 
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+This is a script to compress the baseline logs of existing MOP
+folders in place, to save disk space on the collection server.
+baseline_check reads the compressed logs without any changes.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import argparse
+
+from utils.baseline_utils import load_config
+from utils.log_io import compact_folder
+
+
+def arguments():
+    """
+    Grab arguments from cli - Requires a ticket number.
+    """
+    parser = argparse.ArgumentParser(description="Compresses the baseline logs of MOP folders in place.")
+    parser.add_argument("-m", "--mop", help="MOP/Change/Ticket number to compress", required=True)
+    parser.add_argument("-c", "--config", help="Alternate config file", required=False)
+    parser.add_argument(
+        "-z",
+        "--compression",
+        help="Compression to use (default=gzip)",
+        choices=["gzip", "zstd"],
+        default="gzip",
+    )
+    args = vars(parser.parse_args())
+    config_file = os.path.dirname(os.path.realpath(__file__)) + "/configs/config.yml"
+    if args["config"]:
+        config_file = args["config"]
+    return args["mop"], config_file, args["compression"]
+
+
+def compact(mop, cfg_file, compression="gzip"):
+    """
+    Compresses every folder for a MOP found under mop_path.
+        :param mop:  (str) Ticket number of the baselines to compress
+        :param cfg_file: (str) baseline_run config file
+        :param compression: (str) gzip or zstd
+    """
+    cfg = load_config(cfg_file)
+    found = False
+    for root, dirnames, _filenames in os.walk(cfg["mop_path"]):
+        for directory in dirnames:
+            if str(directory) == str(mop):
+                found = True
+                folder = os.path.join(root, directory)
+                before, after = compact_folder(folder, compression)
+                print(f"{folder}: {before // 1024} KB -> {after // 1024} KB")
+    if not found:
+        print("ERROR: MOP number not found!")
+        exit(1)
+
+
+if __name__ == "__main__":
+    mop, cfg_file, compression = arguments()
+    compact(mop, cfg_file, compression)
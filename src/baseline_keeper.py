@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+This is a script to log in to the devices in a MOP and keep the
+sessions open, so that baseline_run can capture the "after" output
+right away without logging in to every device again.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import sys
+import socket
+import argparse
+
+from baseline_run import device_input
+from utils.baseline_utils import load_config
+from utils.session_keeper import SessionKeeper
+from utils.session_keeper import keeper_dir
+from utils.session_keeper import socket_path
+
+
+def arguments():
+    """
+    Grab arguments from cli - Requires devices and ticket number.
+    """
+    parser = argparse.ArgumentParser(description="Keeps device sessions open between baseline runs.")
+    parser.add_argument(
+        "-d",
+        "--dev",
+        help="Comma-seperated list of hosts, @FILE to read them from a file or - for stdin",
+        required=True,
+    )
+    parser.add_argument("-m", "--mop", help="MOP/Change/Ticket number for tracking", required=True)
+    parser.add_argument("-c", "--config", help="Alternate config file", required=False)
+    parser.add_argument("-D", "--daemon", action="count", default=0, help="Run in the background")
+    args = vars(parser.parse_args())
+    config_file = os.path.dirname(os.path.realpath(__file__)) + "/configs/config.yml"
+    if args["config"]:
+        config_file = args["config"]
+    return args["dev"], args["mop"], config_file, bool(args["daemon"])
+
+
+def _daemonize():
+    """Detach from the terminal with a double fork"""
+    if os.fork() > 0:
+        sys.exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        sys.exit(0)
+    with open(os.devnull, "r", encoding="utf8") as f:
+        os.dup2(f.fileno(), sys.stdin.fileno())
+
+
+def run_keeper(dev, mop, cfg_file, daemon=False):
+    """
+    Logs in to the devices and serves the sessions until they go idle.
+        :param dev: (str) Comma-seperated list of device names, @FILE for a device list file,
+                    or - to read the device list from stdin
+        :param mop:  (str) Ticket number tracking the changes being made
+        :param cfg_file: (str) baseline_run config file
+        :param daemon: (bool) Run in the background
+    """
+    cfg = load_config(cfg_file)
+    # Read the whole list up front, the daemon has no stdin
+    devices = [device for device, _os_type in device_input(dev)[0]]
+    try:
+        keeper_dir(cfg)
+    except OSError as e:
+        print(f"ERROR: {str(e)}")
+        sys.exit(1)
+    if os.path.exists(socket_path(cfg, mop)):
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(socket_path(cfg, mop))
+            sock.close()
+            print(f"ERROR: A session keeper is already running for {mop}")
+            sys.exit(1)
+        except ConnectionRefusedError:
+            # Left over from a keeper that didn't shut down cleanly
+            os.remove(socket_path(cfg, mop))
+    # Fork before logging in, the SSH transport threads don't survive a fork
+    if daemon:
+        _daemonize()
+    keeper = SessionKeeper(cfg, mop, devices)
+    keeper.login_all()
+    keeper.serve()
+
+
+if __name__ == "__main__":
+    devices, mop, cfg_file, daemon = arguments()
+    run_keeper(devices, mop, cfg_file, daemon=daemon)
@@ -10,16 +10,39 @@ johntishey@gmail.com - 2019
 
 import os
 import sys
-import yaml
+import time
 import argparse
 import threading
-import datetime
 from queue import Queue
 from netmiko import ConnectHandler
 
-from utils.baseline_utils import get_credentials
 from utils.baseline_utils import get_os
-from utils.baseline_utils import normalize_config_paths
+from utils.baseline_utils import load_config
+from utils.baseline_utils import netmiko_device_object
+from utils.baseline_utils import device_commands
+from utils.baseline_utils import log_file_path
+from utils.baseline_utils import log_header
+from utils.baseline_utils import command_timeout
+from utils.baseline_utils import pipeline_batch
+from utils.baseline_utils import device_deadline
+from utils.baseline_utils import CONFIG_COMMANDS
+from utils.log_writer import LogWriter
+from utils.log_writer import stream_command
+from utils.log_writer import stream_commands
+from utils import async_collector
+from utils import session_keeper
+from utils import channel_fanout
+from utils import process_pool
+from utils import config_transfer
+from utils import route_table
+from utils import testfile_catalog
+from utils.preflight import run_preflight
+from utils.collection_history import CollectionHistory
+from utils.run_journal import RunJournal
+from utils.login_limiter import wait_for_login
+from utils.concurrency import adaptive_concurrency
+from utils.telemetry import RunTelemetry
+from utils.telemetry import record_log
 
 
 def arguments():
@@ -27,7 +50,12 @@ def arguments():
     Grab arguments from cli - Requires devices, ticket number, and before/after keyword.
     """
     parser = argparse.ArgumentParser(description="Runs a before/after baseline against network devices.")
-    parser.add_argument("-d", "--dev", help="Comma-seperated list of hosts", required=True)
+    parser.add_argument(
+        "-d",
+        "--dev",
+        help="Comma-seperated list of hosts, @FILE to read them from a file or - for stdin",
+        required=True,
+    )
     parser.add_argument(
         "-k",
         "--keyword",
@@ -36,6 +64,34 @@ def arguments():
     )
     parser.add_argument("-m", "--mop", help="MOP/Change/Ticket number for tracking", required=True)
     parser.add_argument("-c", "--config", help="Alternate config file", required=False)
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="Collection engine: threads (default) or async",
+        choices=["threads", "async"],
+        required=False,
+    )
+    parser.add_argument(
+        "-s",
+        "--skip-preflight",
+        action="count",
+        default=0,
+        help="Skip the pre-flight DNS/reachability/login checks",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Worker processes, each with its own threads or async sessions (default 1)",
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-r",
+        "--resume",
+        action="count",
+        default=0,
+        help="Resume an interrupted run, only collecting devices without a complete log",
+    )
     args = vars(parser.parse_args())
     dev = args["dev"]
     keyword = args["keyword"]
@@ -43,154 +99,270 @@ def arguments():
     config_file = os.path.dirname(os.path.realpath(__file__)) + "/configs/config.yml"
     if args["config"]:
         config_file = args["config"]
-    return dev, keyword, mop_id, config_file
+    engine = args["engine"]
+    preflight = False if args["skip_preflight"] else None
+    processes = args["processes"]
+    resume = bool(args["resume"])
+    return dev, keyword, mop_id, config_file, engine, preflight, processes, resume
 
 
-def _load_config(config_file):
+def _connect(device, device_type, cfg, mop_id):
     """
-    Loads baseline_run configuration file
-    :param config_file: (str) Define a config file (Default=config.yml)
+    Logs in to a device and preps the session for collection.
+    Returns the connection and the device type (which may change to nokia_mdcli)
+    """
+    # Use a warm session from baseline_keeper if one is running for this MOP,
+    # otherwise open a netmiko connection to the device
+    net_connect = session_keeper.attach(cfg, mop_id, device)
+    if not net_connect:
+        wait_for_login(cfg)
+        # A reconnect passes the nokia_mdcli found on the first login, netmiko only knows nokia_sros
+        netmiko_type = "nokia_sros" if device_type == "nokia_mdcli" else device_type
+        net_connect = ConnectHandler(**netmiko_device_object(device, netmiko_type, cfg.get("ssh_port", 22)))
+    # Nokia in Model Driven mode puts user@hostname as prompt
+    if device_type == "nokia_sros" and "@" in net_connect.base_prompt:
+        device_type = "nokia_mdcli"
+    # Turn off timestamps for XR show run
+    if device_type == "cisco_xr":
+        net_connect.send_command("terminal exec prompt no-timestamp")
+    net_connect.find_prompt()
+    return net_connect, device_type
+
+
+def _reconnect(device, device_type, cfg, mop_id, net_connect, attempt, deadline):
+    """
+    Drops a failed session and logs in again after a backoff.
+    Returns the new connection, or None if the deadline would be passed.
     """
-    if not os.path.exists(config_file):
-        if os.path.exists(os.path.dirname(os.path.realpath(__file__)) + "/" + config_file):
-            config_file = os.path.dirname(os.path.realpath(__file__)) + "/" + config_file
-        else:
-            print("ERROR: Unable to open config file")
-            sys.exit(1)
     try:
-        with open(config_file, encoding="utf-8") as f:
-            cfg = yaml.safe_load(f)
-    except Exception as e:
-        print(str(e))
-        sys.exit(1)
-    # Expand ~'s and $'s in the config file paths and follow symlinks
-    cfg = normalize_config_paths(cfg)
-    return cfg
+        net_connect.disconnect()
+    except Exception:
+        pass
+    backoff = cfg.get("retry_backoff", 5) * 2 ** (attempt - 1)
+    if deadline and time.time() + backoff > deadline:
+        return None
+    time.sleep(backoff)
+    net_connect, _device_type = _connect(device, device_type, cfg, mop_id)
+    return net_connect
 
 
-def _worker(work_queue, cfg, key_word, mop_id):
-    """worker function that executes thread queue"""
-    while True:
-        device = work_queue.get()
-        # Open a netmiko connection to a device
-        auth_info = get_credentials()
-        # Get OS Type
-        device_type = get_os(device, cfg)
+def _resume(device, device_type, cfg, mop_id, failed_connect, reason, attempt, retries, deadline):
+    """
+    Reconnects after a command failed, if there are retries left.
+    Returns the new connection (None if there isn't one) and the reason to record for the commands left.
+    """
+    net_connect = None
+    if attempt <= retries:
         try:
-            device_object = {
-                "device_type": device_type,
-                "ip": device,
-                "username": auth_info["username"],
-                "password": auth_info["password"],
-                "timeout": 180,
-                "session_timeout": 60,
-            }
-            net_connect = ConnectHandler(**device_object)
+            net_connect = _reconnect(device, device_type, cfg, mop_id, failed_connect, attempt, deadline)
         except Exception as e:
-            print(str(e))
-            work_queue.task_done()
-            continue
+            reason = str(e)
+    return net_connect, reason
 
+
+def _collect_device(device, cfg, key_word, mop_id, history, stats, os_type=None):
+    """
+    Logs in to a device, runs the commands and streams the output to the log file.
+    If a command fails, the session is reconnected (up to cfg["retries"] times)
+    and collection resumes at the failed command.  Commands that can't be
+    collected are recorded in the log as [NOT_COLLECTED].
+    Collection times are recorded in the history when all commands are collected.
+    Returns complete, partial, skipped or None if the device failed, and fills in
+    the telemetry stats of the device.
+    The OS type is looked up with get_os unless it was given with the device list.
+    """
+    start = time.time()
+    deadline = device_deadline(cfg, start)
+    if deadline and time.time() > deadline:
+        print(f"{device}: skipped, run deadline exceeded")
+        return "skipped"
+    # Get OS Type
+    device_type = os_type or get_os(device, cfg)
+    if device_type not in CONFIG_COMMANDS:
+        stats["error"] = f"No supported OS type ({device_type})"
+        print(f"{device}: {stats['error']}")
+        return None
+    retries = cfg.get("retries", 2)
+    attempt = 0
+    # Login time for the adaptive concurrency, without the OS lookup
+    connect_start = time.time()
+    while True:
         try:
-            # Run commands and get output from network device
-            output = ""
-            # Build Config Command Map
-            cmds = {
-                "juniper_junos": "show configuration | display set",
-                "cisco_ios": "show run",
-                "cisco_xr": "show configuration running-config formal",
-                "nokia_sros": "admin display-config",
-                "nokia_mdcli": "admin show configuration",
-            }
-            # Nokia in Model Driven mode puts user@hostname as prompt
-            if device_type == "nokia_sros" and "@" in net_connect.base_prompt:
-                device_type = "nokia_mdcli"
-            # Turn off timestamps for XR show run
-            if device_type == "cisco_xr":
-                net_connect.send_command("terminal exec prompt no-timestamp")
-            # Run commands from testfiles + show running config
-            net_connect.find_prompt()
-            output += f"\n[DEVICE] {device}"
-            output += f"\n[KEYWORD] {key_word}"
-            output += f"\n[MOP] {mop_id}"
-            output += f"\n[DEVICE_TYPE] {device_type}"
-            output += f"\n[BASE_PROMPT] {net_connect.base_prompt}\n\n"
-            for command in cfg["commands"][device_type]:
-                output += f"\n\n[COMMAND] {command}\n"
-                output += net_connect.send_command(command)
-            # Capture Configuration
-            output += f"\n\n[COMMAND] {cmds[device_type]}\n"
-            output += net_connect.send_command(cmds[device_type])
-            # Capture Pings
-            ping_cmds = {
-                "juniper_junos": "ping rapid <<TARGET>>",
-                "cisco_ios": "ping <<TARGET>>",
-                "cisco_xr": "ping <<TARGET>>",
-                "nokia_sros": "ping rapid <<TARGET>>",
-                "nokia_mdcli": "//ping rapid <<TARGET>>",
-            }
-            ping_vrf_cmds = {
-                "juniper_junos": "ping rapid routing-instance <<VRF>> <<TARGET>>",
-                "cisco_ios": "ping vrf <<VRF>> <<TARGET>>",
-                "cisco_xr": "ping vrf <<VRF>> <<TARGET>>",
-                "nokia_sros": "ping rapid router <<VRF>> <<TARGET>>",
-                "nokia_mdcli": "//ping rapid router <<VRF>>  <<TARGET>>",
-            }
-
-            for target in cfg["ping_targets"]:
-                if target.get("vrf"):
-                    cmd = ping_vrf_cmds[device_type]
-                    cmd = cmd.replace("<<TARGET>>", target["ip"])
-                    cmd = cmd.replace("<<VRF>>", target["vrf"])
-                else:
-                    cmd = ping_cmds[device_type]
-                    cmd = cmd.replace("<<TARGET>>", target["ip"])
-                output += f"\n\n[COMMAND] {cmd}\n"
-                output += net_connect.send_command(cmd)
-            net_connect.disconnect()
+            net_connect, device_type = _connect(device, device_type, cfg, mop_id)
+            break
         except Exception as e:
-            output += "\n"
-            output += str(e)
+            attempt += 1
+            stats["retries"] = attempt
+            backoff = cfg.get("retry_backoff", 5) * 2 ** (attempt - 1)
+            if attempt > retries or (deadline and time.time() + backoff > deadline):
+                stats["error"] = str(e) or type(e).__name__
+                stats["login_failed"] = True
+                print(f"{device}: {str(e)}")
+                return None
+            time.sleep(backoff)
+    stats["connect"] = round(time.time() - connect_start, 3)
 
-        try:
-            # Construct the file path to save the log
-            t = datetime.datetime.utcnow().date()
-            file_path = f"{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}/{mop_id}/"
-            file_name = f"{mop_id}_{device}_{key_word}_log"
-
-            # Make sure all the folders exist, and create them if needed
-            if os.path.exists(f"{cfg['mop_path']}"):
-                if not os.path.exists(f"{cfg['mop_path']}/{t.year}"):
-                    os.mkdir(f"{cfg['mop_path']}/{t.year}")
-                if not os.path.exists(f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}"):
-                    os.mkdir(f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}")
-                if not os.path.exists(
-                    f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}"
-                ):
-                    os.mkdir(
-                        f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}"
-                    )
-                if not os.path.exists(
-                    f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}/{mop_id}"
-                ):
-                    os.mkdir(
-                        f"{cfg['mop_path']}/{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}/{mop_id}"
-                    )
-                if os.path.exists(f"{cfg['mop_path']}/{file_path}/{file_name}"):
-                    os.remove(f"{cfg['mop_path']}/{file_path}/{file_name}")
+    # Output is streamed to a partial file and moved into place when done
+    try:
+        writer = LogWriter(log_file_path(cfg, mop_id, device, key_word), cfg.get("log_compression"))
+    except Exception as e:
+        print(str(e))
+        net_connect.disconnect()
+        return None
+
+    try:
+        # Run commands from testfiles + show running config + pings
+        writer.write(log_header(device, key_word, mop_id, device_type, net_connect.base_prompt))
+        commands = device_commands(cfg, device_type)
+        command_times = {}
+        # With config_transfer, the config is downloaded as a file up front and copied in
+        # as the output of the config command, instead of being read through the CLI
+        config_command, config_file = CONFIG_COMMANDS[device_type], None
+        if cfg.get("config_transfer"):
+            config_start = time.time()
+            config_file = config_transfer.config_file_path(writer.log_file)
+            if config_transfer.fetch_config(net_connect, device, device_type, cfg, config_file):
+                command_times[config_command] = time.time() - config_start
             else:
-                print("ERROR: MOP folder does not exist, update the config file")
-        except Exception as e:
-            print(str(e))
+                config_file = None
+        # With more than one channel, the commands are spread over the channels first and
+        # only the ones that failed are run one at a time below. The output goes to a spool
+        # that is copied into the log in command order at the end.
+        target, run_commands = writer, commands
+        # False once commands are given up on without reaching the serial loop below
+        complete = True
+        channels = channel_fanout.channel_count(cfg, device_type, net_connect)
+        if channels > 1:
+            target = channel_fanout.CommandSpool(writer.log_file)
+            expected_times = history.devices.get(device, {}).get("commands", {})
+            run_commands, main_error = channel_fanout.collect(
+                net_connect,
+                device_type,
+                [command for command in commands if not (config_file and command == config_command)],
+                target,
+                cfg,
+                channels,
+                expected_times,
+                command_times,
+                deadline,
+            )
+            if main_error:
+                # The main channel still has the output of the command that failed waiting on it
+                attempt += 1
+                stats["retries"] = attempt
+                net_connect, reason = _resume(
+                    device, device_type, cfg, mop_id, net_connect, main_error, attempt, retries, deadline
+                )
+                if not net_connect:
+                    for command in run_commands:
+                        target.not_collected(command, reason)
+                    run_commands, complete = [], False
+            if config_file:
+                run_commands.append(config_command)
+        # With pipeline_batch, several commands are sent at once to save a round trip per command
+        batch_size = pipeline_batch(cfg, device_type)
+        i = 0
+        while i < len(run_commands):
+            command = run_commands[i]
+            if deadline and time.time() > deadline:
+                for command in run_commands[i:]:
+                    target.not_collected(command, "deadline exceeded")
+                break
+            if config_file and command == config_command:
+                target.start_command(command)
+                config_transfer.copy_config(config_file, target.write)
+                config_file = None
+                i += 1
+                continue
+            try:
+                if batch_size > 1:
+                    # Send the next commands together, finished has the seconds of each one that completed
+                    batch, finished = run_commands[i : i + batch_size], []
+                    if config_file and config_command in batch:
+                        batch = batch[: batch.index(config_command)]
+                    read_timeout = max(command_timeout(cfg, command) for command in batch)
+                    try:
+                        pipelined = stream_commands(
+                            net_connect, batch, target, finished, read_timeout=read_timeout, deadline=deadline
+                        )
+                    finally:
+                        command_times.update(zip(batch, finished))
+                        i += len(finished)
+                    if not pipelined:
+                        print(f"{device}: commands sent ahead weren't echoed, sending one at a time")
+                        batch_size = 1
+                    continue
+                command_start = time.time()
+                target.start_command(command)
+                stream_command(
+                    net_connect, command, target.write, read_timeout=command_timeout(cfg, command), deadline=deadline
+                )
+                command_times[command] = time.time() - command_start
+                i += 1
+            except Exception as e:
+                # Reconnect and resume at the command that failed, one command at a time from now on
+                batch_size = 1
+                attempt += 1
+                stats["retries"] = attempt
+                net_connect, reason = _resume(
+                    device, device_type, cfg, mop_id, net_connect, str(e), attempt, retries, deadline
+                )
+                if not net_connect:
+                    for command in run_commands[i:]:
+                        target.not_collected(command, reason)
+                    break
+        if config_file and os.path.exists(config_file):
+            os.remove(config_file)
+        # The route table goes to its own compact file, not the log
+        if cfg.get("route_capture") and net_connect:
+            route_table.capture_routes(net_connect, device, device_type, cfg, writer.plain_file, deadline)
+        try:
+            if net_connect:
+                net_connect.disconnect()
+        except Exception:
+            pass
+        if target is not writer:
+            target.drain(writer, commands)
+    except Exception:
+        # Don't leave the partial file or the session behind
+        writer.discard()
+        try:
+            if net_connect:
+                net_connect.disconnect()
+        except Exception:
+            pass
+        raise
+
+    # Save the log file
+    try:
+        writer.close()
+    except Exception as e:
+        print(str(e))
+        return None
+    record_log(stats, writer, command_times)
+    if complete and i == len(run_commands):
+        history.record(device, time.time() - start, command_times)
+        return "complete"
+    return "partial"
+
 
-        # Save output to a file
+def _worker(work_queue, cfg, key_word, mop_id, history, telemetry, concurrency=None):
+    """worker function that executes thread queue"""
+    while True:
+        # With adaptive concurrency, only take a device when the limit allows it
+        ticket = concurrency.acquire() if concurrency else None
+        device, os_type, queued_at = work_queue.get()
+        stats = telemetry.start_device(device, queued_at)
+        status = None
         try:
-            with open(f"{cfg['mop_path']}/{file_path}/{file_name}", "w+", encoding="utf8") as f:
-                f.write(output)
-            work_queue.task_done()
+            status = _collect_device(device, cfg, key_word, mop_id, history, stats, os_type)
         except Exception as e:
-            print(str(e))
-            work_queue.task_done()
+            stats["error"] = str(e) or type(e).__name__
+            print(f"{device}: {str(e)}")
+        telemetry.finish_device(stats, status)
+        if concurrency:
+            concurrency.release(ticket, stats)
+        work_queue.task_done()
 
 
 def get_commands(cfg):
@@ -212,51 +384,177 @@ def get_commands(cfg):
     for dev_os in commands:
         if dev_os not in cfg.keys():
             continue
-        for test_file in cfg[dev_os]:
-            try:
-                with open(f"{cfg['testfile_path']}/{dev_os}/{test_file}", encoding="utf8") as f:
-                    test = yaml.safe_load(f)
-                if isinstance(test[0]["command"], list):
-                    for c in test[0]["command"]:
-                        commands[dev_os].append(c)
-                else:
-                    commands[dev_os].append(test[0]["command"])
-            except Exception as e:
-                print(str(e))
-                sys.exit(1)
+        # Commands shared by more than one testfile are only run once
+        try:
+            commands[dev_os] = testfile_catalog.commands(cfg, dev_os)
+        except Exception as e:
+            print(str(e))
+            sys.exit(1)
     return commands
 
 
-def get_baseline(dev, key_word, mop, cfg_file):
+def _read_devices(lines):
+    """
+    Yields (device, os_type) from device list lines, one device per line with
+    an optional OS type column: "router1" or "router1 juniper_junos" (or "router1,juniper_junos").
+    Blank lines and # comments are skipped.
+    """
+    for line in lines:
+        line = line.split("#", 1)[0].replace(",", " ").split()
+        if not line:
+            continue
+        if "_" in line[0]:
+            print(f"{line[0]}: skipped, device names may not contain underscores")
+            continue
+        if len(line) > 1 and line[1] not in CONFIG_COMMANDS:
+            print(f"{line[0]}: skipped, unknown OS type {line[1]} (use {', '.join(CONFIG_COMMANDS)})")
+            continue
+        yield line[0], line[1] if len(line) > 1 else None
+
+
+def _read_devices_file(device_file):
+    """Yields (device, os_type) from a device list file, reading it a line at a time"""
+    with open(device_file, encoding="utf-8") as f:
+        yield from _read_devices(f)
+
+
+def device_input(dev):
+    """
+    Returns the devices to collect and whether they are streamed.
+        :param dev: (str) Comma-seperated list of device names, @FILE for a device list file,
+                    or - to read the device list from stdin
+        :return: (tuple) (list or iterator of (device, os_type), streamed)
+    """
+    if dev == "-":
+        return _read_devices(sys.stdin), True
+    if dev.startswith("@"):
+        if not os.path.isfile(dev[1:]):
+            print(f"ERROR: Unable to open device file {dev[1:]}")
+            exit(1)
+        return _read_devices_file(dev[1:]), True
+    return [(device.rstrip(), None) for device in dev.split(",")], False
+
+
+def _chunks(devices, size):
+    """Yields lists of up to size devices (size None = all of them in one list)"""
+    if size is None:
+        yield list(devices)
+        return
+    chunk = []
+    for device in devices:
+        chunk.append(device)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _feed(devices, streamed, cfg, mop, history, telemetry, journal, preflight, workers):
+    """
+    Yields (device, os_type) in collection order.
+    Devices with a complete log in the journal of a resumed run are skipped.
+    A device list is pre-flight checked and ordered longest-expected-first as a whole.
+    Streamed devices are read and checked max_queue at a time, so collection starts right
+    away and the device list is never held in memory.
+    """
+    canary = preflight and not session_keeper.trusted_socket(cfg, mop)
+    for chunk in _chunks(devices, (cfg.get("max_queue") or 100) if streamed else None):
+        os_types = {device: os_type for device, os_type in chunk if os_type}
+        names = [device for device, _os_type in chunk]
+        done = {device for device in names if journal.complete(device)}
+        if done:
+            print(f"Resuming: skipped {len(done)} devices already collected")
+            names = [device for device in names if device not in done]
+        # Skip unreachable devices before they are handed to the workers
+        if preflight:
+            names = run_preflight(
+                names,
+                cfg,
+                canary=canary,
+                os_types=os_types,
+                connect=lambda device, device_type: _connect(device, device_type, cfg, mop),
+            )
+            canary = False
+        # Start the slowest devices first, based on previous runs
+        names = history.order(names)
+        if not streamed:
+            history.print_estimate(names, workers)
+        journal.pending(names)
+        telemetry.add_devices(len(names), last=not streamed)
+        for device in names:
+            yield device, os_types.get(device)
+    telemetry.add_devices(0, last=True)
+
+
+def get_baseline(dev, key_word, mop, cfg_file, engine=None, preflight=None, processes=None, resume=False):
     """
     Gets info from cli arguments or external call and starts the script.
-        :param dev: (str) Comma-seperated list of device names
+        :param dev: (str) Comma-seperated list of device names, @FILE or - (see device_input)
         :param key_word: (str) Before/after or pre/post key_word
         :param mop:  (str) Ticket number tracking the changes being made
+        :param engine: (str) threads or async (Default=cfg["engine"] or threads)
+        :param preflight: (bool) Check devices before collecting (Default=cfg["preflight"] or True)
+        :param processes: (int) Worker processes (Default=cfg["processes"] or 1)
+        :param resume: (bool) Skip devices already collected by an interrupted run of this MOP/keyword
     """
     # Argument validations
-    if [arg for arg in [dev, key_word, mop] if "_" in arg]:
+    devices, streamed = device_input(dev)
+    if [arg for arg in [key_word, mop] + ([] if streamed else [dev]) if "_" in arg]:
         print("Arguments may not contain underscores")
         exit(1)
-    cfg = _load_config(cfg_file)
+    cfg = load_config(cfg_file)
+    # Every device's log goes in the MOP folder, check it before logging in to any of them
+    if not os.path.isdir(cfg["mop_path"]):
+        print(f"ERROR: MOP folder {cfg['mop_path']} does not exist, update the config file")
+        exit(1)
     cfg["commands"] = get_commands(cfg)
+    if not engine:
+        engine = cfg.get("engine", "threads")
+    if preflight is None:
+        preflight = cfg.get("preflight", True)
+    if not processes:
+        processes = cfg.get("processes") or 1
+    if cfg.get("run_deadline"):
+        cfg["run_deadline_at"] = time.time() + cfg["run_deadline"]
+    history = CollectionHistory(cfg)
+    workers = cfg.get("async_max_sessions", 500) if engine == "async" else cfg["max_threads"]
+    if engine == "async" and not streamed:
+        workers = min(workers, len(devices))
+    journal = RunJournal(cfg, mop, key_word, resume)
+    telemetry = RunTelemetry(cfg, mop, key_word, None, workers * processes, engine, journal)
+    devices = _feed(devices, streamed, cfg, mop, history, telemetry, journal, preflight, workers * processes)
+    if processes > 1:
+        process_pool.collect(devices, cfg, key_word, mop, engine, processes, history, telemetry, _worker)
+        history.save()
+        telemetry.save()
+        journal.close()
+        return
+    if engine == "async":
+        async_collector.collect(devices, cfg, key_word, mop, history, telemetry)
+        history.save()
+        telemetry.save()
+        journal.close()
+        return
     work_queue = Queue(maxsize=cfg["max_queue"]) or 0
     _lock = threading.RLock()
-    devices = dev.split(",")
+    concurrency = adaptive_concurrency(cfg, cfg["max_threads"], telemetry)
 
     # Create worker threads that sleep until they have something in the queue
     for _i in range(cfg["max_threads"]) or 10:
-        t = threading.Thread(target=_worker, args=(work_queue, cfg, key_word, mop))
+        t = threading.Thread(target=_worker, args=(work_queue, cfg, key_word, mop, history, telemetry, concurrency))
         t.setDaemon(True)
         t.start()
-    # Add work to the queue for the worker threads
-    for device in devices:
-        device = device.rstrip()
-        work_queue.put(device)
+    # Add work to the queue for the worker threads, put() waits while the queue is full
+    for device, os_type in devices:
+        work_queue.put((device, os_type, time.time()))
     # Dont continue until the queue is empty
     work_queue.join()
+    history.save()
+    telemetry.save()
+    journal.close()
 
 
 if __name__ == "__main__":
-    devices, kw, mop, cfg_file = arguments()
-    get_baseline(devices, kw, mop, cfg_file)
+    devices, kw, mop, cfg_file, engine, preflight, processes, resume = arguments()
+    get_baseline(devices, kw, mop, cfg_file, engine=engine, preflight=preflight, processes=processes, resume=resume)
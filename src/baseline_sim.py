@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+This is a script to run simulated network devices on the loopback
+addresses, so baseline_run can be tested and benchmarked without
+logging in to real routers.
+USAGE: baseline_sim -n 100 -w /tmp/sim_os_override.txt
+johntishey@gmail.com - 2024
+"""
+
+import os
+import time
+import argparse
+
+from utils.device_sim import DeviceSimulator
+from utils.device_sim import OS_TYPES
+
+
+def arguments():
+    """
+    Grab arguments from cli
+    """
+    parser = argparse.ArgumentParser(description="Runs simulated network devices for testing baseline_run.")
+    parser.add_argument("-n", "--count", help="Number of devices (default 10)", type=int, default=10)
+    parser.add_argument("-o", "--os", help="Comma-seperated OS types (default all)", default=",".join(OS_TYPES))
+    parser.add_argument("-p", "--port", help="SSH port (default 2222)", type=int, default=2222)
+    parser.add_argument("-l", "--latency", help="Average seconds per command (default 0)", type=float, default=0.0)
+    parser.add_argument("-s", "--size", help="Output size multiplier (default 1)", type=float, default=1.0)
+    parser.add_argument(
+        "-f", "--failure-rate", help="Chance (0-1) of a command dropping the session", type=float, default=0.0
+    )
+    parser.add_argument(
+        "-t",
+        "--typeahead",
+        help="Commands sent before the prompt are echoed after it, dropped, or echoed early (default echo)",
+        choices=["echo", "drop", "early"],
+        default="echo",
+    )
+    parser.add_argument(
+        "-r", "--replay", help="Folder of baseline logs to replay (default src/mops)", required=False
+    )
+    parser.add_argument("-w", "--write-override", help="Write an OS override file for the devices", required=False)
+    args = vars(parser.parse_args())
+    if not args["replay"]:
+        args["replay"] = os.path.dirname(os.path.realpath(__file__)) + "/mops"
+    return args
+
+
+def run_simulator(args):
+    """
+    Starts the simulated devices and runs until interrupted
+        :param args: (dict) Arguments from the cli
+    """
+    os_types = [os_type.strip() for os_type in args["os"].split(",")]
+    unknown = [os_type for os_type in os_types if os_type not in OS_TYPES]
+    if unknown:
+        print(f"ERROR: Unsupported OS type {', '.join(unknown)}")
+        exit(1)
+    simulator = DeviceSimulator(
+        args["count"],
+        os_types,
+        args["replay"],
+        args["port"],
+        args["latency"],
+        args["size"],
+        args["failure_rate"],
+        args["typeahead"],
+    )
+    try:
+        simulator.start()
+    except OSError as e:
+        print(f"ERROR: Unable to listen on the loopback addresses: {str(e)}")
+        exit(1)
+    if args["write_override"]:
+        simulator.write_override(args["write_override"])
+    addresses = list(simulator.devices)
+    print(f"Simulating {len(addresses)} devices on {addresses[0]}-{addresses[-1]} port {args['port']}", flush=True)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    run_simulator(arguments())
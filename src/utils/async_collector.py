@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to capture device output from a single asyncio event loop
+
+Instead of one thread per device, each device is a coroutine driving an
+interactive SSH shell with asyncssh.  The number of devices in flight is
+capped by cfg["async_max_sessions"].  The log files written are the same
+[DEVICE]/[COMMAND] format as the threaded collector, and devices are
+collected the same way: logins and failed commands are retried
+(cfg["retries"], cfg["retry_backoff"]), device_deadline/run_deadline
+stop a device with the rest of its commands recorded as not collected,
+and the route table is captured whenever a session is up.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import time
+import asyncio
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+from utils.baseline_utils import get_credentials
+from utils.baseline_utils import get_os
+from utils.baseline_utils import device_commands
+from utils.baseline_utils import log_file_path
+from utils.baseline_utils import log_header
+from utils.baseline_utils import command_timeout
+from utils.baseline_utils import device_deadline
+from utils.baseline_utils import SESSION_PREP
+from utils.baseline_utils import CONFIG_COMMANDS
+from utils import config_transfer
+from utils import route_table
+from utils.log_writer import LogWriter
+from utils.telemetry import record_log
+from utils.login_limiter import login_limiter
+from utils.concurrency import adaptive_concurrency
+
+# Any line ending in one of these characters is considered a prompt
+PROMPT_END_RE = re.compile(r"[>#$%]\s*$")
+
+
+class AsyncCliSession(object):
+    """Interactive CLI session on a network device over asyncssh"""
+
+    def __init__(self, host, device_type, cfg):
+        self.host = host
+        self.device_type = device_type
+        self.cfg = cfg
+        self.base_prompt = ""
+        self.prompt_re = None
+        self.conn = None
+        self.proc = None
+        self.read_timeout = cfg.get("command_timeout", 120)
+
+    async def connect(self):
+        """Open the SSH connection and interactive shell, then prep the session"""
+        auth_info = get_credentials()
+        limiter = login_limiter(self.cfg)
+        if limiter:
+            await limiter.wait_async()
+        self.conn = await asyncio.wait_for(
+            asyncssh.connect(
+                self.host,
+                port=self.cfg.get("ssh_port", 22),
+                username=auth_info["username"],
+                password=auth_info["password"],
+                known_hosts=None,
+            ),
+            timeout=self.cfg.get("async_connect_timeout", 60),
+        )
+        self.proc = await self.conn.create_process(term_type="vt100", term_size=(511, 24))
+        await self.find_prompt()
+        # Nokia in Model Driven mode puts user@hostname as prompt
+        if self.device_type == "nokia_sros" and "@" in self.base_prompt:
+            self.device_type = "nokia_mdcli"
+        for command in SESSION_PREP.get(self.device_type, []):
+            await self.send_command(command)
+
+    async def _read_until(self, pattern, timeout):
+        """Read from the shell until the last line of output matches pattern"""
+        buffer = ""
+        while True:
+            data = await asyncio.wait_for(self.proc.stdout.read(65536), timeout=timeout)
+            if not data:
+                raise EOFError(f"{self.host}: session closed by device")
+            buffer += data.replace("\r", "")
+            last_line = buffer.rsplit("\n", 1)[-1]
+            if pattern.search(last_line):
+                return buffer
+
+    async def find_prompt(self):
+        """Send a return and work out the base prompt of the device"""
+        self.proc.stdin.write("\n")
+        output = await self._read_until(PROMPT_END_RE, self.read_timeout)
+        prompt = output.strip().splitlines()[-1].strip()
+        # Drop the trailing > or # and any leading */! from the prompt
+        self.base_prompt = prompt[:-1].lstrip("*!")
+        self.prompt_re = re.compile(re.escape(self.base_prompt) + r".*[>#$%]\s*$")
+        return prompt
+
+    async def send_command(self, command):
+        """Run a command and return the output without the echo or trailing prompt"""
+        output = []
+        await self.stream_command(command, output.append)
+        return "".join(output)
+
+    async def stream_command(self, command, write, deadline=None):
+        """
+        Run a command and pass the output to write() line by line as it arrives
+            :param deadline: (float) Epoch time the command must be finished by
+        """
+        self.proc.stdin.write(command + "\n")
+        # tail is the last (possibly partial) line, held back until we know it isn't the prompt
+        tail = ""
+        echo_stripped = False
+        newline_held = False
+        while True:
+            timeout = self.read_timeout
+            if deadline:
+                if time.time() > deadline:
+                    raise TimeoutError(f"Deadline exceeded waiting for prompt: {command}")
+                timeout = min(timeout, deadline - time.time())
+            try:
+                data = await asyncio.wait_for(self.proc.stdout.read(65536), timeout=timeout)
+            except asyncio.TimeoutError:
+                if deadline and time.time() >= deadline:
+                    raise TimeoutError(f"Deadline exceeded waiting for prompt: {command}")
+                raise
+            if not data:
+                raise EOFError(f"{self.host}: session closed by device")
+            tail += data.replace("\r", "")
+            if not echo_stripped:
+                if "\n" not in tail:
+                    continue
+                first_line, rest = tail.split("\n", 1)
+                if command.strip() in first_line:
+                    tail = rest
+                echo_stripped = True
+            head, sep, last = tail.rpartition("\n")
+            if self.prompt_re.search(last):
+                if sep:
+                    write(("\n" if newline_held else "") + head)
+                return
+            if sep:
+                # Hold back the newline, the one before the prompt is not part of the output
+                write(("\n" if newline_held else "") + head)
+                newline_held = True
+                tail = last
+
+    def disconnect(self):
+        """Close the SSH connection"""
+        if self.conn:
+            self.conn.close()
+
+
+async def _collect_device(
+    device, os_type, cfg, key_word, mop_id, semaphore, history, telemetry, queued_at, concurrency=None, ticket=None
+):
+    """Collect the output for one device and save it to the log file, then release its session slot"""
+    stats = telemetry.start_device(device, queued_at)
+    status = None
+    try:
+        status = await _collect_session(device, os_type, cfg, key_word, mop_id, history, stats)
+    except Exception as e:
+        stats["error"] = str(e) or type(e).__name__
+        print(f"{device}: {str(e)}")
+    finally:
+        semaphore.release()
+        telemetry.finish_device(stats, status)
+        if concurrency:
+            concurrency.release(ticket, stats)
+
+
+async def _remove_config(session, transfer):
+    """Remove the config file from the device, over SFTP or with the delete command, see config_transfer._remove"""
+    try:
+        async with session.conn.start_sftp_client() as sftp:
+            if await sftp.exists(transfer["path"]):
+                await sftp.remove(transfer["path"])
+        return True
+    except Exception:
+        pass
+    if not transfer.get("delete"):
+        return False
+    try:
+        await session.send_command(transfer["delete"])
+        return True
+    except Exception:
+        return False
+
+
+async def _save_config(session, transfer, cfg):
+    """Save the config to the file on the device and check it was written, see config_transfer._save"""
+    if not await _remove_config(session, transfer):
+        raise ValueError(f"could not remove an earlier {transfer['path']}")
+    session.read_timeout = command_timeout(cfg, CONFIG_COMMANDS[session.device_type])
+    config_transfer.check_save(await session.send_command(transfer["save"]))
+    try:
+        async with session.conn.start_sftp_client() as sftp:
+            if not await sftp.exists(transfer["path"]):
+                raise ValueError(f"the save didn't write {transfer['path']}")
+            size = (await sftp.stat(transfer["path"])).size
+    except ValueError:
+        raise
+    except Exception:
+        # No SFTP on the device, the download fails if the (new) file isn't there
+        return
+    config_transfer.check_saved(size)
+
+
+async def _fetch_config(session, device, cfg, local_file):
+    """Save the config on the device and download it over asyncssh, see config_transfer.fetch_config"""
+    transfer = config_transfer.transfer_settings(cfg, session.device_type)
+    if not transfer.get("path"):
+        return False
+    try:
+        if transfer.get("save"):
+            await _save_config(session, transfer, cfg)
+        errors = []
+        for method in config_transfer.transfer_methods(cfg):
+            try:
+                if method == "sftp":
+                    async with session.conn.start_sftp_client() as sftp:
+                        await sftp.get(transfer["path"], local_file)
+                elif method == "scp":
+                    await asyncssh.scp((session.conn, transfer["path"]), local_file)
+                else:
+                    raise ValueError(f"Unknown config_transfer {method}, use sftp, scp or auto")
+                return True
+            except Exception as e:
+                errors.append(f"{method}: {str(e) or type(e).__name__}")
+        raise ValueError(", ".join(errors))
+    except Exception as e:
+        print(f"{device}: config transfer failed, reading the config through the CLI: {str(e)}")
+        if os.path.exists(local_file):
+            os.remove(local_file)
+        return False
+    finally:
+        # Files made by the save command don't stay on the device
+        if transfer.get("save"):
+            await _remove_config(session, transfer)
+
+
+async def _capture_routes(session, device, cfg, log_file, deadline=None):
+    """Stream the route table into its route table file, see route_table.capture_routes"""
+    command = route_table.route_command(cfg, session.device_type)
+    if not command:
+        return None
+    writer = route_table.RouteTableWriter(route_table.routes_file(log_file))
+    try:
+        session.read_timeout = command_timeout(cfg, command)
+        await session.stream_command(command, writer.write, deadline=deadline)
+        return writer.close()
+    except Exception as e:
+        route_table.capture_failed(device, writer.path, e)
+        return None
+
+
+async def _connect(device, device_type, cfg):
+    """Returns a logged in session, see baseline_run._connect"""
+    session = AsyncCliSession(device, device_type, cfg)
+    try:
+        await session.connect()
+    except BaseException:
+        session.disconnect()
+        raise
+    return session
+
+
+async def _reconnect(device, cfg, session, attempt, deadline):
+    """
+    Drops a failed session and logs in again after a backoff, see baseline_run._reconnect.
+    Returns the new session, or None if the deadline would be passed.
+    """
+    session.disconnect()
+    backoff = cfg.get("retry_backoff", 5) * 2 ** (attempt - 1)
+    if deadline and time.time() + backoff > deadline:
+        return None
+    await asyncio.sleep(backoff)
+    return await _connect(device, session.device_type, cfg)
+
+
+async def _collect_session(device, os_type, cfg, key_word, mop_id, history, stats):
+    """
+    Log in and run the commands the same way as baseline_run._collect_device,
+    returns complete, partial, skipped or None if the device failed
+    """
+    loop = asyncio.get_event_loop()
+    start = time.time()
+    deadline = device_deadline(cfg, start)
+    if deadline and time.time() > deadline:
+        print(f"{device}: skipped, run deadline exceeded")
+        return "skipped"
+    # get_os may block on SNMP, so keep it off the event loop
+    device_type = os_type or await loop.run_in_executor(None, get_os, device, cfg)
+    if device_type not in CONFIG_COMMANDS:
+        stats["error"] = f"No supported OS type ({device_type})"
+        print(f"{device}: {stats['error']}")
+        return None
+    retries = cfg.get("retries", 2)
+    attempt = 0
+    # Login time for the adaptive concurrency, without the OS lookup
+    connect_start = time.time()
+    while True:
+        try:
+            session = await _connect(device, device_type, cfg)
+            break
+        except Exception as e:
+            attempt += 1
+            stats["retries"] = attempt
+            backoff = cfg.get("retry_backoff", 5) * 2 ** (attempt - 1)
+            if attempt > retries or (deadline and time.time() + backoff > deadline):
+                stats["error"] = str(e) or type(e).__name__
+                stats["login_failed"] = True
+                print(f"{device}: {str(e)}")
+                return None
+            await asyncio.sleep(backoff)
+    stats["connect"] = round(time.time() - connect_start, 3)
+
+    # Output is streamed to a partial file and moved into place when done
+    try:
+        writer = LogWriter(log_file_path(cfg, mop_id, device, key_word), cfg.get("log_compression"))
+    except Exception as e:
+        print(str(e))
+        session.disconnect()
+        return None
+
+    try:
+        device_type = session.device_type
+        writer.write(log_header(device, key_word, mop_id, device_type, session.base_prompt))
+        commands = device_commands(cfg, device_type)
+        command_times = {}
+        config_command, config_file = CONFIG_COMMANDS[device_type], None
+        if cfg.get("config_transfer"):
+            config_start = time.time()
+            config_file = config_transfer.config_file_path(writer.log_file)
+            if await _fetch_config(session, device, cfg, config_file):
+                command_times[config_command] = time.time() - config_start
+            else:
+                config_file = None
+        i = 0
+        while i < len(commands):
+            command = commands[i]
+            if deadline and time.time() > deadline:
+                for command in commands[i:]:
+                    writer.not_collected(command, "deadline exceeded")
+                break
+            if config_file and command == config_command:
+                writer.start_command(command)
+                config_transfer.copy_config(config_file, writer.write)
+                config_file = None
+                i += 1
+                continue
+            try:
+                command_start = time.time()
+                writer.start_command(command)
+                session.read_timeout = command_timeout(cfg, command)
+                await session.stream_command(command, writer.write, deadline=deadline)
+                command_times[command] = time.time() - command_start
+                i += 1
+            except Exception as e:
+                # Reconnect and resume at the command that failed
+                reason = str(e) or type(e).__name__
+                attempt += 1
+                stats["retries"] = attempt
+                failed_session, session = session, None
+                if attempt <= retries:
+                    try:
+                        session = await _reconnect(device, cfg, failed_session, attempt, deadline)
+                    except Exception as reconnect_e:
+                        reason = str(reconnect_e) or type(reconnect_e).__name__
+                else:
+                    failed_session.disconnect()
+                if not session:
+                    for command in commands[i:]:
+                        writer.not_collected(command, reason)
+                    break
+        if config_file and os.path.exists(config_file):
+            os.remove(config_file)
+        # The route table goes to its own compact file, not the log
+        if cfg.get("route_capture") and session:
+            await _capture_routes(session, device, cfg, writer.plain_file, deadline)
+        if session:
+            session.disconnect()
+    except Exception:
+        # Don't leave the partial file or the session behind
+        writer.discard()
+        if session:
+            session.disconnect()
+        raise
+
+    # Save the log file
+    try:
+        writer.close()
+    except Exception as e:
+        print(str(e))
+        return None
+    record_log(stats, writer, command_times)
+    if i == len(commands):
+        history.record(device, time.time() - start, command_times)
+        return "complete"
+    return "partial"
+
+
+async def _collect_all(devices, cfg, key_word, mop_id, history, telemetry):
+    """Run all of the device collections with a cap on concurrent sessions"""
+    semaphore = asyncio.Semaphore(cfg.get("async_max_sessions", 500))
+    concurrency = adaptive_concurrency(cfg, cfg.get("async_max_sessions", 500), telemetry)
+    # Only start a task when a session slot is free, so a streamed device list isn't read ahead
+    tasks = set()
+    # The next device can block (pre-flight checks, stdin, a worker process queue),
+    # so it is read in a thread to keep the sessions already running moving
+    loop = asyncio.get_running_loop()
+    devices = iter(devices)
+    while True:
+        item = await loop.run_in_executor(None, next, devices, None)
+        if item is None:
+            break
+        device, os_type = item
+        queued_at = time.time()
+        ticket = await loop.run_in_executor(None, concurrency.acquire) if concurrency else None
+        await semaphore.acquire()
+        task = asyncio.ensure_future(
+            _collect_device(
+                device, os_type, cfg, key_word, mop_id, semaphore, history, telemetry, queued_at, concurrency, ticket
+            )
+        )
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+def collect(devices, cfg, key_word, mop_id, history, telemetry):
+    """
+    Capture baselines for a list of devices with the asyncio engine
+        :param devices: (iterable) (device, os_type) pairs, os_type None to look it up
+        :param cfg: the baseline_run config yaml object (with cfg["commands"])
+        :param key_word: (str) Before/after or pre/post key_word
+        :param mop_id: (str) Ticket number tracking the changes being made
+        :param history: (CollectionHistory) Records how long each device takes
+        :param telemetry: (RunTelemetry) Records the run stats
+    """
+    if asyncssh is None:
+        print("ERROR: The async engine requires asyncssh (pip install asyncssh)")
+        exit(1)
+    asyncio.run(_collect_all(devices, cfg, key_word, mop_id, history, telemetry))
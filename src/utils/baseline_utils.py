@@ -17,8 +17,21 @@ network devices.  (Should be a string that Netmiko device_typ format)
 
 import os
 import re
+import sys
+import json
+import time
+import atexit
+import datetime
+import threading
+import yaml
 from easysnmp import Session
 
+try:
+    import fcntl
+except ImportError:
+    # Windows - runs saving at the same moment can still lose each other's entries
+    fcntl = None
+
 
 def _convert_netmiko(my_os):
     """Convert format to what netmiko expects for connections
@@ -58,11 +71,23 @@ def nokia_classis_or_mdcli(hostname, output):
     return "nokia_sros"
 
 
+# Seconds a cached OS type is trusted, per source (0 = never cached)
+OS_CACHE_TTL = {"override": 0, "inventory": 86400, "snmp": 604800}
+
+# OS type resolution cache - {hostname: {"os": os_type, "source": source, "time": epoch}}
+# "new" are the hostnames resolved by this process, saved to the file once when it exits
+_os_cache = {"file": None, "hosts": {}, "new": set()}
+# Override file contents - {hostname: os_type}, reloaded when the file's mtime changes
+_os_overrides = {"file": None, "mtime": None, "hosts": {}}
+_os_lock = threading.RLock()
+
+
 def get_os(host, config):
     """Utility to get network device OS type using several different methods.
 
     1. Look in 'override.txt' for manual OS definiations
-    2. Use custom inventory plugins to check the device database
+    2. Look in the OS type cache for a previous answer that hasn't expired
+    3. Use custom inventory plugins to check the device database
     4. Query the device via SNMP
 
     Args:
@@ -71,25 +96,126 @@ def get_os(host, config):
     Returns:
         str: The OS type for Netmiko connection
     """
+    my_os, _source = get_os_and_source(host, config)
+    return my_os
+
+
+def get_os_and_source(host, config):
+    """Same as get_os, but also returns which source gave the answer
+    Args:
+        host (str): The device hostname
+        config (dict): The configuration dictionary
+    Returns:
+        tuple: (OS type for Netmiko connection, source)
+            source is one of override, inventory, snmp, or None if not found
+    """
     # Check the override file for manual overrides:
     # Should be formatted one per line HOSTNAME OS_TYPE
     my_os = check_override_file(host, config)
     if my_os:
-        return my_os
+        return my_os, "override"
+    # Check the cache for a previous answer
+    cached = _check_os_cache(host, config)
+    if cached:
+        return cached["os"], cached["source"]
     # Check custom inventory (code required to implement this function)
     my_os = check_custom_inventory(host)
     if my_os:
-        return my_os
+        _update_os_cache(host, my_os, "inventory", config)
+        return my_os, "inventory"
     # Check SNMP
     my_os = check_snmp(host, config)
     if my_os:
-        return my_os
+        _update_os_cache(host, my_os, "snmp", config)
+        return my_os, "snmp"
     # if all failed return None
-    return
+    return None, None
+
+
+def _load_os_cache(config):
+    """Load the OS type cache file once per process (or when the file changes in the config)"""
+    cache_file = config.get("os_cache_file")
+    if _os_cache["file"] == cache_file:
+        return
+    save_os_cache()
+    _os_cache["file"] = cache_file
+    _os_cache["hosts"] = _read_os_cache(cache_file)
+
+
+def _read_os_cache(cache_file):
+    """Returns the hosts in an OS type cache file ({} if it can't be read)"""
+    try:
+        with open(cache_file, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as _e:
+        return {}
+
+
+def _check_os_cache(host, config):
+    """Returns the cache entry for a host if it is still within its source's TTL"""
+    with _os_lock:
+        _load_os_cache(config)
+        entry = _os_cache["hosts"].get(host)
+    if not entry:
+        return None
+    ttl = {**OS_CACHE_TTL, **config.get("os_cache_ttl", {})}.get(entry["source"], 0)
+    if time.time() - entry["time"] > ttl:
+        return None
+    return entry
+
+
+def _update_os_cache(host, my_os, source, config):
+    """Record an OS type in the cache, the file is saved by save_os_cache"""
+    ttl = {**OS_CACHE_TTL, **config.get("os_cache_ttl", {})}.get(source, 0)
+    if not ttl:
+        return
+    with _os_lock:
+        _load_os_cache(config)
+        _os_cache["hosts"][host] = {"os": my_os, "source": source, "time": int(time.time())}
+        _os_cache["new"].add(host)
+
+
+def save_os_cache():
+    """Save the OS types resolved by this process to the cache file
+
+    The file is read again and the new entries merged into it (the newest
+    entry of a host wins), so runs and processes sharing the file keep each
+    other's answers.  Called when the process exits.
+    """
+    with _os_lock:
+        if not _os_cache["new"] or not _os_cache["file"]:
+            return
+        cache_file = _os_cache["file"]
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # The lock file keeps another process from saving between the read and the rename
+            with open(f"{cache_file}.lock", "a") as lock:
+                if fcntl:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                hosts = _read_os_cache(cache_file)
+                for host in _os_cache["new"]:
+                    entry = _os_cache["hosts"][host]
+                    if host not in hosts or hosts[host].get("time", 0) <= entry["time"]:
+                        hosts[host] = entry
+                # Write to a temp file and rename, so other runs never read half a file
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(hosts, f, indent=1, sort_keys=True)
+                os.replace(tmp_file, cache_file)
+            _os_cache["hosts"] = hosts
+            _os_cache["new"] = set()
+        except Exception as e:
+            print(f"ERROR saving OS type cache: {str(e)}")
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+
+atexit.register(save_os_cache)
 
 
 def check_override_file(host, config):
     """Check a file for manual OS overrides
+    The file is only read again when its modification time changes.
     Args:
         host (str): The device hostname
         config (dict): The configuration dictionary
@@ -98,16 +224,25 @@ def check_override_file(host, config):
         str: The OS type for Netmiko connection
     """
     try:
-        my_os = ""
-        with open(config["os_override_file"]) as f:
-            overrides = f.read()
-        if host in overrides:
-            for line in overrides.splitlines():
-                if line.split()[0] == host:
-                    my_os = line.split()[1]
+        override_file = config["os_override_file"]
+        mtime = os.path.getmtime(override_file)
     except Exception as _e:
         return
-    return my_os
+    with _os_lock:
+        if _os_overrides["file"] != override_file or _os_overrides["mtime"] != mtime:
+            hosts = {}
+            try:
+                with open(override_file) as f:
+                    for line in f:
+                        line = line.split()
+                        if len(line) > 1:
+                            hosts[line[0]] = line[1]
+            except Exception as _e:
+                return
+            _os_overrides["file"] = override_file
+            _os_overrides["mtime"] = mtime
+            _os_overrides["hosts"] = hosts
+        return _os_overrides["hosts"].get(host, "")
 
 
 def check_custom_inventory(host):
@@ -173,6 +308,134 @@ def get_credentials():
     return login_info
 
 
+# Commands used to capture the running configuration for each OS type
+CONFIG_COMMANDS = {
+    "juniper_junos": "show configuration | display set",
+    "cisco_ios": "show run",
+    "cisco_xr": "show configuration running-config formal",
+    "nokia_sros": "admin display-config",
+    "nokia_mdcli": "admin show configuration",
+}
+# Ping command formats for each OS type
+PING_COMMANDS = {
+    "juniper_junos": "ping rapid <<TARGET>>",
+    "cisco_ios": "ping <<TARGET>>",
+    "cisco_xr": "ping <<TARGET>>",
+    "nokia_sros": "ping rapid <<TARGET>>",
+    "nokia_mdcli": "//ping rapid <<TARGET>>",
+}
+PING_VRF_COMMANDS = {
+    "juniper_junos": "ping rapid routing-instance <<VRF>> <<TARGET>>",
+    "cisco_ios": "ping vrf <<VRF>> <<TARGET>>",
+    "cisco_xr": "ping vrf <<VRF>> <<TARGET>>",
+    "nokia_sros": "ping rapid router <<VRF>> <<TARGET>>",
+    "nokia_mdcli": "//ping rapid router <<VRF>>  <<TARGET>>",
+}
+
+
+# Commands to turn off paging and line wrapping for each OS type
+# (netmiko does this itself, these are for sessions opened without netmiko)
+SESSION_PREP = {
+    "juniper_junos": ["set cli screen-length 0", "set cli screen-width 511"],
+    "cisco_ios": ["terminal length 0", "terminal width 511"],
+    "cisco_xr": ["terminal length 0", "terminal width 511", "terminal exec prompt no-timestamp"],
+    "nokia_sros": ["environment no more"],
+    "nokia_mdcli": ["environment more false"],
+}
+
+
+def device_commands(cfg, device_type):
+    """
+    Builds the ordered list of commands to run on a device:
+    testfile commands, then the config capture, then the ping targets.
+    :param cfg: the baseline_run config yaml object (with cfg["commands"])
+    :param device_type: (str) netmiko device type of the device
+    """
+    commands = list(cfg["commands"][device_type])
+    commands.append(CONFIG_COMMANDS[device_type])
+    for target in cfg["ping_targets"]:
+        if target.get("vrf"):
+            cmd = PING_VRF_COMMANDS[device_type]
+            cmd = cmd.replace("<<TARGET>>", target["ip"])
+            cmd = cmd.replace("<<VRF>>", target["vrf"])
+        else:
+            cmd = PING_COMMANDS[device_type]
+            cmd = cmd.replace("<<TARGET>>", target["ip"])
+        commands.append(cmd)
+    return commands
+
+
+def device_deadline(cfg, start):
+    """Returns the epoch time a device must be finished by, or None for no deadline"""
+    deadlines = []
+    if cfg.get("device_deadline"):
+        deadlines.append(start + cfg["device_deadline"])
+    if cfg.get("run_deadline_at"):
+        deadlines.append(cfg["run_deadline_at"])
+    return min(deadlines) if deadlines else None
+
+
+def command_timeout(cfg, command):
+    """Returns the read timeout for a command, from command_timeouts or command_timeout"""
+    return cfg.get("command_timeouts", {}).get(command, cfg.get("command_timeout", 120))
+
+
+def pipeline_batch(cfg, device_type):
+    """Returns how many commands are sent to a device at once (pipeline_batch, or its OS type's value)"""
+    batch_size = cfg.get("pipeline_batch") or 1
+    if isinstance(batch_size, dict):
+        batch_size = batch_size.get(device_type) or 1
+    return batch_size
+
+
+def log_header(device, key_word, mop_id, device_type, base_prompt):
+    """Returns the [DEVICE]/[KEYWORD]/... header written at the top of each log"""
+    output = f"\n[DEVICE] {device}"
+    output += f"\n[KEYWORD] {key_word}"
+    output += f"\n[MOP] {mop_id}"
+    output += f"\n[DEVICE_TYPE] {device_type}"
+    output += f"\n[BASE_PROMPT] {base_prompt}\n\n"
+    return output
+
+
+def log_file_path(cfg, mop_id, device, key_word):
+    """
+    Returns the full path of the log file for a device, creating the
+    mop_path/<year>/<month>/<day>/<mop> folders if needed.
+    An existing log file is left in place until the new one replaces it.
+    Raises FileNotFoundError if the MOP folder does not exist.
+    """
+    t = datetime.datetime.utcnow().date()
+    file_path = f"{t.year}/{t.month:02d}_{t.strftime('%B')[:3]}/{t.day:02d}_{t.month:02d}_{t.year:02d}/{mop_id}/"
+    file_name = f"{mop_id}_{device}_{key_word}_log"
+    if not os.path.exists(f"{cfg['mop_path']}"):
+        raise FileNotFoundError(f"MOP folder {cfg['mop_path']} does not exist, update the config file")
+    os.makedirs(f"{cfg['mop_path']}/{file_path}", exist_ok=True)
+    return f"{cfg['mop_path']}/{file_path}/{file_name}"
+
+
+def netmiko_device_object(device, device_type, port=22):
+    """Returns the netmiko ConnectHandler arguments for a device
+    Args:
+        device (str): The device hostname or IP
+        device_type (str): The OS type for Netmiko connection
+        port (int): SSH port (cfg["ssh_port"])
+    Returns:
+        dict: ConnectHandler keyword arguments
+    """
+    auth_info = get_credentials()
+    device_object = {
+        "device_type": device_type,
+        "ip": device,
+        "port": port,
+        "username": auth_info["username"],
+        "password": auth_info["password"],
+        "timeout": 180,
+        "session_timeout": 60,
+    }
+    return device_object
+
+
 def _expand_user_and_vars_to_abs(path):
     """Expand user and environment variables in a path"""
     path = os.path.expanduser(path)
@@ -216,4 +479,33 @@ def normalize_config_paths(config):
         config["os_override_file"] = config["project_path"] + "src/configs/os_type_override.txt"
     else:
         config["os_override_file"] = _expand_user_and_vars_to_abs(config["os_override_file"])
+    # OS TYPE CACHE FILE - kept in the user's cache folder, out of the source tree
+    if not config.get("os_cache_file"):
+        cache_home = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+        config["os_cache_file"] = _expand_user_and_vars_to_abs(cache_home + "/baseline/os_type_cache.json")
+    else:
+        config["os_cache_file"] = _expand_user_and_vars_to_abs(config["os_cache_file"])
     return config
+
+
+def load_config(config_file):
+    """
+    Loads baseline_run configuration file
+    :param config_file: (str) Define a config file, relative to the scripts folder if it isn't found
+    """
+    if not os.path.exists(config_file):
+        scripts_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+        if os.path.exists(scripts_path + "/" + config_file):
+            config_file = scripts_path + "/" + config_file
+        else:
+            print("ERROR: Unable to open config file")
+            sys.exit(1)
+    try:
+        with open(config_file, encoding="utf-8") as f:
+            cfg = yaml.safe_load(f)
+    except Exception as e:
+        print(str(e))
+        sys.exit(1)
+    # Expand ~'s and $'s in the config file paths and follow symlinks
+    cfg = normalize_config_paths(cfg)
+    return cfg
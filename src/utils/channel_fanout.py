@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to run a device's commands over several SSH channels
+
+Extra exec channels are opened on the SSH transport netmiko already
+logged in with, so no extra logins are needed.  The command list is split
+across the channels (longest commands first, using the collection
+history) and each command's output is spooled to its own temp file.
+The spool is then copied into the log in the original command order.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import time
+import codecs
+import shutil
+import tempfile
+import threading
+
+from utils.baseline_utils import SESSION_PREP
+from utils.baseline_utils import command_timeout
+from utils.log_writer import stream_command
+
+# Max channels per device for each OS type, can be changed with cfg["channel_limits"]
+CHANNEL_LIMITS = {
+    "juniper_junos": 4,
+    "cisco_ios": 2,
+    "cisco_xr": 4,
+    "nokia_sros": 2,
+    "nokia_mdcli": 2,
+}
+
+
+def channel_count(cfg, device_type, net_connect):
+    """Returns how many channels to use for a device (1 = no fan-out)"""
+    # Sessions from baseline_keeper don't have an SSH transport to open channels on
+    if not hasattr(net_connect, "remote_conn"):
+        return 1
+    limits = {**CHANNEL_LIMITS, **cfg.get("channel_limits", {})}
+    return max(1, min(cfg.get("channels_per_device", 1), limits.get(device_type, 1)))
+
+
+class ExtraChannel(object):
+    """An extra shell channel on a netmiko session's transport.
+    Has the same write_channel/read_channel interface as netmiko, so stream_command works on it."""
+
+    def __init__(self, net_connect, device_type, timeout=60):
+        self.base_prompt = net_connect.base_prompt
+        self.RETURN = net_connect.RETURN
+        transport = net_connect.remote_conn.get_transport()
+        self.channel = transport.open_session(timeout=timeout)
+        self.channel.get_pty(term="vt100", width=511, height=1000)
+        self.channel.invoke_shell()
+        # A multibyte character can be split across two reads
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # Wait for the login banner and prompt, then turn off paging
+        prompt_re = re.compile(re.escape(self.base_prompt) + r".*[>#$%]\s*$")
+        output, start = "", time.time()
+        while not prompt_re.search(output.rsplit("\n", 1)[-1]):
+            if time.time() - start > timeout:
+                self.disconnect()
+                raise TimeoutError("Timed out waiting for the prompt on a new channel")
+            output += self.read_channel().replace("\r", "")
+            time.sleep(0.05)
+        for command in SESSION_PREP.get(device_type, []):
+            stream_command(self, command, lambda data: None, read_timeout=timeout)
+
+    def write_channel(self, data):
+        """Send data to the channel"""
+        self.channel.sendall(data)
+
+    def read_channel(self):
+        """Read whatever data is waiting on the channel"""
+        output = ""
+        while self.channel.recv_ready():
+            output += self.decoder.decode(self.channel.recv(65535))
+        return output
+
+    def disconnect(self):
+        """Close the channel (the transport stays up for netmiko)"""
+        try:
+            self.channel.close()
+        except Exception:
+            pass
+
+
+class CommandSpool(object):
+    """Per-command temp files that are copied into the log in command order.
+    Also has the start_command/write/not_collected interface of LogWriter."""
+
+    def __init__(self, log_file):
+        self.folder = tempfile.mkdtemp(prefix=f".{os.path.basename(log_file)}.", dir=os.path.dirname(log_file))
+        self.files = {}
+        self.reasons = {}
+        self.current = None
+        # Spool files are numbered in the order they are opened, a retried command gets a new one
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def open(self, command):
+        """Returns a new spool file for a command (replacing any earlier attempt)"""
+        with self.lock:
+            self.reasons.pop(command, None)
+            path = f"{self.folder}/{self.opened}"
+            self.opened += 1
+            self.files[command] = path
+        return open(path, "w", encoding="utf8")
+
+    def start_command(self, command):
+        """Start spooling a command"""
+        if self.current:
+            self.current.close()
+        self.current = self.open(command)
+
+    def write(self, text):
+        """Spool output for the current command"""
+        self.current.write(text)
+
+    def not_collected(self, command, reason):
+        """Record a command that could not be collected"""
+        with self.lock:
+            self.reasons[command] = reason
+
+    def drain(self, writer, commands):
+        """Copy the spooled output into the log in the original command order and clean up"""
+        if self.current:
+            self.current.close()
+            self.current = None
+        for command in commands:
+            if command in self.reasons or command not in self.files:
+                writer.not_collected(command, self.reasons.get(command, "not run"))
+                continue
+            writer.start_command(command)
+            with open(self.files[command], encoding="utf8") as f:
+                shutil.copyfileobj(f, writer)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _split(commands, channels, expected_times):
+    """Split the commands over the channels, longest expected command first"""
+    groups = [[] for _i in range(channels)]
+    loads = [0.0] * channels
+    for command in sorted(commands, key=lambda c: expected_times.get(c, 1.0), reverse=True):
+        i = loads.index(min(loads))
+        groups[i].append(command)
+        loads[i] += expected_times.get(command, 1.0)
+    return groups
+
+
+def collect(net_connect, device_type, commands, spool, cfg, channels, expected_times, command_times, deadline):
+    """
+    Runs the commands over the main netmiko channel plus extra channels.
+        :param net_connect: Logged in netmiko connection (used as the first channel)
+        :param device_type: (str) netmiko device type of the device
+        :param commands: (list) Commands to run
+        :param spool: (CommandSpool) Where the output of each command is written
+        :param cfg: the baseline_run config yaml object
+        :param channels: (int) Number of channels to use
+        :param expected_times: (dict) Expected seconds per command from the history
+        :param command_times: (dict) Updated with the seconds each command took
+        :param deadline: (float) Epoch time the device must be finished by
+        :return: (tuple) Commands that failed, in their original order, and the error that failed
+                 the main channel (None if it didn't), which leaves unread output on net_connect
+    """
+    sessions = [net_connect]
+    for _i in range(channels - 1):
+        try:
+            sessions.append(ExtraChannel(net_connect, device_type))
+        except Exception:
+            # The device won't give us any more channels, use what we have
+            break
+    groups = _split(commands, len(sessions), expected_times)
+    failed = set()
+    errors = {}
+
+    def _run(session, group):
+        for i, command in enumerate(group):
+            command_start = time.time()
+            try:
+                with spool.open(command) as f:
+                    stream_command(
+                        session, command, f.write, read_timeout=command_timeout(cfg, command), deadline=deadline
+                    )
+                command_times[command] = time.time() - command_start
+            except Exception as e:
+                # The channel is in an unknown state, leave the rest of its commands for a retry
+                failed.update(group[i:])
+                errors[id(session)] = str(e) or type(e).__name__
+                return
+
+    threads = [threading.Thread(target=_run, args=(s, g)) for s, g in zip(sessions[1:], groups[1:])]
+    for t in threads:
+        t.start()
+    _run(sessions[0], groups[0])
+    for t in threads:
+        t.join()
+    for session in sessions[1:]:
+        session.disconnect()
+    return [command for command in commands if command in failed], errors.get(id(net_connect))
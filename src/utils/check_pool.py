@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+baseline_check module to check devices in parallel worker processes
+
+Extracting, running the custom commands, the testfiles and the config
+diff for a device is all CPU work, so one baseline_check process checks
+one device at a time on one core.  With --jobs N the devices are checked
+in a pool of N worker processes.  A worker doesn't write to
+BaselineCheck.log or the screen, it keeps the log records of each device
+and sends them back with the device's JSON output.  The parent replays
+the records and merges the JSON in the same device order as a serial
+check, so the output is the same either way.  capture() keeps the records
+of a device checked in this process the same way, for the result cache.
+johntishey@gmail.com - 2024
+"""
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+_config = None
+_check_device = None
+_records = []
+
+
+class _RecordHandler(logging.Handler):
+    """Keeps the (level, message) of each log record for the parent"""
+
+    def emit(self, record):
+        _records.append((record.levelno, record.getMessage()))
+
+
+def record_level(logger):
+    """Returns the lowest level the logger writes, records below it aren't kept (or rendered)"""
+    handler_level = min([handler.level for handler in logger.handlers] or [logging.CRITICAL])
+    return max(logger.getEffectiveLevel(), handler_level)
+
+
+def _init_worker(config, check_device, level):
+    """Set up a worker process: log records are kept instead of written"""
+    global _config, _check_device
+    _config, _check_device = config, check_device
+    logger = logging.getLogger("BaselineCheck")
+    # Forked workers inherit the parent's BaselineCheck.log and stdout handlers
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(_RecordHandler())
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def _run(device):
+    """Check one device in a worker, returns (log records, JSON output)"""
+    del _records[:]
+    device_json = _check_device(_config, *device)
+    return list(_records), device_json
+
+
+def check(config, devices, check_device, jobs, level):
+    """
+    Check devices in a pool of worker processes.
+        :param config: baseline_check Config object
+        :param devices: (list) Arguments of check_device after the config for each device, in order
+        :param check_device: (function) Checks a device and returns its JSON output (or None)
+        :param jobs: (int) Number of worker processes
+        :param level: (int) Lowest log level to keep, see record_level
+        :return: (generator) (log records, JSON output) of each device, in the order of devices
+    """
+    with ProcessPoolExecutor(
+        max_workers=min(jobs, len(devices)),
+        initializer=_init_worker,
+        initargs=(config, check_device, level),
+    ) as pool:
+        yield from pool.map(_run, devices)
+
+
+def capture(logger, check_device, config, device, level):
+    """
+    Check one device in this process, keeping its log records instead of writing them
+        :return: (tuple) (log records, JSON output), like a worker
+    """
+    handlers, propagate = list(logger.handlers), logger.propagate
+    record_handler = _RecordHandler(level)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(record_handler)
+    logger.propagate = False
+    del _records[:]
+
+    def restore():
+        logger.removeHandler(record_handler)
+        for handler in handlers:
+            logger.addHandler(handler)
+        logger.propagate = propagate
+
+    try:
+        device_json = check_device(config, *device)
+    except BaseException:
+        # Write what was logged before the error
+        restore()
+        replay(logger, _records)
+        raise
+    restore()
+    return list(_records), device_json
+
+
+def replay(logger, records):
+    """Log the records from a worker on the parent's logger"""
+    for level, message in records:
+        logger.log(level, "%s", message)
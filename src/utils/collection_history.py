@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to remember how long each device takes to collect
+
+The history is used to put the slowest devices on the queue first
+(longest-processing-time-first scheduling), so one slow router at the end
+of the device list doesn't stretch the whole change window, and to print
+an estimate of how long the run will take.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import json
+import time
+import heapq
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows - runs saving at the same moment can still lose each other's devices
+    fcntl = None
+
+# Weight of the newest run in the smoothed collection times
+SMOOTHING = 0.5
+
+
+def format_time(seconds):
+    """Format seconds as 1h 02m 03s"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m {seconds % 60:02d}s"
+    return f"{seconds // 60}m {seconds % 60:02d}s"
+
+
+def estimate_makespan(durations, workers):
+    """Simulate the queue with the given number of workers and return the total run time
+    :param durations: (list) Expected seconds per device, in queue order
+    :param workers: (int) Number of worker threads
+    """
+    finish_times = [0.0] * max(1, min(workers, len(durations)))
+    for duration in durations:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+
+def _read_history(history_file):
+    """Returns the devices in a history file, or {} if it is missing or unreadable"""
+    try:
+        with open(history_file, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+class CollectionHistory(object):
+    """Per-device collection times, saved in cfg["history_file"]"""
+
+    def __init__(self, cfg):
+        self.history_file = cfg.get("history_file") or f"{cfg['mop_path']}/.collection_history.json"
+        self.default_time = cfg.get("history_default_time", 60)
+        self.lock = threading.Lock()
+        self.devices = _read_history(self.history_file)
+        # Devices recorded by this run, merged into the file when it is saved
+        self.new = set()
+
+    def expected(self, device):
+        """Expected seconds to collect a device, or the default for new devices"""
+        if device in self.devices:
+            return self.devices[device]["total"]
+        return self.default_time
+
+    def order(self, devices):
+        """Returns the devices sorted longest-expected-first"""
+        return sorted(devices, key=self.expected, reverse=True)
+
+    def print_estimate(self, devices, workers):
+        """Print the estimated run time for the (already ordered) devices"""
+        if not devices:
+            return
+        durations = [self.expected(device) for device in devices]
+        known = len([device for device in devices if device in self.devices])
+        print(
+            f"Estimated run time: {format_time(estimate_makespan(durations, workers))} "
+            f"for {len(devices)} devices on {workers} workers "
+            f"(longest device {format_time(max(durations))}, {known} with history)"
+        )
+
+    def record(self, device, total, command_times):
+        """Record the collection time of a device
+        :param device: (str) Device name
+        :param total: (float) Seconds from login to logout
+        :param command_times: (dict) Seconds per command
+        """
+        with self.lock:
+            entry = self.devices.get(device)
+            if not entry:
+                entry = {"total": total, "commands": dict(command_times), "runs": 0}
+            else:
+                entry["total"] = SMOOTHING * total + (1 - SMOOTHING) * entry["total"]
+                for command, seconds in command_times.items():
+                    old = entry["commands"].get(command, seconds)
+                    entry["commands"][command] = SMOOTHING * seconds + (1 - SMOOTHING) * old
+            entry["runs"] += 1
+            entry["updated"] = int(time.time())
+            self.devices[device] = entry
+            self.new.add(device)
+
+    def save(self):
+        """Save the history file
+
+        The file is read again and the devices recorded by this run merged
+        into it (the newest entry of a device wins), so runs sharing the file
+        keep each other's timings.
+        """
+        with self.lock:
+            if not self.new:
+                return
+            tmp_file = f"{self.history_file}.{os.getpid()}.tmp"
+            try:
+                # The lock file keeps another run from saving between the read and the rename
+                with open(f"{self.history_file}.lock", "a") as lock:
+                    if fcntl:
+                        fcntl.flock(lock, fcntl.LOCK_EX)
+                    devices = _read_history(self.history_file)
+                    for device in self.new:
+                        entry = self.devices[device]
+                        if device not in devices or devices[device].get("updated", 0) <= entry["updated"]:
+                            devices[device] = entry
+                    # Write to a temp file and rename, so other runs never read half a file
+                    with open(tmp_file, "w", encoding="utf-8") as f:
+                        json.dump(devices, f, indent=1, sort_keys=True)
+                    os.replace(tmp_file, self.history_file)
+                self.devices = devices
+                self.new = set()
+            except Exception as e:
+                print(f"ERROR saving collection history: {str(e)}")
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to tune the number of devices in flight while it runs
+
+A fixed max_threads is either too low (slow) or too high for the AAA
+servers, the bastion or the devices (logins time out).  With
+cfg["adaptive_concurrency"] the run starts at cfg["adaptive_start"]
+devices in flight and adjusts as devices finish, like TCP congestion
+control:
+
+ - Until the first problem the limit goes up by one for every device
+   that finishes cleanly (slow start), after that by one for every
+   <limit> devices (additive increase).
+ - It is not raised while the average login time is more than
+   ADAPTIVE_LATENCY_FACTOR times the fastest login seen.
+ - A failed SSH login or a session that had to be retried halves the
+   limit (multiplicative decrease).  Devices turned away before a login
+   was tried, like an unknown OS type, don't count.  Only devices started
+   after the last decrease can lower it again, so one burst of failures
+   counts once.
+
+The limit never goes over max_threads (async_max_sessions for the async
+engine).  Every adjustment and its reason is reported to the telemetry.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import time
+import threading
+
+# Default devices in flight at the start of the run
+ADAPTIVE_START = 4
+# Average login time, relative to the fastest login, above which the limit is held
+ADAPTIVE_LATENCY_FACTOR = 3.0
+# Weight of the newest login time in the average
+LATENCY_SMOOTHING = 0.3
+
+
+class AdaptiveConcurrency(object):
+    """AIMD limit on the devices in flight, shared by the workers"""
+
+    def __init__(self, cfg, ceiling, report=None):
+        """
+        :param ceiling: (int) Most devices in flight (max_threads or async_max_sessions)
+        :param report: (function) Called with each adjustment record
+        """
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(cfg.get("adaptive_start") or ADAPTIVE_START, self.ceiling))
+        self.latency_factor = cfg.get("adaptive_latency_factor") or ADAPTIVE_LATENCY_FACTOR
+        self.report = report
+        self.source = os.getpid()
+        self.cond = threading.Condition()
+        self.active = 0
+        self.epoch = 0
+        self.slow_start = True
+        self.successes = 0
+        self.fastest_connect = None
+        self.connect_avg = None
+        self.start = time.time()
+        self._adjust(self.limit, "start")
+
+    def _adjust(self, limit, reason):
+        """Set the limit and report the change"""
+        self.limit = limit
+        if self.report:
+            self.report(
+                {"time": round(time.time() - self.start, 1), "limit": limit, "reason": reason, "source": self.source}
+            )
+
+    def acquire(self):
+        """Wait for a free slot, returns a ticket for release"""
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+            return self.epoch
+
+    def release(self, ticket, stats):
+        """Free the slot of a finished device and adjust the limit from its stats
+        :param ticket: (int) From acquire
+        :param stats: (dict) The device's telemetry stats
+        """
+        with self.cond:
+            self.active -= 1
+            self._update(ticket, stats)
+            self.cond.notify_all()
+
+    def _update(self, ticket, stats):
+        """Apply one finished device to the limit (called with the lock held)"""
+        if stats["status"] == "skipped":
+            return
+        failure = None
+        if stats.get("login_failed"):
+            failure = f"login to {stats['device']} failed"
+            if stats.get("error"):
+                failure += f": {stats['error']}"
+        elif stats["connect"] is None:
+            # Turned away before a login was tried (no supported OS type), says nothing about the load
+            return
+        elif stats["retries"]:
+            failure = f"{stats['device']} needed {stats['retries']} retries"
+        if failure:
+            # Ignore devices that were already running before the last decrease
+            if ticket != self.epoch:
+                return
+            self.epoch += 1
+            self.slow_start = False
+            self.successes = 0
+            self._adjust(max(1, self.limit // 2), failure)
+            return
+        connect = stats["connect"]
+        self.fastest_connect = connect if self.fastest_connect is None else min(self.fastest_connect, connect)
+        if self.connect_avg is None:
+            self.connect_avg = connect
+        else:
+            self.connect_avg = LATENCY_SMOOTHING * connect + (1 - LATENCY_SMOOTHING) * self.connect_avg
+        if self.limit >= self.ceiling:
+            return
+        if self.connect_avg > self.latency_factor * max(self.fastest_connect, 0.1):
+            return
+        self.successes += 1
+        if self.slow_start or self.successes >= self.limit:
+            self.successes = 0
+            self._adjust(self.limit + 1, f"healthy, average login {self.connect_avg:.2f}s")
+
+
+def adaptive_concurrency(cfg, ceiling, telemetry):
+    """Returns the adaptive limit for the workers, or None if cfg["adaptive_concurrency"] isn't set
+    :param ceiling: (int) Most devices in flight
+    :param telemetry: (RunTelemetry) Adjustments are reported to its add_adjustment
+    """
+    if not cfg.get("adaptive_concurrency"):
+        return None
+    return AdaptiveConcurrency(cfg, ceiling, telemetry.add_adjustment)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to capture the config as a file instead of through the CLI
+
+Reading a big config through the interactive channel is the slowest part
+of most devices.  With cfg["config_transfer"] the config is saved to a
+file on the device in the same format as the CLI command (where the OS
+can't send the running config as a file directly) and downloaded over
+SFTP or SCP on the SSH connection that is already logged in.  The file is
+written to the log as the output of the config command, so config_diff
+and config_diff_flat work the same.  If anything fails, the config is read
+through the CLI as before.
+
+Each run saves to a new file name ({name} in the commands and path), the
+file is removed before the save (for a fixed name from the overrides) and
+checked after it, so a save that failed without an error can never pass
+off an earlier run's config as this one's.  The file is removed from the
+device after the download, over SFTP or with the delete command.
+
+The save, delete command and the file path can be changed per OS type
+with cfg["config_transfers"], e.g.:
+
+    config_transfers:
+      juniper_junos:
+        save: show configuration | display set | save /var/tmp/{name}
+        delete: file delete /var/tmp/{name}
+        path: /var/tmp/{name}
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import uuid
+import errno
+import paramiko
+from scp import SCPClient
+
+from utils.baseline_utils import CONFIG_COMMANDS
+from utils.baseline_utils import command_timeout
+from utils.log_writer import stream_command
+
+# How the config file is made and where it is downloaded from, for each OS type
+# ({name} is a new file name for each run)
+CONFIG_TRANSFERS = {
+    "juniper_junos": {
+        "save": "show configuration | display set | save /var/tmp/{name}",
+        "delete": "file delete /var/tmp/{name}",
+        "path": "/var/tmp/{name}",
+    },
+    # The running config can be copied straight from IOS
+    "cisco_ios": {"path": "system:running-config"},
+    "cisco_xr": {
+        "save": "show configuration running-config formal | file harddisk:/{name}",
+        "delete": "delete /noprompt harddisk:/{name}",
+        "path": "/harddisk:/{name}",
+    },
+    "nokia_sros": {
+        "save": "admin display-config > cf3:/{name}",
+        "delete": "file delete cf3:/{name} force",
+        "path": "cf3:/{name}",
+    },
+    "nokia_mdcli": {
+        "save": "admin show configuration > cf3:/{name}",
+        "delete": "file remove cf3:/{name}",
+        "path": "cf3:/{name}",
+    },
+}
+# Output of a save command that means the file wasn't written
+SAVE_ERRORS = re.compile(r"^\s*(%|error|invalid|syntax error|MINOR:|MAJOR:|CRITICAL:)", re.I | re.M)
+# Seconds to wait on a stalled SCP transfer
+SCP_TIMEOUT = 60
+# Characters copied into the log at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+def config_file_path(log_file):
+    """Returns the temp path the config is downloaded to, next to the log file"""
+    return f"{os.path.dirname(log_file)}/.{os.path.basename(log_file)}.config"
+
+
+def transfer_settings(cfg, device_type):
+    """
+    Returns the save/delete commands and file path for an OS type, with the
+    cfg["config_transfers"] overrides, and {name} set to a new file name
+    """
+    name = f"baseline_{uuid.uuid4().hex[:12]}.txt"
+    transfer = {**CONFIG_TRANSFERS.get(device_type, {}), **cfg.get("config_transfers", {}).get(device_type, {})}
+    return {key: str(value).replace("{name}", name) for key, value in transfer.items() if value}
+
+
+def transfer_methods(cfg):
+    """Returns the transfer methods to try, in order (cfg["config_transfer"] auto/true tries SFTP first)"""
+    if cfg["config_transfer"] in [True, "auto"]:
+        return ["sftp", "scp"]
+    return [cfg["config_transfer"]]
+
+
+def check_save(output):
+    """Raise if the output of a save command says the file wasn't written"""
+    if SAVE_ERRORS.search(output):
+        raise ValueError(" ".join(output.split()))
+
+
+def check_saved(size):
+    """Raise if the saved config file is empty"""
+    if not size:
+        raise ValueError("the saved config file is empty")
+
+
+def _sftp_call(transport, function):
+    """Run function(sftp) on a new SFTP session"""
+    sftp = paramiko.SFTPClient.from_transport(transport)
+    try:
+        return function(sftp)
+    finally:
+        sftp.close()
+
+
+def _remove(net_connect, transfer, cfg):
+    """
+    Remove the config file from the device, over SFTP or with the delete command.
+    Returns True if it is gone (or wasn't there).
+    """
+    try:
+        _sftp_call(net_connect.remote_conn.get_transport(), lambda sftp: sftp.remove(transfer["path"]))
+        return True
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return True
+    except Exception:
+        pass
+    if not transfer.get("delete"):
+        return False
+    try:
+        output = []
+        stream_command(
+            net_connect, transfer["delete"], output.append, read_timeout=command_timeout(cfg, transfer["delete"])
+        )
+        return True
+    except Exception:
+        return False
+
+
+def _save(net_connect, transfer, cfg, device_type):
+    """Save the config to the file on the device and check it was written"""
+    if not _remove(net_connect, transfer, cfg):
+        raise ValueError(f"could not remove an earlier {transfer['path']}")
+    output = []
+    stream_command(
+        net_connect, transfer["save"], output.append, read_timeout=command_timeout(cfg, CONFIG_COMMANDS[device_type])
+    )
+    check_save("".join(output))
+    try:
+        size = _sftp_call(net_connect.remote_conn.get_transport(), lambda sftp: sftp.stat(transfer["path"]).st_size)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            raise ValueError(f"the save didn't write {transfer['path']}")
+        return
+    except Exception:
+        # No SFTP on the device, the download fails if the (new) file isn't there
+        return
+    check_saved(size)
+
+
+def _download(transport, path, local_file, cfg):
+    """Download a file over SFTP or SCP"""
+    errors = []
+    for method in transfer_methods(cfg):
+        try:
+            if method == "sftp":
+                sftp = paramiko.SFTPClient.from_transport(transport)
+                try:
+                    sftp.get(path, local_file)
+                finally:
+                    sftp.close()
+            elif method == "scp":
+                with SCPClient(transport, socket_timeout=SCP_TIMEOUT) as scp:
+                    scp.get(path, local_file)
+            else:
+                raise ValueError(f"Unknown config_transfer {method}, use sftp, scp or auto")
+            return
+        except Exception as e:
+            errors.append(f"{method}: {str(e) or type(e).__name__}")
+    raise ValueError(", ".join(errors))
+
+
+def fetch_config(net_connect, device, device_type, cfg, local_file):
+    """
+    Save the config on the device and download it.
+        :param net_connect: Logged in netmiko connection
+        :param device: (str) Device name, for messages
+        :param device_type: (str) netmiko device type of the device
+        :param cfg: the baseline_run config yaml object
+        :param local_file: (str) Where to download the config to
+        :return: (bool) True if the config was downloaded, False to use the CLI command
+    """
+    transfer = transfer_settings(cfg, device_type)
+    # Sessions from baseline_keeper don't have an SSH transport to transfer files on
+    if not transfer.get("path") or not hasattr(net_connect, "remote_conn"):
+        return False
+    try:
+        if transfer.get("save"):
+            _save(net_connect, transfer, cfg, device_type)
+        _download(net_connect.remote_conn.get_transport(), transfer["path"], local_file, cfg)
+        return True
+    except Exception as e:
+        print(f"{device}: config transfer failed, reading the config through the CLI: {str(e)}")
+        if os.path.exists(local_file):
+            os.remove(local_file)
+        return False
+    finally:
+        # Files made by the save command don't stay on the device
+        if transfer.get("save"):
+            _remove(net_connect, transfer, cfg)
+
+
+def copy_config(local_file, write):
+    """
+    Write a downloaded config to the log the way stream_command would have:
+    with \\n line endings and without the trailing newlines.  The file is removed.
+    """
+    held = ""
+    with open(local_file, encoding="utf8", errors="replace", newline=None) as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+            chunk = held + chunk
+            text = chunk.rstrip("\n")
+            held = chunk[len(text) :]
+            if text:
+                write(text)
+    os.remove(local_file)
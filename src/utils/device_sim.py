@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""
+baseline module to simulate network devices over SSH for benchmarking
+
+Each simulated device listens on its own loopback address (127.0.x.y) on
+the same port, and answers with the prompt of its OS type.  Command
+output is replayed from baseline logs (the sample logs in src/mops by
+default), so baseline_run can be benchmarked without touching real
+routers.  Latency, output size and a session drop rate can be set to
+model slow or flaky devices, and commands typed ahead (sent before the
+prompt) can be echoed after the prompt like most CLIs, dropped, or
+echoed as they arrive.  Output can be saved to a file on a
+simulated device (| save, | file or >) and downloaded over SFTP, like
+the config_transfer option does on real devices.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import stat
+import time
+import random
+import socket
+import selectors
+import threading
+import paramiko
+
+from .log_io import open_log
+from .log_io import CHECK_LOGS
+
+OS_TYPES = ["juniper_junos", "cisco_ios", "cisco_xr", "nokia_sros", "nokia_mdcli"]
+# Replies netmiko waits for while it preps the session
+SETUP_REPLIES = {
+    "set cli screen-width 511": "Screen width set to 511",
+    "set cli complete-on-space off": "Disabling complete-on-space",
+    "set cli screen-length 0": "Screen length set to 0",
+}
+# Bytes sent to the client at a time
+CHUNK_SIZE = 16384
+# A command with its output saved to a file on the device
+SAVE_RE = re.compile(r"^(?P<command>.+?)\s*(?:\|\s*(?:save|file)\s+|>\s*)(?P<path>\S+)$")
+# A command that deletes a file on the device
+DELETE_RE = re.compile(r"^(?:file delete|file remove|delete(?: /noprompt)?)\s+(?P<path>\S+)(?:\s+force)?$")
+# Files that are always there, and the command their content comes from
+DEVICE_FILES = {"system:running-config": "show run"}
+
+
+def device_address(i):
+    """Returns the loopback address of the i-th simulated device (127.0.1.1, 127.0.1.2, ...)"""
+    return f"127.0.{1 + i // 250}.{1 + i % 250}"
+
+
+def load_outputs(folder):
+    """
+    Read the recorded command output from the baseline logs in a folder.
+        :param folder: (str) Folder to search for logs (e.g. src/mops)
+        :return: (dict) {os_type: {command: output}}, the first log found for each command wins
+    """
+    outputs = {}
+    for root, _dirs, files in os.walk(folder):
+        for file_name in sorted(files):
+            if file_name.startswith(".") or file_name in CHECK_LOGS or "_log" not in file_name:
+                continue
+            os_type, command, lines = None, None, []
+            commands = {}
+            try:
+                with open_log(f"{root}/{file_name}") as f:
+                    for line in f:
+                        if line.startswith("[DEVICE_TYPE]"):
+                            os_type = line.split()[-1]
+                        elif line.startswith("[COMMAND]"):
+                            if command:
+                                commands[command] = "".join(lines).strip("\n")
+                            command, lines = line.replace("[COMMAND]", "").strip(), []
+                        elif command:
+                            lines.append(line)
+            except Exception:
+                continue
+            if command:
+                commands[command] = "".join(lines).strip("\n")
+            if os_type:
+                for command, output in commands.items():
+                    if not output.startswith("[NOT_COLLECTED]"):
+                        outputs.setdefault(os_type, {}).setdefault(command, output)
+    return outputs
+
+
+class SimDevice(object):
+    """One simulated device"""
+
+    def __init__(self, address, hostname, os_type, username="guest"):
+        self.address = address
+        self.hostname = hostname
+        self.os_type = os_type
+        prompts = {
+            "juniper_junos": f"{username}@{hostname}> ",
+            "cisco_ios": f"{hostname}#",
+            "cisco_xr": f"RP/0/RP0/CPU0:{hostname}#",
+            "nokia_sros": f"A:{hostname}# ",
+            "nokia_mdcli": f"[/]\r\nA:{username}@{hostname}# ",
+        }
+        self.prompt = prompts[os_type]
+        # Files saved on the device, {path: bytes}
+        self.files = {}
+
+
+class _SimServer(paramiko.ServerInterface):
+    """Accepts any password and interactive shell sessions"""
+
+    def __init__(self, simulator, device):
+        self.simulator = simulator
+        self.device = device
+        # Set when a channel asks for a shell, SFTP channels are served by the subsystem handler
+        self.shells = {}
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            self.shells[chanid] = threading.Event()
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OPEN_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self.shells[channel.get_id()].set()
+        return True
+
+
+class _SimFile(paramiko.SFTPHandle):
+    """A file being downloaded from a simulated device"""
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def read(self, offset, length):
+        return self.data[offset : offset + length]
+
+    def stat(self):
+        return _file_attributes(self.data)
+
+
+def _file_attributes(data):
+    """SFTP attributes of a read-only file"""
+    attributes = paramiko.SFTPAttributes()
+    attributes.st_size = len(data)
+    attributes.st_mode = stat.S_IFREG | 0o444
+    return attributes
+
+
+class _SimSFTP(paramiko.SFTPServerInterface):
+    """Serves the files saved on a simulated device"""
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.simulator = server.simulator
+        self.device = server.device
+
+    def _name(self, path):
+        """Returns the name a file was saved under (IOS-XR file systems are /harddisk:/... over SFTP)"""
+        for name in [path, path.lstrip("/")]:
+            if name in self.device.files:
+                return name
+        return None
+
+    def _data(self, path):
+        if self._name(path):
+            return self.device.files[self._name(path)]
+        if path in DEVICE_FILES:
+            return self.simulator.output(self.device, DEVICE_FILES[path]).replace("\r\n", "\n").encode() + b"\n"
+        return None
+
+    def open(self, path, flags, attr):
+        data = self._data(path)
+        if data is None:
+            return paramiko.SFTP_NO_SUCH_FILE
+        return _SimFile(data)
+
+    def stat(self, path):
+        data = self._data(path)
+        return paramiko.SFTP_NO_SUCH_FILE if data is None else _file_attributes(data)
+
+    lstat = stat
+
+    def remove(self, path):
+        if not self._name(path):
+            return paramiko.SFTP_NO_SUCH_FILE
+        del self.device.files[self._name(path)]
+        return paramiko.SFTP_OK
+
+
+class DeviceSimulator(object):
+    """Runs the SSH servers for a set of simulated devices"""
+
+    def __init__(
+        self,
+        count,
+        os_types=None,
+        replay_path=None,
+        port=2222,
+        latency=0.0,
+        size=1.0,
+        failure_rate=0.0,
+        typeahead="echo",
+    ):
+        """
+        :param count: (int) Number of devices
+        :param os_types: (list) OS types, given to the devices in turn (default all)
+        :param replay_path: (str) Folder of baseline logs to replay the output from
+        :param port: (int) SSH port every device listens on
+        :param latency: (float) Average seconds before a command's output starts
+        :param size: (float) Output size multiplier
+        :param failure_rate: (float) Chance (0-1) that a command drops the session
+        :param typeahead: (str) What happens to commands sent before the prompt: echo (after the prompt),
+                          drop (discarded) or early (echoed as they arrive, not after the prompt)
+        """
+        os_types = os_types or OS_TYPES
+        self.port = port
+        self.latency = latency
+        self.size = size
+        self.failure_rate = failure_rate
+        self.typeahead = typeahead
+        self.outputs = load_outputs(replay_path) if replay_path else {}
+        self.devices = {}
+        for i in range(count):
+            address = device_address(i)
+            self.devices[address] = SimDevice(address, f"sim{i + 1}", os_types[i % len(os_types)])
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+
+    def write_override(self, path):
+        """Write an OS override file for the devices, for cfg["os_override_file"]"""
+        with open(path, "w", encoding="utf8") as f:
+            for device in self.devices.values():
+                # MD-CLI is found from the prompt, netmiko only knows nokia_sros
+                os_type = "nokia_sros" if device.os_type == "nokia_mdcli" else device.os_type
+                f.write(f"{device.address} {os_type}\n")
+
+    def output(self, device, command):
+        """Returns the simulated output of a command"""
+        output = self.outputs.get(device.os_type, {}).get(command, SETUP_REPLIES.get(command))
+        if output is None:
+            # Config commands and anything that wasn't recorded
+            output = "" if command.split()[0] in ["set", "terminal", "environment"] else f"{command}: simulated"
+        if self.size != 1.0 and output:
+            lines = output.split("\n")
+            output = "\n".join((lines * int(self.size + 1))[: max(1, int(len(lines) * self.size))])
+        return output.replace("\n", "\r\n")
+
+    def _session(self, device, channel):
+        """Serve one shell channel: echo each command, then its output and the prompt"""
+        channel.sendall(f"\r\nSimulated {device.os_type}\r\n\r\n{device.prompt}".encode())
+        buffer, last = "", ""
+        try:
+            while self.running:
+                data = channel.recv(4096)
+                if not data:
+                    return
+                data = data.decode("utf-8", errors="replace")
+                # Early echo: everything that arrived is echoed with the first reply, like a terminal
+                # that echoes typed-ahead input, and the replies after it have no echo
+                pending = re.sub(r"\r\n|\r|\n", "\r\n", data) if self.typeahead == "early" else None
+                for char in data:
+                    if char == "\n" and last == "\r":
+                        last = char
+                        continue
+                    last = char
+                    if char not in "\r\n":
+                        buffer += char
+                        continue
+                    command, buffer = buffer.strip(), ""
+                    # The echo of the command and the newline after it
+                    echo = f"{command}\r\n"
+                    if pending is not None:
+                        echo, pending = pending, ""
+                    if not command:
+                        channel.sendall(f"{echo}{device.prompt}".encode())
+                        continue
+                    if self.latency:
+                        time.sleep(random.uniform(0.5, 1.5) * self.latency)
+                    if self.failure_rate and random.random() < self.failure_rate:
+                        # Drop the session mid-command like a flaky device
+                        channel.get_transport().close()
+                        return
+                    saved = SAVE_RE.match(command)
+                    deleted = DELETE_RE.match(command)
+                    if deleted:
+                        reply = "" if device.files.pop(deleted.group("path"), None) is not None else "error: no such file"
+                    elif saved:
+                        output = self.output(device, saved.group("command")).replace("\r\n", "\n")
+                        device.files[saved.group("path")] = output.encode() + b"\n"
+                        reply = f"Wrote {output.count(chr(10)) + 1} lines of output to '{saved.group('path')}'"
+                    else:
+                        reply = self.output(device, command)
+                    output = f"{echo}{reply}\r\n{device.prompt}".encode()
+                    for i in range(0, len(output), CHUNK_SIZE):
+                        channel.sendall(output[i : i + CHUNK_SIZE])
+                    if self.typeahead == "drop":
+                        # Throw away the rest of what was sent with this command
+                        break
+        except Exception:
+            pass
+        finally:
+            channel.close()
+
+    def _shell(self, device, server, channel):
+        """Run a shell session on a channel once it asks for one"""
+        if server.shells[channel.get_id()].wait(10):
+            self._session(device, channel)
+
+    def _connection(self, device, client):
+        """Handle one SSH connection (it can open more than one shell channel)"""
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SimSFTP)
+        server = _SimServer(self, device)
+        try:
+            transport.start_server(server=server)
+            while self.running and transport.is_active():
+                channel = transport.accept(1)
+                if channel:
+                    threading.Thread(target=self._shell, args=(device, server, channel), daemon=True).start()
+        except Exception:
+            pass
+        finally:
+            transport.close()
+
+    def _accept_loop(self):
+        """Accept connections on all of the device addresses"""
+        while self.running:
+            for key, _events in self.selector.select(timeout=1):
+                try:
+                    client, _address = key.fileobj.accept()
+                except OSError:
+                    continue
+                threading.Thread(target=self._connection, args=(key.data, client), daemon=True).start()
+
+    def start(self):
+        """Start listening on every device address"""
+        for device in self.devices.values():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((device.address, self.port))
+            sock.listen(100)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, device)
+        self.running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def stop(self):
+        """Stop listening"""
+        self.running = False
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+"""
+baseline module for the [COMMAND] index of a baseline log
+
+baseline_run writes a small hidden sidecar next to each log with the byte
+offset and length of every [COMMAND] block:
+
+    .<mop>_<device>_<keyword>_log.idx
+    {"version": 2, "file_size": 1234, "file_mtime": 1717171717000000000,
+     "commands": [["show version", 120, 830], ...]}
+
+Offsets are in the uncompressed text, so the same index works after the
+log is compacted.  The index is only used while the log's size and
+modification time match, a log that was edited is indexed again.  baseline_check uses it to read only the command
+sections the testfiles ask for, and builds it in one pass over the log
+for logs captured before the index existed.
+johntishey@gmail.com - 2024
+"""
+
+import io
+import os
+import json
+from collections.abc import MutableMapping
+
+from .log_io import open_log_binary
+from .log_io import strip_compression_suffix
+
+INDEX_VERSION = 2
+# Bytes read at a time when skipping forward in a compressed log
+SKIP_CHUNK = 1024 * 1024
+
+
+def index_path(log_file):
+    """Returns the sidecar index path for a log (the same for plain and compressed logs)"""
+    folder, file_name = os.path.split(log_file)
+    return os.path.join(folder, f".{strip_compression_suffix(file_name)}.idx")
+
+
+def _file_stamp(log_file):
+    """Returns the size and modification time the index of a log is valid for"""
+    stat = os.stat(log_file)
+    return {"file_size": stat.st_size, "file_mtime": stat.st_mtime_ns}
+
+
+def write_index(log_file, entries):
+    """
+    Write the sidecar index for a finished log (temp file renamed into place).
+        :param log_file: (str) Path of the finished log
+        :param entries: (list) [command, offset, length] or [command, None, reason] for
+                        commands that were not collected, in log order
+    """
+    path = index_path(log_file)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, **_file_stamp(log_file), "commands": entries}, f)
+        os.replace(tmp_file, path)
+    except Exception as e:
+        print(f"ERROR writing log index {path}: {str(e)}")
+
+
+def rebase_index(old_file, new_file):
+    """Point a log's index at the compacted copy of the log (the uncompressed offsets don't change)"""
+    path = index_path(old_file)
+    try:
+        with open(path, encoding="utf-8") as f:
+            index = json.load(f)
+        if index["version"] != INDEX_VERSION or _file_stamp(old_file) != {
+            "file_size": index["file_size"],
+            "file_mtime": index["file_mtime"],
+        }:
+            return
+        index.update(_file_stamp(new_file))
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, path)
+    except Exception:
+        # No index, baseline_check will build one
+        pass
+
+
+def _read_index(log_file):
+    """Returns the entries from the sidecar, or None if it's missing or doesn't match the log"""
+    try:
+        with open(index_path(log_file), encoding="utf-8") as f:
+            index = json.load(f)
+        stamp = _file_stamp(log_file)
+        if (
+            index["version"] == INDEX_VERSION
+            and index["file_size"] == stamp["file_size"]
+            and index["file_mtime"] == stamp["file_mtime"]
+        ):
+            return index["commands"]
+    except Exception:
+        pass
+    return None
+
+
+def build_index(log_file):
+    """
+    Build the index in one pass over a log that doesn't have a sidecar.
+        :return: (list) Index entries, or None if the log has no [COMMAND] blocks
+                 (older logs captured with the prompt, which need the full parse)
+    """
+    entries = []
+    offset = 0
+    with open_log_binary(log_file) as f:
+        for line in f:
+            if line.startswith(b"[COMMAND]"):
+                if entries and entries[-1][1] is not None:
+                    entries[-1][2] = offset - entries[-1][1]
+                command = line.decode("utf-8", errors="replace").rstrip()
+                entries.append([command.replace("[COMMAND] ", "", 1), offset + len(line), 0])
+            elif line.startswith(b"[NOT_COLLECTED]") and entries and entries[-1][2] == 0:
+                if entries[-1][1] == offset:
+                    reason = line.decode("utf-8", errors="replace").replace("[NOT_COLLECTED]", "").strip()
+                    entries[-1][1:] = [None, reason]
+            offset += len(line)
+    if not entries:
+        return None
+    if entries[-1][1] is not None:
+        entries[-1][2] = offset - entries[-1][1]
+    # Save it for next time, it's only a cache so carry on if the folder is read only
+    write_index(log_file, entries)
+    return entries
+
+
+def load_index(log_file):
+    """Returns the index entries for a log, building the sidecar if needed (None = no [COMMAND] blocks)"""
+    entries = _read_index(log_file)
+    if entries is None:
+        entries = build_index(log_file)
+    return entries
+
+
+class LazyCommands(MutableMapping):
+    """
+    Command -> output lines for one baseline log, like the dict the extractor
+    used to build, but each command's output is only read from the log the
+    first time it is looked up.  A command's output can be more than one
+    section of the log, see __init__.
+    """
+
+    def __init__(self, log_file, entries):
+        self.log_file = log_file
+        # command -> [(offset, length), ...]
+        self.sections = {}
+        self.loaded = {}
+        self.not_collected = {}
+        self.reader = None
+        self.position = 0
+        current = None
+        for command, offset, length in entries:
+            # The full parse keys commands on the [COMMAND] line with its trailing spaces stripped
+            command = command.rstrip()
+            # The full parse doesn't start a new command at a [COMMAND] line ending in > or #,
+            # it drops the line and keeps adding the lines after it to the command before it
+            if command.endswith(">") or command.endswith("#"):
+                if current is None:
+                    continue
+                if offset is None:
+                    # ...and a [NOT_COLLECTED] line right after it marks that command
+                    del self.sections[current]
+                    self.not_collected[current] = length
+                    current = None
+                else:
+                    self.sections[current].append((offset, length))
+                continue
+            if offset is None:
+                self.sections.pop(command, None)
+                self.not_collected[command] = length
+                current = None
+            else:
+                self.sections[command] = [(offset, length)]
+                current = command
+
+    def _read(self, offset, length):
+        """Read a section of the uncompressed log"""
+        if self.reader is None or offset < self.position:
+            self.close()
+            self.reader = open_log_binary(self.log_file)
+            self.position = 0
+        if self.reader.seekable():
+            self.reader.seek(offset)
+        else:
+            # zstd streams can only be read forward
+            while self.position < offset:
+                skipped = self.reader.read(min(SKIP_CHUNK, offset - self.position))
+                if not skipped:
+                    break
+                self.position += len(skipped)
+        data = self.reader.read(length)
+        self.position = offset + len(data)
+        return data.decode("utf-8", errors="replace")
+
+    def _load(self, command):
+        """Read and filter the output lines of a command"""
+        lines = []
+        for offset, length in self.sections[command]:
+            # Split lines the same way reading the log in text mode does
+            for line in io.StringIO(self._read(offset, length), newline=None):
+                line = line.rstrip()
+                if line != "" and line[:7] != "{master" and line != "[]":
+                    lines.append(line)
+        return lines
+
+    def __getitem__(self, command):
+        if command not in self.loaded:
+            if command not in self.sections:
+                raise KeyError(command)
+            self.loaded[command] = self._load(command)
+        return self.loaded[command]
+
+    def __setitem__(self, command, lines):
+        if command not in self.sections:
+            self.sections[command] = None
+        self.loaded[command] = lines
+
+    def __delitem__(self, command):
+        del self.sections[command]
+        self.loaded.pop(command, None)
+
+    def __iter__(self):
+        return iter(list(self.sections))
+
+    def __len__(self):
+        return len(self.sections)
+
+    def __contains__(self, command):
+        return command in self.sections
+
+    def close(self):
+        """Close the log file, sections are opened again if needed"""
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def __del__(self):
+        self.close()
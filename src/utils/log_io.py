@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+baseline module to read and write compressed baseline logs
+
+Logs can be written as gzip (.gz) or zstd (.zst, needs the zstandard
+package).  open_log() detects the format from the file contents, so the
+check scripts read plain and compressed logs the same way, streaming the
+decompression instead of unpacking the file first.
+johntishey@gmail.com - 2024
+"""
+
+import io
+import os
+import gzip
+import shutil
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Log files written by baseline_check itself, these stay plain text
+CHECK_LOGS = ["BaselineCheck.log", "BaselineParser.log"]
+
+
+def _check_zstd():
+    """Exit with an error if zstd is needed but not installed"""
+    if zstandard is None:
+        print("ERROR: zstd compression requires the zstandard package (pip install zstandard)")
+        exit(1)
+
+
+def strip_compression_suffix(file_name):
+    """Returns the file name without a .gz/.zst suffix"""
+    for suffix in COMPRESSION_SUFFIXES.values():
+        if file_name.endswith(suffix):
+            return file_name[: -len(suffix)]
+    return file_name
+
+
+def compressed_name(file_name, compression):
+    """Returns the file name with the suffix for the compression (None = plain text)"""
+    file_name = strip_compression_suffix(file_name)
+    if not compression:
+        return file_name
+    return file_name + COMPRESSION_SUFFIXES[compression]
+
+
+def open_log(path, mode="r", compression=None):
+    """
+    Open a baseline log as text.
+    When reading, gzip/zstd/plain is detected from the first bytes of the file.
+    When writing, compression is gzip, zstd or None for plain text.
+    """
+    if "r" in mode:
+        with open(path, "rb") as f:
+            magic = f.read(4)
+        if magic.startswith(GZIP_MAGIC):
+            return gzip.open(path, "rt", errors="replace", encoding="utf-8")
+        if magic.startswith(ZSTD_MAGIC):
+            _check_zstd()
+            reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+            return io.TextIOWrapper(reader, errors="replace", encoding="utf-8")
+        return open(path, "r", errors="replace", encoding="utf-8")
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf8", compresslevel=6)
+    if compression == "zstd":
+        _check_zstd()
+        writer = zstandard.ZstdCompressor(level=6).stream_writer(open(path, "wb"))
+        return io.TextIOWrapper(writer, encoding="utf8")
+    return open(path, "w", encoding="utf8")
+
+
+def open_log_binary(path):
+    """Open a baseline log for reading as uncompressed bytes (gzip/zstd/plain is detected)"""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, "rb")
+    if magic.startswith(ZSTD_MAGIC):
+        _check_zstd()
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def compact_folder(folder, compression="gzip"):
+    """
+    Compress the baseline logs in a MOP folder in place.
+    Each file is compressed to a temp file, renamed into place, and then
+    the plain text file is removed.  The bytes are copied as-is, so the
+    offsets in the log's [COMMAND] index stay valid.
+        :param folder: (str) MOP folder path
+        :param compression: (str) gzip or zstd
+        :return: (tuple) Bytes before and after compression
+    """
+    # log_index reads logs with this module, so import it here
+    from .log_index import rebase_index
+
+    before, after = 0, 0
+    for file_name in sorted(os.listdir(folder)):
+        path = f"{folder}/{file_name}"
+        if file_name.startswith(".") or file_name in CHECK_LOGS or not os.path.isfile(path):
+            continue
+        if strip_compression_suffix(file_name) != file_name:
+            continue
+        new_path = f"{folder}/{compressed_name(file_name, compression)}"
+        tmp_path = f"{folder}/.{compressed_name(file_name, compression)}.partial"
+        with open(path, "rb") as src, open_log(tmp_path, "w", compression) as dst:
+            shutil.copyfileobj(src, dst.buffer)
+        os.replace(tmp_path, new_path)
+        before += os.path.getsize(path)
+        after += os.path.getsize(new_path)
+        rebase_index(path, new_path)
+        os.remove(path)
+    return before, after
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to stream command output to the log file
+
+Each [COMMAND] block is appended to a hidden partial file as soon as
+it is read from the device, so a device with a huge config or route table
+never has to sit in memory as one string.  When the device is finished
+the partial file is renamed over the final log file, and the byte offset
+of each block is saved in the log's index sidecar (see log_index).
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import time
+
+from utils.log_io import open_log
+from utils.log_io import compressed_name
+from utils.log_io import COMPRESSION_SUFFIXES
+from utils.log_index import write_index
+
+# Seconds stream_commands waits at a prompt for the echo of the next command it sent
+ECHO_WAIT = 3
+
+
+class LogWriter(object):
+    """Append-only writer for a baseline log file"""
+
+    def __init__(self, log_file, compression=None):
+        """Opens <dir>/.<log_name>.partial for writing
+        :param log_file: (str) Final path of the log file
+        :param compression: (str) gzip, zstd or None for plain text"""
+        self.plain_file = log_file
+        self.log_file = compressed_name(log_file, compression)
+        self.compression = compression
+        self.tmp_file = f"{os.path.dirname(self.log_file)}/.{os.path.basename(self.log_file)}.partial"
+        self.f = open_log(self.tmp_file, "w", compression)
+        # Bytes written so far and [command, offset, length] of each block for the index
+        self.offset = 0
+        self.index = []
+
+    def flush(self):
+        """Flush plain text logs to disk (compressed logs are only flushed on close)"""
+        if not self.compression:
+            self.f.flush()
+
+    def write(self, text):
+        """Append text to the log file"""
+        self.f.write(text)
+        self.offset += len(text.encode("utf8"))
+
+    def _end_command(self):
+        """Set the length of the last [COMMAND] block in the index"""
+        if self.index and self.index[-1][1] is not None:
+            self.index[-1][2] = self.offset - self.index[-1][1]
+
+    def start_command(self, command):
+        """Start a new [COMMAND] block"""
+        self._end_command()
+        self.write(f"\n\n[COMMAND] {command}\n")
+        self.index.append([command, self.offset, 0])
+        self.flush()
+
+    def not_collected(self, command, reason):
+        """Record a command that could not be collected, so baseline_check can report it"""
+        self._end_command()
+        reason = " ".join(str(reason).split())
+        self.write(f"\n\n[COMMAND] {command}\n[NOT_COLLECTED] {reason}\n")
+        self.index.append([command, None, reason])
+        self.flush()
+
+    def discard(self):
+        """Close and remove the partial file of a device that failed, the log from an earlier run stays"""
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def close(self):
+        """Close the partial file and move it into place"""
+        if self.f.closed:
+            return
+        self._end_command()
+        self.f.close()
+        os.replace(self.tmp_file, self.log_file)
+        write_index(self.log_file, self.index)
+        # Remove the log from an earlier run if it was written with a different compression
+        for compression in [None] + list(COMPRESSION_SUFFIXES):
+            old_file = compressed_name(self.plain_file, compression)
+            if old_file != self.log_file and os.path.exists(old_file):
+                os.remove(old_file)
+
+
+def _read_channel(net_connect, command, last_data, read_timeout):
+    """
+    Returns the output waiting on the channel, or "" after a short sleep if there is none.
+    Raises if the session was dropped or nothing has arrived for read_timeout seconds.
+    """
+    data = net_connect.read_channel()
+    if not data:
+        # Don't wait out the timeout on a session the device has dropped
+        channel = getattr(net_connect, "remote_conn", None) or getattr(net_connect, "channel", None)
+        if getattr(channel, "closed", False):
+            raise EOFError(f"Session closed waiting for prompt: {command}")
+        if time.time() - last_data > read_timeout:
+            raise TimeoutError(f"Timed out after {read_timeout}s waiting for prompt: {command}")
+        time.sleep(0.05)
+    return data
+
+
+def stream_command(net_connect, command, write, read_timeout=120, deadline=None):
+    """
+    Sends a command on a netmiko connection and passes the output to write()
+    line by line as it arrives.  The command echo and the trailing prompt are
+    stripped the same way as netmiko's send_command.
+        :param net_connect: netmiko connection object
+        :param command: (str) Command to run
+        :param write: (function) Called with each chunk of output text
+        :param read_timeout: (int) Seconds to wait for more output before giving up
+        :param deadline: (float) Epoch time the command must be finished by
+    """
+    # Sessions attached through baseline_keeper stream the output themselves
+    if hasattr(net_connect, "stream_command"):
+        return net_connect.stream_command(command, write, read_timeout=read_timeout, deadline=deadline)
+    prompt_re = re.compile(re.escape(net_connect.base_prompt) + r".*[>#$%]\s*$")
+    net_connect.write_channel(command + net_connect.RETURN)
+    # tail is the last (possibly partial) line, held back until we know it isn't the prompt
+    tail = ""
+    echo_stripped = False
+    newline_held = False
+    last_data = time.time()
+    while True:
+        if deadline and time.time() > deadline:
+            raise TimeoutError(f"Deadline exceeded waiting for prompt: {command}")
+        data = _read_channel(net_connect, command, last_data, read_timeout)
+        if not data:
+            continue
+        last_data = time.time()
+        tail += data.replace("\r", "")
+        if not echo_stripped:
+            if "\n" not in tail:
+                continue
+            first_line, rest = tail.split("\n", 1)
+            if command.strip() in first_line:
+                tail = rest
+            echo_stripped = True
+        head, sep, last = tail.rpartition("\n")
+        if prompt_re.search(last):
+            if sep:
+                write(("\n" if newline_held else "") + head)
+            return
+        if sep:
+            # Hold back the newline, the one before the prompt is not part of the output
+            write(("\n" if newline_held else "") + head)
+            newline_held = True
+            tail = last
+
+
+def _skip_prompts(net_connect, command, text, count, prompt_any_re, prompt_re, read_timeout, deadline):
+    """
+    Read and drop output until count more prompts have been seen, the last one at
+    the end of the output, so the session is back at an idle prompt.
+        :param text: (str) Output already read after the last prompt that was counted
+    """
+    seen = 0
+    last_data = time.time()
+    while True:
+        lines = text.split("\n")
+        text = lines.pop()
+        seen += sum(1 for line in lines if prompt_any_re.search(line))
+        if count == 0 or (seen >= count - 1 and prompt_re.search(text)):
+            return
+        if deadline and time.time() > deadline:
+            raise TimeoutError(f"Deadline exceeded waiting for prompt: {command}")
+        data = _read_channel(net_connect, command, last_data, read_timeout)
+        if data:
+            last_data = time.time()
+            text += data.replace("\r", "")
+
+
+def stream_commands(net_connect, commands, target, finished, read_timeout=120, deadline=None):
+    """
+    Sends a batch of commands in one write and splits the output back into
+    [COMMAND] blocks, so a slow link costs one round trip per batch instead
+    of one per command.  The device reads the commands one at a time, so
+    each command's output ends at the prompt followed by the echo of the
+    next command, and the last one ends at the bare prompt.  The output of
+    each block is the same as stream_command's.
+
+    Not every CLI echoes commands typed ahead after the prompt: some drop
+    them, some echo them as they arrive.  If a prompt shows up that isn't
+    followed by the echo of the next command, or the echo doesn't follow
+    the prompt within ECHO_WAIT seconds, the device's output is skipped up
+    to its last prompt and the rest of the batch is run one command at a
+    time with stream_command (the unfinished command's block is started again).
+        :param net_connect: netmiko connection object
+        :param commands: (list) Commands to run, in order
+        :param target: LogWriter (or CommandSpool), start_command() is called as each block starts
+        :param finished: (list) Seconds taken by each command are appended as it finishes, so the
+                         caller knows where to resume if the batch fails part way through
+        :param read_timeout: (int) Seconds to wait for more output before giving up
+        :param deadline: (float) Epoch time the commands must be finished by
+        :return: (bool) False if the device didn't echo the commands after the prompt
+                 and they were run one at a time
+    """
+    # Sessions attached through baseline_keeper only take one command at a time
+    if hasattr(net_connect, "stream_command"):
+        for command in commands:
+            command_start = time.time()
+            target.start_command(command)
+            stream_command(net_connect, command, target.write, read_timeout=read_timeout, deadline=deadline)
+            finished.append(time.time() - command_start)
+        return True
+    prompt = re.escape(net_connect.base_prompt) + r".*[>#$%]\s*"
+    prompt_re = re.compile(prompt + "$")
+    # Any prompt, with or without an echo after it
+    prompt_any_re = re.compile(prompt)
+    # The prompt line that starts each command after the first
+    next_res = [re.compile(prompt + re.escape(command.strip()) + r"\s*$") for command in commands[1:]]
+    net_connect.write_channel("".join(command + net_connect.RETURN for command in commands))
+    current = 0
+    command_start = time.time()
+    target.start_command(commands[0])
+    tail = ""
+    echo_stripped = False
+    newline_held = False
+    last_data = time.time()
+    # Index of the command to run again one at a time if the echo isn't where it should be
+    resume = None
+    while resume is None:
+        if deadline and time.time() > deadline:
+            raise TimeoutError(f"Deadline exceeded waiting for prompt: {commands[current]}")
+        data = _read_channel(net_connect, commands[current], last_data, read_timeout)
+        if not data:
+            if current < len(next_res) and prompt_re.search(tail) and time.time() - last_data > ECHO_WAIT:
+                # Idle at the prompt: this command is finished, the device dropped the rest
+                finished.append(time.time() - command_start)
+                resume = current + 1
+            continue
+        last_data = time.time()
+        lines = (tail + data.replace("\r", "")).split("\n")
+        tail = lines.pop()
+        output = []
+        for i, line in enumerate(lines):
+            if not echo_stripped:
+                echo_stripped = True
+                if commands[current].strip() in line:
+                    continue
+            if current < len(next_res) and next_res[current].search(line):
+                # The prompt and echo of the next command: this command is finished
+                target.write("".join(output))
+                output = []
+                finished.append(time.time() - command_start)
+                current += 1
+                command_start = time.time()
+                target.start_command(commands[current])
+                newline_held = False
+                continue
+            if prompt_any_re.search(line):
+                # A prompt without the next command's echo: the output of this command can't be trusted,
+                # skip what the device sends until it is idle after the commands it still has to run
+                _skip_prompts(
+                    net_connect,
+                    commands[current],
+                    "\n".join(lines[i + 1 :] + [tail]),
+                    len(commands) - current - 1,
+                    prompt_any_re,
+                    prompt_re,
+                    read_timeout,
+                    deadline,
+                )
+                resume = current
+                break
+            # Hold back the newline, the one before the prompt is not part of the output
+            output.append(("\n" if newline_held else "") + line)
+            newline_held = True
+        if resume is not None:
+            break
+        target.write("".join(output))
+        if current == len(next_res) and prompt_re.search(tail):
+            finished.append(time.time() - command_start)
+            return True
+    for command in commands[resume:]:
+        command_start = time.time()
+        target.start_command(command)
+        stream_command(net_connect, command, target.write, read_timeout=read_timeout, deadline=deadline)
+        finished.append(time.time() - command_start)
+    return False
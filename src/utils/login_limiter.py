@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to pace logins so TACACS/RADIUS isn't flooded
+
+With a high max_threads every worker logs in at the same moment, the AAA
+servers throttle and logins start failing.  A token bucket shared by all
+of the workers lets logins through at cfg["login_rate"] per second, with
+bursts of up to cfg["login_burst"].  Only the logins are paced, commands
+on the sessions that are already up still run in parallel.
+johntishey@gmail.com - 2024
+"""
+
+import time
+import asyncio
+import threading
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+class LoginLimiter(object):
+    """Token bucket for logins, shared by the worker threads (or async sessions)"""
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: (float) Logins per second
+        :param burst: (int) Logins allowed at once after an idle period
+        """
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token and return the seconds to wait until it is available.
+        Tokens are handed out in order, so a waiting worker is never overtaken."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def wait(self):
+        """Block until a login is allowed, returns the seconds waited"""
+        delay = self._reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def wait_async(self):
+        """Wait on the event loop until a login is allowed, returns the seconds waited"""
+        delay = self._reserve()
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+
+def login_limiter(cfg):
+    """Returns the login limiter for this process, or None if cfg["login_rate"] isn't set"""
+    global _limiter
+    if not cfg.get("login_rate"):
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = LoginLimiter(cfg["login_rate"], cfg.get("login_burst") or 1)
+    return _limiter
+
+
+def wait_for_login(cfg):
+    """Block until the next login is allowed (no wait if login_rate isn't set)"""
+    limiter = login_limiter(cfg)
+    return limiter.wait() if limiter else 0.0
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to check devices before any SSH workers are started
+
+For the whole device list at once, this looks up DNS, checks that TCP/22
+is open and gets the OS type.  Then one canary login checks the
+credentials.  Only the devices that pass are handed to the SSH workers,
+so dead devices don't tie up a worker until the login timeout.
+johntishey@gmail.com - 2024
+"""
+
+import sys
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from netmiko import NetmikoAuthenticationException
+
+from utils.baseline_utils import get_os
+
+SSH_PORT = 22
+
+
+def _check_device(device, cfg, os_type=None):
+    """Returns None if the device looks healthy, or the reason to skip it"""
+    timeout = cfg.get("preflight_timeout", 5)
+    port = cfg.get("ssh_port", SSH_PORT)
+    try:
+        address = socket.getaddrinfo(device, port, proto=socket.IPPROTO_TCP)[0][4]
+    except Exception as e:
+        return f"DNS lookup failed: {str(e)}"
+    try:
+        sock = socket.create_connection(address[:2], timeout=timeout)
+        sock.close()
+    except Exception as e:
+        return f"TCP/{port} unreachable: {str(e)}"
+    if not os_type and not get_os(device, cfg):
+        return "OS type not found"
+    return None
+
+
+def _canary_login(devices, cfg, os_types, connect):
+    """Log in to one healthy device to make sure the credentials work.
+    Exits if the device rejects the credentials."""
+    for device in devices[:3]:
+        try:
+            device_type = os_types.get(device) or get_os(device, cfg)
+            net_connect, _device_type = connect(device, device_type)
+            net_connect.disconnect()
+            return
+        except NetmikoAuthenticationException as e:
+            print(f"ERROR: Canary login to {device} failed, check the credentials: {str(e)}")
+            sys.exit(1)
+        except Exception as e:
+            # Not a credential problem, try another device
+            print(f"Canary login to {device} failed: {str(e)}")
+
+
+def run_preflight(devices, cfg, canary=True, os_types=None, connect=None):
+    """
+    Checks all of the devices concurrently and prints a report of the skipped ones.
+        :param devices: (list) Device names or IPs
+        :param cfg: the baseline_run config yaml object
+        :param canary: (bool) Do a canary login to check the credentials
+        :param os_types: (dict) OS types given with the device list, {device: os_type}
+        :param connect: (function) Logs in like a worker (login limiter, netmiko device type),
+            connect(device, device_type) returns (connection, device_type)
+        :return: (list) The devices that passed, in their original order
+    """
+    os_types = os_types or {}
+    with ThreadPoolExecutor(max_workers=cfg.get("preflight_threads", 64)) as pool:
+        results = list(pool.map(lambda device: _check_device(device, cfg, os_types.get(device)), devices))
+    healthy = [device for device, reason in zip(devices, results) if reason is None]
+    skipped = [(device, reason) for device, reason in zip(devices, results) if reason is not None]
+    print(f"Pre-flight: {len(healthy)}/{len(devices)} devices ready")
+    for device, reason in skipped:
+        print(f"  SKIPPED {device} - {reason}")
+    if canary and connect and healthy:
+        _canary_login(healthy, cfg, os_types, connect)
+    return healthy
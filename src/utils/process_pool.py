@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to spread collection over several worker processes
+
+SSH crypto and netmiko's prompt matching all run under one GIL, so a
+single baseline_run process tops out at one CPU core no matter how many
+worker threads it has.  With cfg["processes"] > 1 the parent process
+starts that many worker processes, each with its own thread pool (or
+asyncio loop), and hands them devices from one shared queue so a busy
+process never holds up the others.  The workers send their results back
+to the parent, which keeps the collection history and the run telemetry.
+johntishey@gmail.com - 2024
+"""
+
+import math
+import time
+import queue
+import threading
+import multiprocessing
+
+from utils import async_collector
+from utils.baseline_utils import save_os_cache
+from utils.collection_history import CollectionHistory
+from utils.telemetry import device_stats
+from utils.telemetry import end_device_stats
+from utils.concurrency import adaptive_concurrency
+
+
+class _ChildHistory(CollectionHistory):
+    """Collection history in a worker process, records are sent to the parent"""
+
+    def __init__(self, cfg, results):
+        super().__init__(cfg)
+        self.results = results
+
+    def record(self, device, total, command_times):
+        self.results.put(("history", device, total, dict(command_times)))
+
+    def save(self):
+        """The parent saves the history"""
+
+
+class _ChildTelemetry(object):
+    """Telemetry in a worker process, device stats are sent to the parent"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def start_device(self, device, queued_at=None):
+        self.results.put(("start",))
+        return device_stats(device, queued_at or time.time())
+
+    def finish_device(self, stats, status=None):
+        end_device_stats(stats, status)
+        self.results.put(("device", stats))
+
+    def add_adjustment(self, record):
+        self.results.put(("adjustment", record))
+
+
+def _child(cfg, key_word, mop_id, engine, processes, work_queue, results, worker):
+    """
+    Worker process: collects devices from the shared queue until it gets None.
+        :param worker: (function) baseline_run's thread worker function
+    """
+    # Each process paces its share of the logins
+    if cfg.get("login_rate"):
+        cfg = dict(
+            cfg,
+            login_rate=cfg["login_rate"] / processes,
+            login_burst=math.ceil((cfg.get("login_burst") or 1) / processes),
+        )
+    history = _ChildHistory(cfg, results)
+    telemetry = _ChildTelemetry(results)
+    devices = iter(work_queue.get, None)
+    try:
+        _collect(cfg, key_word, mop_id, engine, devices, history, telemetry, worker)
+    finally:
+        # Child processes exit without running atexit, so the OS types they resolved are saved here
+        save_os_cache()
+
+
+def _collect(cfg, key_word, mop_id, engine, devices, history, telemetry, worker):
+    """Collect the devices of a worker process with the async engine or threads"""
+    if engine == "async":
+        async_collector.collect(
+            ((device, os_type) for device, os_type, _queued_at in devices), cfg, key_word, mop_id, history, telemetry
+        )
+        return
+    # Hand devices to this process's threads as they free up
+    local_queue = queue.Queue(maxsize=cfg["max_threads"])
+    concurrency = adaptive_concurrency(cfg, cfg["max_threads"], telemetry)
+    for _i in range(cfg["max_threads"]):
+        t = threading.Thread(target=worker, args=(local_queue, cfg, key_word, mop_id, history, telemetry, concurrency))
+        t.daemon = True
+        t.start()
+    for item in devices:
+        local_queue.put(item)
+    local_queue.join()
+
+
+def _read_results(results, children, history, telemetry):
+    """Parent side: apply the worker processes' results until they have all exited"""
+    while True:
+        try:
+            message = results.get(timeout=1)
+        except queue.Empty:
+            if not any(child.is_alive() for child in children):
+                return
+            continue
+        if message[0] == "start":
+            telemetry.device_started()
+        elif message[0] == "device":
+            telemetry.add_device(message[1])
+        elif message[0] == "adjustment":
+            telemetry.add_adjustment(message[1])
+        elif message[0] == "history":
+            history.record(*message[1:])
+
+
+def _put(work_queue, item, children):
+    """
+    Put an item on the work queue, waiting while it is full
+    Returns False if every worker process exits first, a full queue would block forever then
+    """
+    while True:
+        if not any(child.is_alive() for child in children):
+            # Nothing will read what is still buffered, don't wait for it at exit
+            work_queue.cancel_join_thread()
+            return False
+        try:
+            work_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+
+
+def collect(devices, cfg, key_word, mop_id, engine, processes, history, telemetry, worker):
+    """
+    Collect the devices with a pool of worker processes
+        :param devices: (iterable) (device, os_type) pairs in collection order
+        :param cfg: the baseline_run config yaml object (with cfg["commands"])
+        :param key_word: (str) Before/after or pre/post key_word
+        :param mop_id: (str) Ticket number tracking the changes being made
+        :param engine: (str) threads or async, used in each worker process
+        :param processes: (int) Number of worker processes
+        :param history: (CollectionHistory) Records how long each device takes
+        :param telemetry: (RunTelemetry) Records the run stats
+        :param worker: (function) baseline_run's thread worker function
+    """
+    work_queue = multiprocessing.Queue(maxsize=cfg.get("max_queue") or 100)
+    results = multiprocessing.Queue()
+    # Start the processes before the parent starts any threads of its own
+    children = [
+        multiprocessing.Process(
+            target=_child, args=(cfg, key_word, mop_id, engine, processes, work_queue, results, worker), daemon=True
+        )
+        for _i in range(processes)
+    ]
+    for child in children:
+        child.start()
+    reader = threading.Thread(target=_read_results, args=(results, children, history, telemetry))
+    reader.start()
+    for device, os_type in devices:
+        if not _put(work_queue, (device, os_type, time.time()), children):
+            print("ERROR: All worker processes have exited")
+            break
+    # One sentinel for each worker that is still running, a dead worker never takes its own
+    for _child_process in [child for child in children if child.is_alive()]:
+        if not _put(work_queue, None, children):
+            break
+    for child in children:
+        child.join()
+        if child.exitcode:
+            print(f"ERROR: Worker process {child.pid} exited with code {child.exitcode}")
+    reader.join()
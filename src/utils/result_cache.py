@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+baseline_check module to keep the results of each device and reuse them
+
+The result of checking a device is its log records and its JSON output.
+They are saved in the MOP folder:
+
+    mop_path/.result_cache/<device>.<variant>.json
+    {"key": ..., "level": 20, "records": [[level, color, text], ...], "json": ...}
+
+with a SHA-256 key of everything the check reads: the device's before and
+after logs and flattened configs, the testfiles of its OS type, the
+textfsm templates, the config file and the baseline_check code.  When the
+key still matches, the device isn't checked again, its records are
+replayed through the logger so every output mode (-v, -q, -s, -r, -l)
+prints the same as a new check.  Records are kept without the ANSI color
+(the color is "pass", "fail" or ""), so -n uses the same results, and
+only from the lowest level the run writes: a run that writes lower
+levels (-v after a default run) checks the device again.  -c and -j run
+different checks, so they are kept as their own variants.  File digests
+are reused while a file's modification time and size haven't changed.
+cfg["result_cache"] false turns the cache off (and the_recyclanator
+reuses BaselineCheck.log like before), -o checks every device again.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import json
+import glob
+import hashlib
+import logging
+import colorama
+
+CACHE_VERSION = 2
+CACHE_FOLDER = ".result_cache"
+DIGESTS_FILE = "digests.json"
+# Colors the devices are checked with, so the color of each record can be found and left out
+COLORS = {"pass": colorama.Fore.GREEN, "fail": colorama.Fore.LIGHTRED_EX}
+
+
+def enabled(cfg):
+    """True unless cfg["result_cache"] turns the cache off"""
+    return cfg.get("result_cache", True) is not False
+
+
+def variant(config):
+    """Returns the name of the results a check mode produces"""
+    return {61: "config", 63: "json"}.get(config.verbose, "log")
+
+
+def template_files(cfg):
+    """Returns the textfsm templates the custom commands parse output with"""
+    if not cfg.get("tfsm_templates_path"):
+        return []
+    return sorted(glob.glob(f"{cfg['tfsm_templates_path']}/*"))
+
+
+class ResultCache(object):
+    """The saved results of the devices of a MOP"""
+
+    def __init__(self, config, sources, level):
+        """
+        :param config: baseline_check Config object (after setup_logging)
+        :param sources: (list) Paths of the code that checks the devices
+        :param level: (int) Lowest log level the run writes
+        """
+        self.config = config
+        self.folder = f"{config.mop_path}/{CACHE_FOLDER}"
+        self.variant = variant(config)
+        self.level = level
+        # The colors of this run, put back on the records when they are replayed
+        self.colors = {"pass": config.PASS_COLOR, "fail": config.FAIL_COLOR}
+        self.digests_changed = False
+        try:
+            with open(f"{self.folder}/{DIGESTS_FILE}", encoding="utf-8") as f:
+                self.digests = json.load(f)
+        except Exception:
+            self.digests = {}
+        code = hashlib.sha256()
+        for path in sorted(sources) + sorted(glob.glob(f"{os.path.dirname(__file__)}/*.py")):
+            code.update(self.digest(path).encode())
+        templates = hashlib.sha256()
+        for path in template_files(config.cfg):
+            templates.update(f"\n{path}\n{self.digest(path)}".encode())
+        common = {
+            "version": CACHE_VERSION,
+            "variant": self.variant,
+            "cfg": config.cfg,
+            "templates": templates.hexdigest(),
+            "mop_path": config.mop_path,
+            "keywords": [config.before_kw, config.after_kw],
+            "code": code.hexdigest(),
+        }
+        self.common = json.dumps(common, sort_keys=True, default=str)
+
+    def digest(self, path):
+        """Returns the SHA-256 of a file ("" if it can't be read)"""
+        try:
+            stat = os.stat(path)
+            cached = self.digests.get(path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                return cached[2]
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+        except OSError:
+            return ""
+        self.digests[path] = [stat.st_mtime_ns, stat.st_size, sha256.hexdigest()]
+        self.digests_changed = True
+        return self.digests[path][2]
+
+    def key(self, hostname, files):
+        """
+        Returns the key of a device's results
+            :param hostname: (str) Device name
+            :param files: (list) Paths of every file the check of the device reads
+        """
+        key = hashlib.sha256(self.common.encode())
+        key.update(hostname.encode())
+        for path in sorted(set(files)):
+            key.update(f"\n{path}\n{self.digest(path)}".encode())
+        return key.hexdigest()
+
+    def _entry(self, hostname):
+        """Returns the cache file of a device"""
+        return f"{self.folder}/{hostname}.{self.variant}.json"
+
+    def load(self, hostname, key):
+        """
+        Returns the saved (records, JSON output) of a device in this run's colors,
+        or None if its inputs changed or it was saved without the levels this run writes
+        """
+        try:
+            with open(self._entry(hostname), encoding="utf-8") as f:
+                entry = json.load(f)
+        except Exception:
+            return None
+        if entry.get("key") != key or entry.get("level", logging.CRITICAL) > self.level:
+            return None
+        return self.colored(entry["records"]), entry["json"]
+
+    def colored(self, records):
+        """Returns [level, color, text] records as (level, message) in this run's colors"""
+        return [(level, self.colors.get(color, "") + text) for level, color, text in records if level >= self.level]
+
+    def save(self, hostname, key, records, device_json):
+        """
+        Save the results of a device (temp file renamed into place)
+            :param records: (list) (level, message) log records, checked in COLORS
+            :return: (list) The records in this run's colors
+        """
+        saved = []
+        for level, message in records:
+            color = ""
+            for name, code in COLORS.items():
+                if message.startswith(code):
+                    color, message = name, message[len(code) :]
+                    break
+            saved.append([level, color, message])
+        path = self._entry(hostname)
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"key": key, "level": self.level, "records": saved, "json": device_json}, f)
+            os.replace(tmp_file, path)
+        except Exception:
+            # The cache only saves time, the device is checked again next time
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return self.colored(saved)
+
+    def close(self):
+        """Save the file digests"""
+        if not self.digests_changed:
+            return
+        path = f"{self.folder}/{DIGESTS_FILE}"
+        tmp_file = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self.digests, f)
+            os.replace(tmp_file, path)
+        except Exception:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+"""
+baseline module to capture IPv4 route tables in a compact file
+
+baseline_run streams the route table of each device through a parser that
+keeps only the prefix, prefix length and next hop of each route, and saves
+them next to the log as a columnar binary file:
+
+    <mop>_<device>_<keyword>_log.routes.bin
+
+    b"BLRT", version (1 byte), route count (4 bytes),
+    prefixes (4 bytes each), prefix lengths (1 byte each), next hops (4 bytes each)
+
+A full table is 9 bytes a route instead of a line of CLI text, and
+baseline_check loads it with no text parsing.  Routes without a next-hop
+address (directly connected, local) have next hop 0.0.0.0.  Only the IPv4
+unicast table is captured.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import re
+import socket
+import struct
+
+from utils.log_io import open_log_binary
+from utils.log_writer import stream_command
+
+ROUTES_SUFFIX = ".routes.bin"
+ROUTES_MAGIC = b"BLRT"
+ROUTES_VERSION = 1
+# Commands to show the IPv4 route table for each OS type
+ROUTE_COMMANDS = {
+    "juniper_junos": "show route table inet.0 terse",
+    "cisco_ios": "show ip route",
+    "cisco_xr": "show route ipv4",
+    "nokia_sros": "show router route-table",
+    "nokia_mdcli": "show router route-table",
+}
+NO_NEXT_HOP = socket.inet_aton("0.0.0.0")
+# An IPv4 address or prefix on its own (not part of a longer token like 10.0.0.1.1 or an interface name)
+ADDRESS_RE = re.compile(r"(?<![\w.:/-])(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(?:/(\d{1,2}))?(?![\w.:/-])")
+
+
+def routes_file(log_file):
+    """Returns the route table file for a log (log_file without a compression suffix)"""
+    return log_file + ROUTES_SUFFIX
+
+
+def route_command(cfg, device_type):
+    """Returns the route table command for an OS type, with the cfg["route_commands"] overrides"""
+    return cfg.get("route_commands", {}).get(device_type) or ROUTE_COMMANDS.get(device_type)
+
+
+def capture_failed(device, path, e):
+    """Report a failed route capture and remove the route table of an earlier run"""
+    print(f"{device}: route capture failed: {str(e) or type(e).__name__}")
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def capture_routes(net_connect, device, device_type, cfg, log_file, deadline=None):
+    """
+    Stream the route table of a device into its route table file.
+        :param net_connect: Logged in netmiko connection
+        :param device: (str) Device name, for messages
+        :param device_type: (str) netmiko device type of the device
+        :param cfg: the baseline_run config yaml object
+        :param log_file: (str) Log file of the device, without a compression suffix
+        :param deadline: (float) Epoch time the capture must be finished by
+        :return: (int) Number of routes saved, None if the capture failed
+    """
+    # baseline_utils needs easysnmp, which reading route tables doesn't, so import it here
+    from utils.baseline_utils import command_timeout
+
+    command = route_command(cfg, device_type)
+    if not command:
+        return None
+    writer = RouteTableWriter(routes_file(log_file))
+    try:
+        stream_command(net_connect, command, writer.write, read_timeout=command_timeout(cfg, command), deadline=deadline)
+        return writer.close()
+    except Exception as e:
+        capture_failed(device, writer.path, e)
+        return None
+
+
+class RouteTableWriter(object):
+    """
+    Parses route table output as it is streamed from the device (write() takes
+    chunks of text, like LogWriter.write) and saves the routes on close().
+
+    A route starts at an IPv4 prefix, and its next hop is the first address after
+    the prefix, on the same line (IOS/IOS-XR "via", Junos terse ">") or on the
+    following lines (SR OS).  IOS classful "is subnetted" headers give the prefix
+    length of the routes listed under them without one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.prefixes = bytearray()
+        self.lengths = bytearray()
+        self.next_hops = bytearray()
+        self.tail = ""
+        self.current = None
+        self.next_hop = None
+        self.default_length = None
+
+    def write(self, text):
+        """Parse a chunk of route table output"""
+        lines = (self.tail + text).split("\n")
+        self.tail = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def _add(self):
+        """Save the current route"""
+        if self.current:
+            self.prefixes += self.current[0]
+            self.lengths.append(self.current[1])
+            self.next_hops += self.next_hop or NO_NEXT_HOP
+        self.current, self.next_hop = None, None
+
+    def _line(self, line):
+        """Parse one line of output"""
+        if "subnetted" in line:
+            # IOS: "172.16.0.0/24 is subnetted, 2 subnets" sets the length of the routes below it
+            match = ADDRESS_RE.search(line)
+            self.default_length = int(match.group(2)) if match and match.group(2) and "variably" not in line else None
+            return
+        for match in ADDRESS_RE.finditer(line):
+            address, length = match.groups()
+            if length is None:
+                before = line[: match.start()]
+                # IOS classful route under an "is subnetted" header: "O E2  172.16.1.0 [110/2] via ..."
+                if self.default_length is None or "via" in before or len(before.split()) not in [1, 2]:
+                    if self.current and self.next_hop is None:
+                        self.next_hop = _aton(address)
+                    continue
+                length = self.default_length
+            packed = _aton(address)
+            if packed and int(length) <= 32:
+                self._add()
+                self.current = (packed, int(length))
+
+    def close(self):
+        """Save the routes to the route table file (through a temp file)"""
+        if self.tail:
+            self._line(self.tail)
+            self.tail = ""
+        self._add()
+        tmp_file = f"{os.path.dirname(self.path)}/.{os.path.basename(self.path)}.partial"
+        with open(tmp_file, "wb") as f:
+            f.write(ROUTES_MAGIC + struct.pack("!BI", ROUTES_VERSION, len(self.lengths)))
+            f.write(self.prefixes)
+            f.write(self.lengths)
+            f.write(self.next_hops)
+        os.replace(tmp_file, self.path)
+        return len(self.lengths)
+
+
+def _aton(address):
+    """Returns the 4 byte form of an IPv4 address, or None if it isn't valid"""
+    try:
+        return socket.inet_aton(address)
+    except OSError:
+        return None
+
+
+def load_routes(path):
+    """
+    Load a route table file (plain or compacted)
+        :return: (dict) {"prefix/length": next_hop}
+    """
+    with open_log_binary(path) as f:
+        data = f.read()
+    if data[:4] != ROUTES_MAGIC:
+        raise ValueError(f"{path} is not a route table file")
+    version, count = struct.unpack_from("!BI", data, 4)
+    if version != ROUTES_VERSION:
+        raise ValueError(f"{path} has unsupported route table version {version}")
+    start = 4 + struct.calcsize("!BI")
+    prefixes = data[start : start + 4 * count]
+    lengths = data[start + 4 * count : start + 5 * count]
+    next_hops = data[start + 5 * count : start + 9 * count]
+    ntoa = socket.inet_ntoa
+    # Most routes share a few next hops, so each one is converted once
+    hops = {}
+    routes = {}
+    for i, length in zip(range(0, 4 * count, 4), lengths):
+        hop = next_hops[i : i + 4]
+        if hop not in hops:
+            hops[hop] = ntoa(hop)
+        routes[f"{ntoa(prefixes[i : i + 4])}/{length}"] = hops[hop]
+    return routes
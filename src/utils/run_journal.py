@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to checkpoint a run so an interrupted run can be resumed
+
+Each MOP/keyword run keeps a journal in the MOP folder:
+
+    mop_path/.<mop>_<keyword>_journal.jsonl
+
+A device is added as pending when it is queued and updated to complete or
+failed when it is finished.  Records are only ever appended (and synced to
+disk), so the journal survives a Ctrl-C, a dropped VPN or a reboot of the
+jump host.  The last record of a device wins.  baseline_run --resume only
+collects the devices that don't have a complete log yet.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import json
+import time
+import threading
+
+
+def journal_path(cfg, mop_id, key_word):
+    """Returns the path of the run journal for a MOP/keyword"""
+    folder = cfg.get("journal_path") or cfg["mop_path"]
+    return f"{folder}/.{mop_id}_{key_word}_journal.jsonl"
+
+
+class RunJournal(object):
+    """Pending/complete/failed state of every device in a run"""
+
+    def __init__(self, cfg, mop_id, key_word, resume=False):
+        """
+        :param resume: (bool) Keep the devices from the last run, otherwise a new journal is started
+        """
+        self.path = journal_path(cfg, mop_id, key_word)
+        self.lock = threading.Lock()
+        # Only the devices from the earlier run are kept in memory
+        self.devices = {}
+        if resume:
+            self.devices = self._load()
+        try:
+            self.f = open(self.path, "a" if resume else "w", encoding="utf-8")
+        except Exception as e:
+            print(f"ERROR opening run journal: {str(e)}")
+            self.f = None
+
+    def _load(self):
+        """Returns {device: last record} from the journal file"""
+        devices = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line cut off when the run was interrupted
+                        continue
+                    devices[record["device"]] = record
+        except FileNotFoundError:
+            print(f"No run journal found at {self.path}, collecting all devices")
+        return devices
+
+    def complete(self, device):
+        """True if the device has a complete log from an earlier run"""
+        record = self.devices.get(device)
+        return bool(record and record["status"] == "complete" and record.get("log") and os.path.exists(record["log"]))
+
+    def _append(self, records):
+        """Append records and sync them to disk"""
+        now = int(time.time())
+        with self.lock:
+            for record in records:
+                record["time"] = now
+            if not self.f:
+                return
+            self.f.write("".join(json.dumps(record, sort_keys=True) + "\n" for record in records))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def pending(self, devices):
+        """Add queued devices as pending"""
+        if devices:
+            self._append([{"device": device, "status": "pending"} for device in devices])
+
+    def finish(self, stats):
+        """Update a finished device from its telemetry stats"""
+        if stats["status"] == "complete":
+            self._append([{"device": stats["device"], "status": "complete", "log": stats["log"]}])
+        else:
+            self._append([{"device": stats["device"], "status": "failed", "result": stats["status"]}])
+
+    def close(self):
+        """Close the journal file"""
+        if self.f:
+            self.f.close()
+            self.f = None
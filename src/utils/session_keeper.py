@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to keep authenticated device sessions warm between runs
+
+The keeper is a local daemon (started with baseline_keeper.py) that logs in
+to a MOP's devices once and holds the netmiko sessions open, so the "after"
+run doesn't have to pay for hundreds of logins again.  baseline_run attaches
+to it over a Unix socket, one socket connection per device:
+
+    client -> {"op": "attach", "device": "router1"}
+    keeper -> {"device_type": "juniper_junos", "base_prompt": "user@router1"}
+    client -> {"op": "command", "command": "show bgp summary"}
+    keeper -> {"data": "..."} ... {"end": true}
+
+Sessions that are idle longer than keeper_idle_timeout are closed, and the
+rest are health checked every keeper_health_interval seconds.
+
+The sockets are kept in a folder only the user can open (0700), and both
+sides check that the other end of the socket is run by the same user, so
+another user can't pose as the keeper or use its sessions.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import json
+import stat
+import time
+import socket
+import struct
+import tempfile
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+from netmiko import ConnectHandler
+
+from utils.baseline_utils import get_os
+from utils.baseline_utils import netmiko_device_object
+from utils.log_writer import stream_command
+from utils.login_limiter import wait_for_login
+
+
+def _socket_dir(cfg):
+    """Returns the folder of the keeper sockets, per user unless keeper_socket_dir is set"""
+    if cfg.get("keeper_socket_dir"):
+        return cfg["keeper_socket_dir"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return f"{os.environ['XDG_RUNTIME_DIR']}/baseline_keeper"
+    return f"{tempfile.gettempdir()}/baseline_keeper_{os.getuid()}"
+
+
+def socket_path(cfg, mop_id):
+    """Returns the Unix socket path of the keeper for a MOP"""
+    return f"{_socket_dir(cfg)}/baseline_keeper_{mop_id}.sock"
+
+
+def _check_private(path, is_type):
+    """Raise PermissionError unless path is of the right type, owned by this user and closed to others"""
+    st = os.lstat(path)
+    if not is_type(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(f"{path} is not private to this user")
+
+
+def keeper_dir(cfg):
+    """Returns the folder of the keeper sockets, created 0700 if needed (PermissionError if it isn't private)"""
+    path = _socket_dir(cfg)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    _check_private(path, stat.S_ISDIR)
+    return path
+
+
+def trusted_socket(cfg, mop_id):
+    """
+    Returns the socket path if this user's keeper is listening for the MOP, otherwise None.
+    A socket that isn't in a private folder or isn't owned by this user is never used.
+    """
+    path = socket_path(cfg, mop_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        _check_private(os.path.dirname(path), stat.S_ISDIR)
+        _check_private(path, stat.S_ISSOCK)
+    except OSError as e:
+        print(f"Session keeper not used - {str(e)}")
+        return None
+    return path
+
+
+def _peer_uid(sock):
+    """Returns the user ID of the process at the other end of a Unix socket (None if unknown)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    return struct.unpack("3i", creds)[1]
+
+
+def _send(sock_file, message):
+    """Write one JSON message line to a socket file"""
+    sock_file.write(json.dumps(message) + "\n")
+    sock_file.flush()
+
+
+def _receive(sock_file):
+    """Read one JSON message line from a socket file"""
+    line = sock_file.readline()
+    if not line:
+        raise EOFError("Session keeper closed the connection")
+    return json.loads(line)
+
+
+class KeeperSession(object):
+    """Client side of a keeper session, used by baseline_run in place of a netmiko connection"""
+
+    def __init__(self, path, device):
+        self.device = device
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        if _peer_uid(self.sock) not in [None, os.getuid()]:
+            self.sock.close()
+            raise ConnectionError("session keeper is run by another user")
+        self.sock_file = self.sock.makefile("rw", encoding="utf8")
+        _send(self.sock_file, {"op": "attach", "device": device})
+        reply = _receive(self.sock_file)
+        if reply.get("error"):
+            self.disconnect()
+            raise ConnectionError(reply["error"])
+        self.device_type = reply["device_type"]
+        self.base_prompt = reply["base_prompt"]
+
+    def find_prompt(self):
+        """The keeper already knows the prompt"""
+        return self.base_prompt
+
+    def stream_command(self, command, write, read_timeout=120, deadline=None):
+        """Run a command on the kept session and pass the output to write()"""
+        _send(
+            self.sock_file,
+            {"op": "command", "command": command, "read_timeout": read_timeout, "deadline": deadline},
+        )
+        while True:
+            reply = _receive(self.sock_file)
+            if reply.get("error"):
+                raise ConnectionError(reply["error"])
+            if reply.get("end"):
+                return
+            write(reply["data"])
+
+    def send_command(self, command):
+        """Run a command on the kept session and return the output"""
+        output = []
+        self.stream_command(command, output.append)
+        return "".join(output)
+
+    def disconnect(self):
+        """Release the session back to the keeper (the device session stays up)"""
+        try:
+            self.sock_file.close()
+            self.sock.close()
+        except Exception:
+            pass
+
+
+def attach(cfg, mop_id, device):
+    """
+    Returns a KeeperSession for the device if a keeper is running for the MOP,
+    or None so that baseline_run logs in to the device directly.
+    """
+    path = trusted_socket(cfg, mop_id)
+    if not path:
+        return None
+    try:
+        return KeeperSession(path, device)
+    except Exception as e:
+        print(f"{device}: session keeper not used - {str(e)}")
+        return None
+
+
+class _KeptDevice(object):
+    """A warm netmiko session held by the keeper"""
+
+    def __init__(self, device, cfg):
+        self.device = device
+        self.cfg = cfg
+        self.lock = threading.Lock()
+        self.net_connect = None
+        self.device_type = ""
+        self.last_used = time.time()
+
+    def login(self):
+        """Log in to the device and prep the session the same way baseline_run does"""
+        self.device_type = get_os(self.device, self.cfg)
+        wait_for_login(self.cfg)
+        self.net_connect = ConnectHandler(
+            **netmiko_device_object(self.device, self.device_type, self.cfg.get("ssh_port", 22))
+        )
+        # Nokia in Model Driven mode puts user@hostname as prompt
+        if self.device_type == "nokia_sros" and "@" in self.net_connect.base_prompt:
+            self.device_type = "nokia_mdcli"
+        # Turn off timestamps for XR show run
+        if self.device_type == "cisco_xr":
+            self.net_connect.send_command("terminal exec prompt no-timestamp")
+        self.net_connect.find_prompt()
+        self.last_used = time.time()
+
+    def is_alive(self):
+        """Health check the session"""
+        try:
+            return bool(self.net_connect and self.net_connect.is_alive())
+        except Exception:
+            return False
+
+    def close(self):
+        """Log out of the device"""
+        try:
+            if self.net_connect:
+                self.net_connect.disconnect()
+        except Exception:
+            pass
+        self.net_connect = None
+
+
+class SessionKeeper(object):
+    """Holds warm sessions for a MOP's devices and serves them over a Unix socket"""
+
+    def __init__(self, cfg, mop_id, devices):
+        self.cfg = cfg
+        self.mop_id = mop_id
+        self.path = socket_path(cfg, mop_id)
+        self.idle_timeout = cfg.get("keeper_idle_timeout", 1800)
+        self.health_interval = cfg.get("keeper_health_interval", 60)
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.server = None
+        for device in devices:
+            self.sessions[device] = _KeptDevice(device, cfg)
+
+    def login_all(self):
+        """Log in to all of the devices, max_threads at a time"""
+
+        def _login(kept):
+            try:
+                kept.login()
+            except Exception as e:
+                print(f"{kept.device}: {str(e)}")
+
+        with ThreadPoolExecutor(max_workers=self.cfg.get("max_threads", 10)) as pool:
+            list(pool.map(_login, self.sessions.values()))
+        up = len([kept for kept in self.sessions.values() if kept.net_connect])
+        print(f"Session keeper: {up}/{len(self.sessions)} sessions up")
+
+    def get_session(self, device):
+        """Returns the locked, healthy session for a device, logging in again if needed"""
+        with self.sessions_lock:
+            if device not in self.sessions:
+                self.sessions[device] = _KeptDevice(device, self.cfg)
+            kept = self.sessions[device]
+        kept.lock.acquire()
+        try:
+            if not kept.is_alive():
+                kept.close()
+                kept.login()
+        except Exception:
+            kept.lock.release()
+            raise
+        kept.last_used = time.time()
+        return kept
+
+    def housekeeping(self):
+        """Close idle sessions and health check the rest, shut down when none are left"""
+        while True:
+            time.sleep(self.health_interval)
+            with self.sessions_lock:
+                sessions = list(self.sessions.items())
+            for device, kept in sessions:
+                # Skip sessions that are in use right now
+                if not kept.lock.acquire(blocking=False):
+                    continue
+                try:
+                    if time.time() - kept.last_used > self.idle_timeout:
+                        kept.close()
+                        with self.sessions_lock:
+                            del self.sessions[device]
+                    elif not kept.is_alive():
+                        kept.close()
+                        kept.login()
+                except Exception as e:
+                    print(f"{device}: {str(e)}")
+                finally:
+                    kept.lock.release()
+            with self.sessions_lock:
+                if not self.sessions:
+                    print("Session keeper: all sessions idle, shutting down")
+                    self.server.shutdown()
+                    return
+
+    def serve(self):
+        """Listen on the Unix socket until shut down"""
+        keeper = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Handles one baseline_run device attachment"""
+
+            def handle(self):
+                # Only this user's baseline_run may use the sessions
+                if _peer_uid(self.connection) not in [None, os.getuid()]:
+                    return
+                sock_file = self.connection.makefile("rw", encoding="utf8")
+                kept = None
+                try:
+                    request = _receive(sock_file)
+                    try:
+                        kept = keeper.get_session(request["device"])
+                    except Exception as e:
+                        _send(sock_file, {"error": str(e)})
+                        return
+                    _send(
+                        sock_file,
+                        {"device_type": kept.device_type, "base_prompt": kept.net_connect.base_prompt},
+                    )
+                    while True:
+                        request = _receive(sock_file)
+                        try:
+                            stream_command(
+                                kept.net_connect,
+                                request["command"],
+                                lambda data: _send(sock_file, {"data": data}),
+                                read_timeout=request.get("read_timeout", 120),
+                                deadline=request.get("deadline"),
+                            )
+                            _send(sock_file, {"end": True})
+                        except Exception as e:
+                            # Don't hand a half-read session to the next client
+                            kept.close()
+                            _send(sock_file, {"error": str(e)})
+                            return
+                except (EOFError, BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    if kept:
+                        kept.last_used = time.time()
+                        kept.lock.release()
+
+        keeper_dir(self.cfg)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        # The socket is created 0600, not opened up until a chmod
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.housekeeping, daemon=True).start()
+        print(f"Session keeper listening on {self.path}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            for kept in self.sessions.values():
+                kept.close()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+baseline_run module to record where the time goes in a run
+
+For every device it records the queue wait, login time, retries and the
+seconds and output bytes of each command.  Each device's stats are
+appended to a JSON lines file as soon as the device is finished, and only
+the run totals are kept in memory, so a fleet-wide run doesn't grow.  At
+the end of the run a JSON summary and an OpenMetrics textfile (for the
+node_exporter textfile collector) are written to the MOP folder:
+
+    .<mop>_<keyword>_telemetry_devices.jsonl
+    .<mop>_<keyword>_telemetry.json
+    .<mop>_<keyword>_metrics.prom
+
+When stderr is a terminal, a progress line with an ETA is shown while
+the run is going.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import threading
+
+from utils.baseline_utils import log_file_path
+from utils.collection_history import format_time
+
+# Seconds between progress line updates
+PROGRESS_INTERVAL = 1
+# Device time quantiles in the summary and metrics
+QUANTILES = [0.5, 0.9, 0.99]
+# Adaptive concurrency adjustments printed at the end of the run
+ADJUSTMENTS_SHOWN = 10
+
+
+def _escape(value):
+    """Escape an OpenMetrics label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def quantile(values, q):
+    """Returns the nearest-rank quantile (0-1) of a sorted list of numbers"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def device_stats(device, queued_at):
+    """Returns a new stats dict for a device that is starting, filled in by the collector"""
+    now = time.time()
+    return {
+        "device": device,
+        "status": "failed",
+        "queue_wait": round(now - queued_at, 3),
+        "connect": None,
+        "login_failed": False,
+        "retries": 0,
+        "seconds": None,
+        "bytes": 0,
+        "commands": {},
+        "not_collected": [],
+        "error": None,
+        "log": None,
+        "_start": now,
+    }
+
+
+def end_device_stats(stats, status):
+    """Set the result, run time and total bytes of a finished device"""
+    stats["status"] = status or "failed"
+    stats["seconds"] = round(time.time() - stats.pop("_start"), 3)
+    stats["bytes"] = sum(command["bytes"] for command in stats["commands"].values())
+
+
+def record_log(stats, writer, command_times):
+    """
+    Fill in the log file and per-command stats of a device from its log
+        :param stats: (dict) Device stats from RunTelemetry.start_device
+        :param writer: (LogWriter) The closed log, with its [command, offset, length] index
+        :param command_times: (dict) Seconds per command
+    """
+    stats["log"] = writer.log_file
+    for command, offset, length in writer.index:
+        if offset is None:
+            stats["not_collected"].append(command)
+            continue
+        stats["commands"][command] = {"seconds": round(command_times.get(command, 0.0), 3), "bytes": length}
+
+
+class RunTelemetry(object):
+    """Collects the per-device stats of a baseline_run and writes the telemetry files"""
+
+    def __init__(self, cfg, mop_id, key_word, total, workers, engine="threads", journal=None):
+        """
+        :param total: (int) Number of devices, or None when the devices are streamed in
+                      (see add_devices)
+        :param journal: (RunJournal) Run journal to mark finished devices in
+        """
+        self.cfg = cfg
+        self.mop_id = mop_id
+        self.key_word = key_word
+        self.total = total or 0
+        self.total_known = total is not None
+        self.workers = workers
+        self.engine = engine
+        self.journal = journal
+        self.enabled = cfg.get("telemetry", True)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.done = 0
+        self.statuses = {}
+        self.device_seconds = []
+        self.totals = {"connect": 0.0, "connected": 0, "queue_wait": 0.0, "retries": 0, "bytes": 0}
+        self.commands = {}
+        self.adjustments = []
+        self.devices_file = None
+        self.start = time.time()
+        self.end = None
+        self.stop_progress = threading.Event()
+        self.progress_thread = None
+        self.show_progress = self.enabled and cfg.get("progress", True) and sys.stderr.isatty()
+        self.name = None
+        if self.enabled:
+            folder = cfg.get("telemetry_path")
+            if not folder:
+                try:
+                    folder = os.path.dirname(log_file_path(cfg, mop_id, "", key_word))
+                except FileNotFoundError as e:
+                    print(f"ERROR saving telemetry: {str(e)}")
+            if folder:
+                self.name = f"{folder}/.{mop_id}_{key_word}"
+                try:
+                    self.devices_file = open(f"{self.name}_telemetry_devices.jsonl", "w", encoding="utf-8")
+                except Exception as e:
+                    print(f"ERROR saving telemetry: {str(e)}")
+
+    def add_devices(self, count, last=False):
+        """Add devices to the total as they are queued, last=True when the device input is finished.
+        The progress line starts with the first devices, after the pre-flight report."""
+        with self.lock:
+            self.total += count
+            self.total_known = self.total_known or last
+        if not self.progress_thread:
+            self.start_progress()
+
+    def start_device(self, device, queued_at=None):
+        """Returns the stats dict for a device that is starting, filled in by the collector"""
+        self.device_started()
+        return device_stats(device, queued_at or self.start)
+
+    def device_started(self):
+        """Count a device as active"""
+        with self.lock:
+            self.active += 1
+
+    def finish_device(self, stats, status=None):
+        """Record a finished device"""
+        end_device_stats(stats, status)
+        self.add_device(stats)
+
+    def add_device(self, stats):
+        """Add a finished device's stats to the totals and write them to the devices file"""
+        with self.lock:
+            self.active -= 1
+            self.done += 1
+            self.statuses[stats["status"]] = self.statuses.get(stats["status"], 0) + 1
+            self.device_seconds.append(stats["seconds"])
+            if stats["connect"] is not None:
+                self.totals["connect"] += stats["connect"]
+                self.totals["connected"] += 1
+            self.totals["queue_wait"] += stats["queue_wait"]
+            self.totals["retries"] += stats["retries"]
+            self.totals["bytes"] += stats["bytes"]
+            for command, per_command in stats["commands"].items():
+                total = self.commands.setdefault(command, {"seconds": 0.0, "bytes": 0, "count": 0})
+                total["seconds"] += per_command["seconds"]
+                total["bytes"] += per_command["bytes"]
+                total["count"] += 1
+            if self.devices_file:
+                self.devices_file.write(json.dumps(stats, sort_keys=True) + "\n")
+                self.devices_file.flush()
+        if self.journal:
+            self.journal.finish(stats)
+        self._print_progress()
+
+    def add_adjustment(self, record):
+        """Record an adaptive concurrency adjustment (see utils/concurrency.py)"""
+        with self.lock:
+            self.adjustments.append(record)
+
+    def concurrency(self):
+        """Returns the adaptive concurrency report, or None for a fixed number of workers"""
+        if not self.adjustments:
+            return None
+        limits = {}
+        for record in self.adjustments:
+            limits[record["source"]] = record["limit"]
+        return {"final": sum(limits.values()), "adjustments": list(self.adjustments)}
+
+    def _print_progress(self):
+        """Rewrite the progress line on stderr"""
+        if not self.show_progress:
+            return
+        with self.lock:
+            done, total, active = self.done, self.total, self.active
+            failed = done - self.statuses.get("complete", 0)
+            total_known = self.total_known
+        elapsed = time.time() - self.start
+        eta = "--"
+        if done and total_known:
+            eta = format_time(elapsed / done * max(0, total - done))
+        if total_known:
+            count = f"[{done}/{total}] {100 * done / total if total else 100:5.1f}%"
+        else:
+            count = f"[{done}/{total}+]"
+        sys.stderr.write(
+            f"\r{count}  active {active}  not complete {failed}  "
+            f"elapsed {format_time(elapsed)}  ETA {eta} "
+        )
+        sys.stderr.flush()
+
+    def _progress_loop(self):
+        """Keep the progress line ticking while devices are running"""
+        while not self.stop_progress.wait(PROGRESS_INTERVAL):
+            self._print_progress()
+
+    def start_progress(self):
+        """Start the progress line (only when stderr is a terminal)"""
+        if self.show_progress:
+            self.progress_thread = threading.Thread(target=self._progress_loop, daemon=True)
+            self.progress_thread.start()
+
+    def summary(self):
+        """Returns the run summary as a dict"""
+        end = self.end or time.time()
+        wall = end - self.start
+        device_seconds = sorted(self.device_seconds)
+        return {
+            "mop": self.mop_id,
+            "keyword": self.key_word,
+            "engine": self.engine,
+            "started": int(self.start),
+            "seconds": round(wall, 3),
+            "workers": self.workers,
+            "worker_utilization": (
+                round(sum(device_seconds) / (self.workers * wall), 4) if wall and self.workers else 0
+            ),
+            "devices_total": self.total,
+            "devices": dict(self.statuses),
+            "device_seconds": {str(q): quantile(device_seconds, q) for q in QUANTILES},
+            "connect_seconds_avg": round(self.totals["connect"] / max(1, self.totals["connected"]), 3),
+            "queue_wait_seconds_avg": round(self.totals["queue_wait"] / max(1, self.done), 3),
+            "retries": self.totals["retries"],
+            "bytes": self.totals["bytes"],
+            "commands": {
+                command: {"count": total["count"], "seconds": round(total["seconds"], 3), "bytes": total["bytes"]}
+                for command, total in self.commands.items()
+            },
+            "concurrency": self.concurrency(),
+        }
+
+    def metrics(self, summary):
+        """Returns the summary in OpenMetrics text format"""
+        run = f'mop="{_escape(self.mop_id)}",keyword="{_escape(self.key_word)}"'
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"# HELP {name} {help_text}")
+            suffix = "_total" if metric_type == "counter" else ""
+            for labels, value in samples:
+                lines.append(f"{name}{suffix}{{{run}{labels}}} {value}")
+
+        def _summary(name, help_text, quantiles, total, count):
+            lines.append(f"# TYPE {name} summary")
+            lines.append(f"# HELP {name} {help_text}")
+            for q, value in quantiles:
+                lines.append(f'{name}{{{run},quantile="{q}"}} {value}')
+            lines.append(f"{name}_sum{{{run}}} {round(total, 3)}")
+            lines.append(f"{name}_count{{{run}}} {count}")
+
+        _metric("baseline_run_duration_seconds", "gauge", "Run wall clock time", [("", summary["seconds"])])
+        _metric("baseline_run_workers", "gauge", "Worker threads or async sessions", [("", self.workers)])
+        if summary["concurrency"]:
+            _metric(
+                "baseline_run_concurrency", "gauge", "Devices in flight chosen by adaptive concurrency",
+                [("", summary["concurrency"]["final"])],
+            )
+        _metric(
+            "baseline_run_worker_utilization", "gauge", "Share of worker time spent on devices",
+            [("", summary["worker_utilization"])],
+        )
+        _metric(
+            "baseline_run_devices", "counter", "Devices by result",
+            [(f',status="{_escape(status)}"', count) for status, count in sorted(summary["devices"].items())],
+        )
+        _summary(
+            "baseline_run_device_seconds", "Seconds from dequeue to log saved",
+            sorted(summary["device_seconds"].items()), sum(self.device_seconds), self.done,
+        )
+        _summary(
+            "baseline_run_connect_seconds", "Seconds to log in", [], self.totals["connect"], self.totals["connected"]
+        )
+        _summary(
+            "baseline_run_queue_wait_seconds", "Seconds waiting for a worker", [], self.totals["queue_wait"], self.done
+        )
+        _metric("baseline_run_retries", "counter", "Reconnects after a failure", [("", summary["retries"])])
+        _metric("baseline_run_output_bytes", "counter", "Bytes of output saved", [("", summary["bytes"])])
+        command_samples = sorted(self.commands.items())
+        lines.append("# TYPE baseline_run_command_seconds summary")
+        lines.append("# HELP baseline_run_command_seconds Command latency over all devices")
+        for command, total in command_samples:
+            labels = f'{run},command="{_escape(command)}"'
+            lines.append(f"baseline_run_command_seconds_sum{{{labels}}} {round(total['seconds'], 3)}")
+            lines.append(f"baseline_run_command_seconds_count{{{labels}}} {total['count']}")
+        _metric(
+            "baseline_run_command_output_bytes", "counter", "Bytes of command output over all devices",
+            [(f',command="{_escape(command)}"', total["bytes"]) for command, total in command_samples],
+        )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def save(self):
+        """Stop the progress line and write the JSON summary and the OpenMetrics textfile"""
+        self.end = time.time()
+        if self.progress_thread:
+            self.stop_progress.set()
+            self.progress_thread.join()
+            self._print_progress()
+            sys.stderr.write("\n")
+        if self.devices_file:
+            self.devices_file.close()
+        if not self.enabled or not self.name:
+            return
+        summary = self.summary()
+        try:
+            for path, text in [
+                (f"{self.name}_telemetry.json", json.dumps(summary, indent=1, sort_keys=True)),
+                (self.cfg.get("metrics_textfile") or f"{self.name}_metrics.prom", self.metrics(summary)),
+            ]:
+                tmp_file = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(tmp_file, path)
+        except Exception as e:
+            print(f"ERROR saving telemetry: {str(e)}")
+            return
+        statuses = ", ".join(f"{count} {status}" for status, count in sorted(summary["devices"].items()))
+        print(
+            f"Run finished in {format_time(summary['seconds'])}: {statuses or 'no devices'}, "
+            f"worker utilization {summary['worker_utilization']:.0%}"
+        )
+        if summary["concurrency"]:
+            adjustments = summary["concurrency"]["adjustments"]
+            changes = len([record for record in adjustments if record["reason"] != "start"])
+            print(
+                f"Adaptive concurrency: {summary['concurrency']['final']} devices in flight "
+                f"after {changes} adjustments"
+            )
+            for record in adjustments[-ADJUSTMENTS_SHOWN:]:
+                print(f"  {format_time(record['time'])}  {record['limit']:>4}  {record['reason']}")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+baseline module to load the testfiles once and share them
+
+baseline_run reads the testfiles for the commands to run, and
+baseline_check read every testfile again for every device and compiled
+the info/err templates for every result line.  The catalog loads the
+testfiles of an OS type once per process, checks that each one has what
+the tests need, and compiles its templates once.  The parsed testfiles
+are cached in cfg["testfile_cache"] (mop_path/.testfile_catalog.json by
+default) and reused while a file's modification time and size, or failing
+that its SHA-1, haven't changed, so YAML is only parsed for new or edited
+testfiles.
+johntishey@gmail.com - 2024
+"""
+
+import os
+import json
+import yaml
+import jinja2
+import hashlib
+
+CACHE_VERSION = 1
+# Test types the_differentiator knows how to run
+TEST_TYPES = ["no-diff", "delta", "exists", "not-exists"]
+
+_catalogs = {}
+_cache = None
+
+
+class Testfile(object):
+    """One testfile, parsed and checked, with its templates compiled"""
+
+    def __init__(self, name, path, values=None, error=""):
+        """
+        :param name: (str) Testfile name from the config file
+        :param path: (str) Full path of the testfile
+        :param values: The parsed YAML
+        :param error: (str) Why the testfile couldn't be read, if it couldn't
+        """
+        self.name = name
+        self.path = path
+        self.values = values
+        self.error = error
+        self.command = None
+        self.info, self.err = None, None
+        self.invalid = "" if error else self._validate()
+
+    def _validate(self):
+        """Returns what is wrong with the testfile, or "" if it can be tested"""
+        if not isinstance(self.values, list) or not self.values or not isinstance(self.values[0], dict):
+            return "not a list of tests"
+        test = self.values[0]
+        if "command" not in test:
+            return "no command"
+        self.command = test["command"]
+        # Command lists (test_pings.yml) are only run, not tested
+        if isinstance(self.command, list):
+            return ""
+        for key in ["iterate", "blacklist", "tests"]:
+            if key not in test:
+                return f"no {key}"
+        if not isinstance(test["tests"], list) or not test["tests"] or not isinstance(test["tests"][0], dict):
+            return "no tests"
+        if not any(test_type in test["tests"][0] for test_type in TEST_TYPES):
+            return f"no test type, use one of {', '.join(TEST_TYPES)}"
+        try:
+            self.info = jinja2.Template(str(test["tests"][0]["info"]))
+            self.err = jinja2.Template(str(test["tests"][0]["err"]))
+        except KeyError as e:
+            return f"no {e.args[0]} message"
+        except jinja2.TemplateSyntaxError as e:
+            return f"bad template: {str(e)}"
+        return ""
+
+    def commands(self):
+        """Returns the commands the testfile needs run"""
+        if isinstance(self.command, list):
+            return list(self.command)
+        return [self.command] if self.command is not None else []
+
+
+def cache_path(cfg):
+    """Returns the path of the testfile cache, or None if it is turned off"""
+    if cfg.get("testfile_cache") is False:
+        return None
+    return cfg.get("testfile_cache") or f"{cfg['mop_path']}/.testfile_catalog.json"
+
+
+def _load_cache(cfg):
+    """Returns the cached testfiles, {path: {"mtime", "size", "sha1", "values"}}"""
+    global _cache
+    if _cache is None:
+        _cache = {}
+        path = cache_path(cfg)
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == CACHE_VERSION:
+                _cache = data["testfiles"]
+        except Exception:
+            pass
+    return _cache
+
+
+def _save_cache(cfg):
+    """Write the testfile cache (temp file renamed into place)"""
+    path = cache_path(cfg)
+    if not path:
+        return
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "testfiles": _cache}, f)
+        os.replace(tmp_file, path)
+    except Exception:
+        # The cache only saves time, the testfiles are still read
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def _read(name, path, cache):
+    """Returns (Testfile, True if the cache was updated)"""
+    try:
+        stat = os.stat(path)
+        cached = cache.get(path)
+        if cached and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+            return Testfile(name, path, cached["values"]), False
+        with open(path, "rb") as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        if cached and cached["sha1"] == sha1:
+            values = cached["values"]
+        else:
+            values = yaml.safe_load(data.decode("utf-8"))
+    except Exception as e:
+        return Testfile(name, path, error=str(e) or type(e).__name__), False
+    # Only cache what comes back from JSON the same
+    try:
+        if json.loads(json.dumps(values)) != values:
+            return Testfile(name, path, values), False
+    except (TypeError, ValueError):
+        return Testfile(name, path, values), False
+    cache[path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "sha1": sha1, "values": values}
+    return Testfile(name, path, values), True
+
+
+def testfiles(cfg, os_type):
+    """
+    Returns the testfiles of an OS type, in config file order.  They are
+    loaded on the first call in a process and shared after that.
+        :param cfg: the baseline config yaml object
+        :param os_type: (str) OS type, a key of the config file with a list of testfiles
+        :return: (list) Testfile objects
+    """
+    key = (cfg["testfile_path"], os_type, tuple(cfg.get(os_type) or []))
+    if key not in _catalogs:
+        cache = _load_cache(cfg) if cache_path(cfg) else {}
+        loaded, changed = [], False
+        for name in key[2]:
+            testfile, updated = _read(name, f"{cfg['testfile_path']}/{os_type}/{name}", cache)
+            loaded.append(testfile)
+            changed = changed or updated
+        if changed:
+            _save_cache(cfg)
+        _catalogs[key] = loaded
+    return _catalogs[key]
+
+
+def commands(cfg, os_type):
+    """
+    Returns the commands the testfiles of an OS type need run, in testfile
+    order without duplicates, or raises ValueError for a testfile that can't be read.
+    """
+    found = {}
+    for testfile in testfiles(cfg, os_type):
+        if testfile.error:
+            raise ValueError(f"{testfile.path}: {testfile.error}")
+        if testfile.command is None:
+            raise ValueError(f"{testfile.path}: {testfile.invalid}")
+        for command in testfile.commands():
+            found.setdefault(command, None)
+    return list(found)
@@ -6,15 +6,123 @@ johntishey@gmail.com - 2017
 """
 
 import colorama
+import bisect
 import difflib
 import logging
-import jinja2
 import math
-import yaml
 import re
 
 
 from . import custom_commands
+from . import testfile_catalog
+from .log_io import open_log
+
+
+# "Building configuration..." and "Current configuration : 1234 bytes" at the top of IOS show run
+CONFIG_HEADER_RE = re.compile(r"^(Building configuration\.\.\.|Current configuration ?: ?\d+ bytes)\s*$")
+
+
+class _LazyMessage(object):
+    """A result message that is only rendered if a log handler writes it"""
+
+    def __init__(self, color, template, **values):
+        self.color = color
+        self.template = template
+        self.values = values
+
+    def __str__(self):
+        return self.color + self.template.render(**self.values) + colorama.Style.RESET_ALL
+
+
+def _config_lines(lines):
+    """Drop the IOS show run header, a config downloaded as a file (config_transfer) doesn't have it"""
+    return [line for line in lines if not CONFIG_HEADER_RE.match(line)]
+
+
+def _section_header(line, section):
+    """Returns the section id if the line is a section header, otherwise None"""
+    try:
+        for word in section:
+            if line.startswith(word):
+                return line[len(word) :]
+    except:
+        pass
+    return None
+
+
+class _AfterLines(object):
+    """
+    The after lines of a test, split once and indexed by the testfile key column
+    (and section id), so each before line goes straight to its candidates instead
+    of scanning and re-splitting every after line.  Candidates come back in the
+    same order as the list, and remove() drops the first line with the same text
+    like list.remove(), so the results are the same as scanning the list.
+    """
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.alive = [True] * len(self.lines)
+        self.tokens = None
+        self.by_key = None
+        self.by_text = {}
+        for i, line in enumerate(self.lines):
+            self.by_text.setdefault(line, [0]).append(i)
+
+    def _index(self, line_id, section):
+        """Index the lines by the key column, and by the section id of the header above them"""
+        self.tokens = [line.split() for line in self.lines]
+        self.by_key = {}
+        section_id = ""
+        for i, tokens in enumerate(self.tokens):
+            if section is not None:
+                header = _section_header(self.lines[i], section)
+                if header is not None:
+                    # Section headers are never candidates
+                    section_id = header
+                    continue
+            try:
+                key = tokens[line_id]
+            except IndexError:
+                continue
+            self.by_key.setdefault((key, section_id), [0]).append(i)
+
+    def _first_alive(self, entry):
+        """Skip the removed lines at the start of an index entry ([start, line, line, ...])"""
+        while entry[0] + 1 < len(entry) and not self.alive[entry[entry[0] + 1]]:
+            entry[0] += 1
+
+    def candidates(self, line_id, key, section_id="", section=None, after=-1):
+        """
+        Yields (position, line, tokens) of the lines with key in column line_id
+        (and in section_id), in order
+            :param section: The testfile's section words (None = no sections)
+            :param after: Only lines after this position
+        """
+        if self.by_key is None:
+            self._index(line_id, section)
+        entry = self.by_key.get((key, section_id))
+        if not entry:
+            return
+        self._first_alive(entry)
+        for j in range(bisect.bisect_right(entry, after, entry[0] + 1), len(entry)):
+            if self.alive[entry[j]]:
+                yield entry[j], self.lines[entry[j]], self.tokens[entry[j]]
+
+    def remove(self, text):
+        """Remove the first line equal to text, returns False if there isn't one"""
+        # not-exists passes the ["null"] placeholder, which is never in the list
+        entry = self.by_text.get(text) if isinstance(text, str) else None
+        if entry:
+            self._first_alive(entry)
+            for j in range(entry[0] + 1, len(entry)):
+                if self.alive[entry[j]]:
+                    self.alive[entry[j]] = False
+                    return True
+        return False
+
+    def remaining(self):
+        """The lines that haven't been removed, in order"""
+        return [line for line, alive in zip(self.lines, self.alive) if alive]
 
 
 class Run(object):
@@ -24,8 +132,7 @@ class Run(object):
         """Compare output of commands according to test rules
         device.output['before'] and device.output['after'] contain the outputs"""
         self.device = device
-        self.test_list = self.device.config.cfg[(self.device.os_type)]
-        self.test_path = f"{self.device.config.cfg['testfile_path']}/{self.device.os_type}"
+        self.testfiles = testfile_catalog.testfiles(self.device.config.cfg, self.device.os_type)
         self.pre, self.post = "", ""
         self.pass_status = ""
         self.delta_value = ""
@@ -69,28 +176,24 @@ class Run(object):
                 pass
 
     def get_command_lists(self):
-        """For each yaml file in the config file, open testfile and gather command output."""
+        """For each testfile in the config file, gather command output."""
         logger = logging.getLogger("BaselineCheck")
-        for test_case in self.test_list:
+        for testfile in self.testfiles:
             # Don't read the ping command testfiles
-            if test_case == "test_pings.yml":
+            if testfile.name == "test_pings.yml":
                 continue
-            # Read all the other testfiles
-            try:
-                with open(self.test_path + "/" + test_case, encoding="utf-8") as f:
-                    self.test_values = yaml.safe_load(f)
-            except:
+            # The testfiles are loaded and checked once, by the catalog
+            if testfile.error or testfile.invalid:
+                error = "Could not load " if testfile.error else f"Invalid testfile ({testfile.invalid}) "
                 if self.json:
-                    self.json_output[self.device.hostname][test_case] = [
-                        f"ERROR: Could not load {self.test_path}/{test_case}"
-                    ]
+                    self.json_output[self.device.hostname][testfile.name] = [f"ERROR: {error}{testfile.path}"]
                 else:
                     logger.info("\n")
-                    logger.error(
-                        self.FAIL_COLOR + "ERROR:  Could not load " + self.test_path + "/" + test_case
-                    )
+                    logger.error(self.FAIL_COLOR + "ERROR:  " + error + testfile.path)
                     logger.info("\n")
                 continue
+            self.test_values = testfile.values
+            self.info_msg, self.err_msg = testfile.info, testfile.err
             try:
                 if isinstance(self.test_values[0]["command"], list):
                     continue
@@ -100,14 +203,30 @@ class Run(object):
                 self.after_cmd_output = self.device.output["after"][(self.test_values[0]["command"])]
                 self.json_output[self.device.hostname][self.test_values[0]["command"]] = []
             except KeyError:
-                log_msg = "ERROR:  " + self.test_values[0]["command"] + " not found in the baseline!"
-                logger.info(log_msg)
+                not_collected = self.not_collected(self.test_values[0]["command"])
+                if not_collected:
+                    if self.json:
+                        self.json_output[self.device.hostname][self.test_values[0]["command"]] = [
+                            not_collected
+                        ]
+                    logger.warning(self.FAIL_COLOR + not_collected + colorama.Style.RESET_ALL)
+                else:
+                    log_msg = "ERROR:  " + self.test_values[0]["command"] + " not found in the baseline!"
+                    logger.info(log_msg)
                 logger.info("\n")
                 continue
             self.before_cmd_output = self.filter_output(self.before_cmd_output)
             self.after_cmd_output = self.filter_output(self.after_cmd_output)
             self.test_cmd_output()
 
+    def not_collected(self, command):
+        """Returns an error message if baseline_run recorded the command as not collected"""
+        for kw in ["before", "after"]:
+            reason = self.device.output.get("not_collected", {}).get(kw, {}).get(command)
+            if reason is not None:
+                return f"ERROR:  {command} was not collected in the {kw} baseline ({reason})"
+        return ""
+
     def filter_output(self, command_output):
         """Remove blacklisted lines and non-iterator lines from command output"""
         testable_output = []
@@ -149,6 +268,7 @@ class Run(object):
         self.summary[(self.test_values[0]["command"])] = {"PASS": 0, "FAIL": 0}
         line = ""
         self.pass_status = "UNSET"
+        self.after_lines = _AfterLines(self.after_cmd_output)
         if len(self.before_cmd_output) == 0:
             self.exists(line)
             if self.pass_status != "UNSET":
@@ -186,6 +306,7 @@ class Run(object):
                     self.pass_status = "FAIL"
                     self.post = ""
                 self.print_result()
+        self.after_cmd_output = self.after_lines.remaining()
         self.after_only_lines()
         self.print_totals()
 
@@ -193,26 +314,24 @@ class Run(object):
         """Execute no-diff tests (indicating all indexes match before/after)"""
         line_id = self.test_values[0]["tests"][0]["no-diff"][0]
         after_line = ""
-        for after_line in self.after_cmd_output:
-            try:
-                after_line_orig = after_line
-                after_line = after_line.split()
-                if line[line_id] == after_line[line_id]:
-                    for index in self.test_values[0]["tests"][0]["no-diff"]:
-                        # If an index fails, mark as failed
-                        try:
-                            if line[index] != after_line[index]:
-                                self.pass_status = "FAIL"
-                                break
-                        except:
-                            self.pass_status = "FAIL"
-                    # If it looped through indexes without failing, mark as pass
-                    if self.pass_status == "UNSET":
-                        self.pass_status = "PASS"
-                    self.after_cmd_output.remove(after_line_orig)
-                    break
-            except IndexError:
-                continue
+        try:
+            candidates = self.after_lines.candidates(line_id, line[line_id])
+        except IndexError:
+            candidates = []
+        for _position, after_line_orig, after_line in candidates:
+            for index in self.test_values[0]["tests"][0]["no-diff"]:
+                # If an index fails, mark as failed
+                try:
+                    if line[index] != after_line[index]:
+                        self.pass_status = "FAIL"
+                        break
+                except:
+                    self.pass_status = "FAIL"
+            # If it looped through indexes without failing, mark as pass
+            if self.pass_status == "UNSET":
+                self.pass_status = "PASS"
+            self.after_lines.remove(after_line_orig)
+            break
         self.pre = line
         self.post = after_line
 
@@ -222,23 +341,20 @@ class Run(object):
         index = self.test_values[0]["tests"][0]["delta"][1]
         max_percent = self.test_values[0]["tests"][0]["delta"][2]
         after_line = ""
-        after_section_id = ""
-        for after_line in self.after_cmd_output:
-            skip_line = False
-            try:
-                for word in self.test_values[0]["section"]:
-                    if after_line.startswith(word):
-                        after_section_id = after_line[len(word) :]
-                        skip_line = True
-                        break
-            except:
-                pass
-            if skip_line:
-                continue
-            try:
-                after_line_orig = after_line
-                after_line = after_line.split()
-                if line[line_id] == after_line[line_id] and self.section_id == after_section_id:
+        try:
+            key = line[line_id]
+        except IndexError:
+            key = None
+        position = -1
+        while key is not None:
+            candidates = self.after_lines.candidates(
+                line_id, key, self.section_id, self.test_values[0].get("section"), position
+            )
+            last_key, key = key, None
+            for position, after_line_orig, after_line in candidates:
+                try:
+                    # The "%" is stripped from a copy, the index keeps the split line
+                    after_line = list(after_line)
                     line[index] = line[index].replace("%", "")
                     after_line[index] = after_line[index].replace("%", "")
                     # If before and after have a number in the match position:
@@ -258,10 +374,13 @@ class Run(object):
                             # If they are not both numbers and dont match
                             self.pass_status = "FAIL"
                             self.delta_value = "100%"
-                    self.after_cmd_output.remove(after_line_orig)
+                    self.after_lines.remove(after_line_orig)
                     break
-            except IndexError:
-                continue
+                except IndexError:
+                    # A "%" stripped from the key column changes the key for the lines after this one
+                    if line[line_id] != last_key:
+                        key = line[line_id]
+                        break
         # If it gets out of the loop with no match in after:
         if self.pass_status == "UNSET":
             if line[index].isdigit():
@@ -290,10 +409,7 @@ class Run(object):
                 self.pass_status = "FAIL"
         self.pre = line
         self.post = line
-        try:
-            self.after_cmd_output.remove(line)
-        except:
-            pass
+        self.after_lines.remove(line)
 
     def after_only_lines(self):
         """Account for lines in AFTER that aren't in BEFORE"""
@@ -308,7 +424,7 @@ class Run(object):
                     self.post = ""
                     if "not-exists" in self.test_values[0]["tests"][0]:
                         self.summary[(self.test_values[0]["command"])]["FAIL"] += 1
-                        msg = jinja2.Template(str(self.test_values[0]["tests"][0]["err"]))
+                        msg = self.err_msg
                         if self.json:
                             self.json_output[self.device.hostname][self.test_values[0]["command"]].append(
                                 msg.render(device=self.device, pre=self.pre, post=self.post)
@@ -320,7 +436,7 @@ class Run(object):
                         )
                     elif "exists" in self.test_values[0]["tests"][0]:
                         self.summary[(self.test_values[0]["command"])]["PASS"] += 1
-                        msg = jinja2.Template(str(self.test_values[0]["tests"][0]["info"]))
+                        msg = self.info_msg
                         logger.info(
                             self.PASS_COLOR
                             + msg.render(device=self.device, pre=self.pre, post=self.post)
@@ -361,7 +477,7 @@ class Run(object):
                         self.pre[line_id] = self.post[line_id]
                     except:
                         continue
-                    msg = jinja2.Template(str(self.test_values[0]["tests"][0]["err"]))
+                    msg = self.err_msg
                     if self.json:
                         self.json_output[self.device.hostname][self.test_values[0]["command"]].append(
                             msg.render(
@@ -389,45 +505,36 @@ class Run(object):
         logger = logging.getLogger("BaselineCheck")
         if self.pass_status == "FAIL":
             self.summary[(self.test_values[0]["command"])]["FAIL"] += 1
-            msg = jinja2.Template(str(self.test_values[0]["tests"][0]["err"]))
+            msg = self.err_msg
             if self.post == "" or self.post == []:
                 self.post = ["null"] * 12
-            if self.json:
-                self.json_output[self.device.hostname][self.test_values[0]["command"]].append(
-                    msg.render(
-                        device=self.device,
-                        pre=self.pre,
-                        post=self.post,
-                        delta=self.delta_value,
-                        section_id=self.section_id,
-                    )
-                )
-            logger.warning(
-                self.FAIL_COLOR
-                + msg.render(
-                    device=self.device,
-                    pre=self.pre,
-                    post=self.post,
-                    delta=self.delta_value,
-                    section_id=self.section_id,
-                )
-                + colorama.Style.RESET_ALL
+            message = msg.render(
+                device=self.device,
+                pre=self.pre,
+                post=self.post,
+                delta=self.delta_value,
+                section_id=self.section_id,
             )
+            if self.json:
+                self.json_output[self.device.hostname][self.test_values[0]["command"]].append(message)
+            logger.warning(self.FAIL_COLOR + message + colorama.Style.RESET_ALL)
         else:
             self.summary[(self.test_values[0]["command"])]["PASS"] += 1
-            msg = jinja2.Template(str(self.test_values[0]["tests"][0]["info"]))
+            msg = self.info_msg
             if not self.post:
                 self.post = ["null"] * 12
+            # PASS lines are only shown with -v, they are rendered if a handler writes them
             logger.debug(
-                self.PASS_COLOR
-                + msg.render(
+                "%s",
+                _LazyMessage(
+                    self.PASS_COLOR,
+                    msg,
                     device=self.device,
                     pre=self.pre,
                     post=self.post,
                     delta=self.delta_value,
                     section_id=self.section_id,
-                )
-                + colorama.Style.RESET_ALL
+                ),
             )
 
     def print_totals(self):
@@ -467,11 +574,11 @@ class Run(object):
         try:
             for _file in self.device.config.before_config:
                 if self.device.hostname in _file:
-                    with open(self.device.config.mop_path + "/" + _file, encoding="utf-8") as f:
+                    with open_log(self.device.config.mop_path + "/" + _file) as f:
                         before_cfg = f.readlines()
             for _file in self.device.config.after_config:
                 if self.device.hostname in _file:
-                    with open(self.device.config.mop_path + "/" + _file, encoding="utf-8") as f:
+                    with open_log(self.device.config.mop_path + "/" + _file) as f:
                         after_cfg = f.readlines()
         except:
             self.config_diff()
@@ -527,14 +634,14 @@ class Run(object):
         logger.info("******* Command: %s ********", cmds[self.device.os_type])
         try:
             line_count = 0
-            before_cfg = self.device.output["before"][(cmds[self.device.os_type])]
-            after_cfg = self.device.output["after"][(cmds[self.device.os_type])]
+            before_cfg = _config_lines(self.device.output["before"][(cmds[self.device.os_type])])
+            after_cfg = _config_lines(self.device.output["after"][(cmds[self.device.os_type])])
         except KeyError:
-            if self.json:
-                self.json_output[self.device.hostname]["show configuration"].append(
-                    f"ERROR: {cmds[self.device.os_type]} not found in {self.device.hostname} baseline"
-                )
             log_msg = f"ERROR: {cmds[self.device.os_type]} not found in {self.device.hostname} baseline"
+            if self.not_collected(cmds[self.device.os_type]):
+                log_msg = self.not_collected(cmds[self.device.os_type])
+            if self.json:
+                self.json_output[self.device.hostname]["show configuration"].append(log_msg)
             logger.warning(log_msg)
             logger.info("\n")
             return
@@ -7,6 +7,10 @@ johntishey@gmail.com - 2017
 
 import re
 
+from .log_io import open_log
+from .log_index import load_index
+from .log_index import LazyCommands
+
 
 def run(device):
     """Get device prompt and call the extract function"""
@@ -31,14 +35,28 @@ def run(device):
 def extract(device, prompt):
     """extract commands from baselines"""
     # Open the before and after baseline files and loop through lines
-    output = {}
+    output = {"not_collected": {}}
     for each_file in device.files:
-        with open(each_file, "r", errors="replace", encoding="utf-8") as f:
+        # Logs with [COMMAND] blocks are indexed, so only the commands
+        # that get looked up are read from the file
+        entries = load_index(each_file)
+        if entries is not None:
+            commands = LazyCommands(each_file, entries)
+            _assign(device, each_file, output, commands, commands.not_collected)
+            continue
+        with open_log(each_file) as f:
             baseline_text = f.readlines()
         commands = {}
+        not_collected = {}
         current_command = ""
         for line in baseline_text:
             line = line.rstrip()
+            # baseline_run marks commands it couldn't collect
+            if line.startswith("[NOT_COLLECTED]") and current_command in commands:
+                del commands[current_command]
+                not_collected[current_command] = line.replace("[NOT_COLLECTED]", "").strip()
+                current_command = ""
+                continue
             # if there's a prompt, set it as a new command
             # and capture subsequent lines under it
             if re.match(prompt, line) or line.startswith("[COMMAND]"):
@@ -51,8 +69,15 @@ def extract(device, prompt):
                 if current_command != "":
                     if line != "" and line[:7] != "{master" and line != "[]":
                         commands[current_command].append(line)
-        if device.config.before_kw.lower() in str(each_file).lower():
-            output["before"] = commands
-        else:
-            output["after"] = commands
+        _assign(device, each_file, output, commands, not_collected)
     return output
+
+
+def _assign(device, each_file, output, commands, not_collected):
+    """Put a file's commands under "before" or "after" in the output"""
+    if device.config.before_kw.lower() in str(each_file).lower():
+        output["before"] = commands
+        output["not_collected"]["before"] = not_collected
+    else:
+        output["after"] = commands
+        output["not_collected"]["after"] = not_collected
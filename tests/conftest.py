@@ -0,0 +1,67 @@
+"""
+Put src on the path, the scripts in it import the utils package from there
+"""
+
+import os
+import sys
+import socket
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+def _free_port():
+    """Returns a port that is free on the simulator addresses"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.1.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def simulator(tmp_path):
+    """
+    Returns start(os_types, outputs, **options), which runs a DeviceSimulator with one
+    device per OS type replaying outputs ({os_type: {command: output}}) and returns it
+    """
+    pytest.importorskip("paramiko")
+    from utils.device_sim import DeviceSimulator
+
+    running = []
+
+    def start(os_types, outputs, **options):
+        replay_path = tmp_path / "replay"
+        replay_path.mkdir()
+        for os_type in os_types:
+            text = f"[DEVICE_TYPE] {os_type}\n"
+            for command, output in outputs.get(os_type, {}).items():
+                text += f"\n\n[COMMAND] {command}\n{output}\n"
+            (replay_path / f"{os_type}_log").write_text(text)
+        sim = DeviceSimulator(len(os_types), os_types, replay_path=str(replay_path), port=_free_port(), **options)
+        sim.start()
+        running.append(sim)
+        return sim
+
+    yield start
+    for sim in running:
+        sim.stop()
+
+
+@pytest.fixture
+def connect():
+    """Returns connect(sim, device), a netmiko session to a simulated device"""
+    netmiko = pytest.importorskip("netmiko")
+    sessions = []
+
+    def _connect(sim, device):
+        # MD-CLI is found from the prompt, netmiko only knows nokia_sros
+        device_type = "nokia_sros" if device.os_type == "nokia_mdcli" else device.os_type
+        net_connect = netmiko.ConnectHandler(
+            device_type=device_type, host=device.address, port=sim.port, username="guest", password="x"
+        )
+        sessions.append(net_connect)
+        return net_connect
+
+    yield _connect
+    for net_connect in sessions:
+        net_connect.disconnect()
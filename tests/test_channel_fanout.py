@@ -0,0 +1,122 @@
+"""
+A device's commands spread over several channels of one SSH session, against the simulator
+"""
+
+import pytest
+
+pytest.importorskip("easysnmp")
+
+import baseline_run
+from utils import channel_fanout
+from utils.telemetry import device_stats
+from utils.log_index import load_index
+from utils.log_index import LazyCommands
+
+OUTPUTS = {
+    "show slow": "slow line 1\nslow line 2",
+    "show version": "Hostname: sim1\nModel: simulated",
+    "show interfaces terse": "ge-0/0/0 up up\nge-0/0/1 up down",
+    # Two byte characters, one byte out of step so they are split across reads
+    "show description": "x" + "é" * 50000,
+    "show chassis alarms": "No alarms currently active",
+}
+
+
+class _History(object):
+    def __init__(self):
+        self.devices = {}
+        self.recorded = []
+
+    def record(self, device, seconds, command_times):
+        self.recorded.append(device)
+
+
+def _collect(tmp_path, sim, monkeypatch, fail_main):
+    """Collects the simulated device over 2 channels, the main channel sends "show slow" and gives up"""
+    stream_command = channel_fanout.stream_command
+
+    def _stuck(session, command, write, **kwargs):
+        if fail_main and command == "show slow" and not isinstance(session, channel_fanout.ExtraChannel):
+            # The command is sent, but its output is never read
+            session.write_channel(command + session.RETURN)
+            raise TimeoutError(f"Timed out waiting for prompt: {command}")
+        return stream_command(session, command, write, **kwargs)
+
+    monkeypatch.setattr(channel_fanout, "stream_command", _stuck)
+    cfg = {
+        "mop_path": str(tmp_path),
+        "ssh_port": sim.port,
+        "channels_per_device": 2,
+        "retries": 1,
+        "retry_backoff": 0,
+        "commands": {"juniper_junos": list(OUTPUTS)},
+        "ping_targets": [],
+    }
+    device = list(sim.devices.values())[0]
+    history, stats = _History(), device_stats(device.address, 0)
+    status = baseline_run._collect_device(device.address, cfg, "before", "mop", history, stats, "juniper_junos")
+    log_file = baseline_run.log_file_path(cfg, "mop", device.address, "before")
+    return status, stats, history, LazyCommands(log_file, load_index(log_file))
+
+
+@pytest.mark.parametrize("fail_main", [False, True])
+def test_output_under_its_command(tmp_path, simulator, monkeypatch, fail_main):
+    sim = simulator(["juniper_junos"], {"juniper_junos": OUTPUTS})
+    status, stats, history, commands = _collect(tmp_path, sim, monkeypatch, fail_main)
+    assert status == "complete"
+    assert stats.get("retries", 0) == (1 if fail_main else 0)
+    assert history.recorded
+    for command, output in OUTPUTS.items():
+        assert commands[command] == output.split("\n")
+
+
+class _SplitChannel(object):
+    """A shell channel that answers like the simulator, 3 bytes per recv"""
+
+    closed = False
+
+    def __init__(self):
+        self.pending = b"guest@sim1> "
+
+    def get_pty(self, **kwargs):
+        pass
+
+    def invoke_shell(self):
+        pass
+
+    def sendall(self, data):
+        command = data.strip()
+        reply = OUTPUTS.get(command, "")
+        self.pending += f"{command}\r\n{reply}\r\nguest@sim1> ".encode()
+
+    def recv_ready(self):
+        return bool(self.pending)
+
+    def recv(self, size):
+        data, self.pending = self.pending[:3], self.pending[3:]
+        return data
+
+    def close(self):
+        pass
+
+
+class _SplitConnect(object):
+    base_prompt = "guest@sim1"
+    RETURN = "\n"
+
+    def __init__(self):
+        self.remote_conn = self
+
+    def get_transport(self):
+        return self
+
+    def open_session(self, timeout):
+        return _SplitChannel()
+
+
+def test_split_characters():
+    """A multibyte character split across two reads is decoded whole"""
+    channel = channel_fanout.ExtraChannel(_SplitConnect(), "juniper_junos")
+    output = []
+    channel_fanout.stream_command(channel, "show description", output.append, read_timeout=10)
+    assert "".join(output) == OUTPUTS["show description"]
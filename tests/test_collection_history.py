@@ -0,0 +1,32 @@
+"""
+Collection history saved by runs that share the history file
+"""
+
+import json
+
+from utils.collection_history import CollectionHistory
+
+
+def test_runs_keep_each_others_devices(tmp_path):
+    cfg = {"mop_path": str(tmp_path)}
+    first, second = CollectionHistory(cfg), CollectionHistory(cfg)
+    first.record("r1", 10.0, {"show version": 1.0})
+    second.record("r2", 20.0, {"show version": 2.0})
+    first.save()
+    second.save()
+    with open(tmp_path / ".collection_history.json", encoding="utf-8") as f:
+        devices = json.load(f)
+    assert sorted(devices) == ["r1", "r2"]
+    assert sorted(second.devices) == ["r1", "r2"]
+    assert CollectionHistory(cfg).expected("r1") == 10.0
+
+
+def test_newest_entry_wins(tmp_path):
+    cfg = {"mop_path": str(tmp_path)}
+    first, second = CollectionHistory(cfg), CollectionHistory(cfg)
+    first.record("r1", 10.0, {})
+    second.record("r1", 30.0, {})
+    second.devices["r1"]["updated"] += 1
+    second.save()
+    first.save()
+    assert CollectionHistory(cfg).expected("r1") == 30.0
@@ -0,0 +1,41 @@
+"""
+The adaptive limit on the devices in flight, from the stats of finished devices
+"""
+
+from utils.concurrency import AdaptiveConcurrency
+
+
+def _stats(device, connect=None, login_failed=False, retries=0, error=None):
+    return {
+        "device": device,
+        "status": "complete" if connect is not None else "failed",
+        "connect": connect,
+        "login_failed": login_failed,
+        "retries": retries,
+        "error": error,
+    }
+
+
+def _finish(limiter, stats):
+    limiter.release(limiter.acquire(), stats)
+
+
+def test_failed_login_halves_the_limit():
+    limiter = AdaptiveConcurrency({"adaptive_start": 8}, 64)
+    _finish(limiter, _stats("r1", login_failed=True, error="Authentication to device failed."))
+    assert limiter.limit == 4
+
+
+def test_turned_away_before_login_keeps_the_limit():
+    limiter = AdaptiveConcurrency({"adaptive_start": 8}, 64)
+    for i in range(10):
+        _finish(limiter, _stats(f"r{i}", error="No supported OS type (None)"))
+    assert limiter.limit == 8
+    _finish(limiter, _stats("r10", connect=1.0))
+    assert limiter.limit == 9
+
+
+def test_retried_session_halves_the_limit():
+    limiter = AdaptiveConcurrency({"adaptive_start": 8}, 64)
+    _finish(limiter, _stats("r1", connect=1.0, retries=1))
+    assert limiter.limit == 4
@@ -0,0 +1,273 @@
+"""
+The indexed before/after matching of the_differentiator against the list scan it replaced
+"""
+
+import copy
+import math
+import random
+import logging
+from unittest import mock
+
+import jinja2
+import pytest
+
+from utils import the_differentiator
+
+
+class _ListLines(object):
+    """Stands in for _AfterLines with the after list itself, which the reference methods change in place"""
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def remaining(self):
+        return self.lines
+
+
+class _ReferenceRun(the_differentiator.Run):
+    """no_diff, delta and exists as they were before the hash index (list scan and list.remove)"""
+
+    def test_cmd_output(self):
+        with mock.patch.object(the_differentiator, "_AfterLines", _ListLines):
+            super().test_cmd_output()
+
+    def no_diff(self, line):
+        line_id = self.test_values[0]["tests"][0]["no-diff"][0]
+        after_line = ""
+        for after_line in self.after_cmd_output:
+            try:
+                after_line_orig = after_line
+                after_line = after_line.split()
+                if line[line_id] == after_line[line_id]:
+                    for index in self.test_values[0]["tests"][0]["no-diff"]:
+                        try:
+                            if line[index] != after_line[index]:
+                                self.pass_status = "FAIL"
+                                break
+                        except:
+                            self.pass_status = "FAIL"
+                    if self.pass_status == "UNSET":
+                        self.pass_status = "PASS"
+                    self.after_cmd_output.remove(after_line_orig)
+                    break
+            except IndexError:
+                continue
+        self.pre = line
+        self.post = after_line
+
+    def delta(self, line):
+        line_id = self.test_values[0]["tests"][0]["delta"][0]
+        index = self.test_values[0]["tests"][0]["delta"][1]
+        max_percent = self.test_values[0]["tests"][0]["delta"][2]
+        after_line = ""
+        after_section_id = ""
+        for after_line in self.after_cmd_output:
+            skip_line = False
+            try:
+                for word in self.test_values[0]["section"]:
+                    if after_line.startswith(word):
+                        after_section_id = after_line[len(word) :]
+                        skip_line = True
+                        break
+            except:
+                pass
+            if skip_line:
+                continue
+            try:
+                after_line_orig = after_line
+                after_line = after_line.split()
+                if line[line_id] == after_line[line_id] and self.section_id == after_section_id:
+                    line[index] = line[index].replace("%", "")
+                    after_line[index] = after_line[index].replace("%", "")
+                    if line[index].isdigit() and after_line[index].isdigit():
+                        self.delta_value = abs(int(line[index]) - int(after_line[index]))
+                        if self.delta_value > math.ceil(float(line[index]) * max_percent):
+                            self.pass_status = "FAIL"
+                        else:
+                            self.pass_status = "PASS"
+                    else:
+                        if line[index] == after_line[index]:
+                            self.pass_status = "PASS"
+                            self.delta_value = "0"
+                        else:
+                            self.pass_status = "FAIL"
+                            self.delta_value = "100%"
+                    self.after_cmd_output.remove(after_line_orig)
+                    break
+            except IndexError:
+                continue
+        if self.pass_status == "UNSET":
+            if line[index].isdigit():
+                self.delta_value = line[index]
+                self.pass_status = "FAIL"
+                after_line = ["null"] * 12
+            else:
+                self.delta_value = "100%"
+                self.pass_status = "FAIL"
+                after_line = ["null"] * 12
+        self.pre = line
+        self.post = after_line
+
+    def exists(self, line):
+        if "not-exists" in self.test_values[0]["tests"][0]:
+            if line != "":
+                self.pass_status = "FAIL"
+            else:
+                self.pass_status = "PASS"
+                line = ["null"] * 12
+        elif "exists" in self.test_values[0]["tests"][0]:
+            if line != "":
+                self.pass_status = "PASS"
+            else:
+                self.pass_status = "FAIL"
+        self.pre = line
+        self.post = line
+        try:
+            self.after_cmd_output.remove(line)
+        except:
+            pass
+
+
+class _Records(logging.Handler):
+    """Keeps the rendered log records"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+@pytest.fixture
+def records():
+    logger = logging.getLogger("BaselineCheck")
+    handler = _Records()
+    level, propagate = logger.level, logger.propagate
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    yield handler.records
+    logger.removeHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = propagate
+
+
+class _Device(object):
+    hostname = "r1"
+
+
+INFO_MSG = jinja2.Template("OK {{ pre }} {{ post }} {{ delta }} {{ section_id }}")
+ERR_MSG = jinja2.Template("BAD {{ pre }} {{ post }} {{ delta }} {{ section_id }}")
+
+
+def _test_values(test, section=None, ignore_null=False):
+    values = {"command": "show x", "iterate": ["all"], "blacklist": [], "tests": [test], "ignore-null": ignore_null}
+    if section:
+        values["section"] = section
+    return [values]
+
+
+def _check(run_class, records, test_values, before, after, json=False, section_id=""):
+    """Runs one test on before/after lines, returns everything it logged and left behind"""
+    del records[:]
+    run = run_class.__new__(run_class)
+    run.device = _Device()
+    run.test_values = copy.deepcopy(test_values)
+    run.info_msg, run.err_msg = INFO_MSG, ERR_MSG
+    run.json = json
+    run.PASS_COLOR, run.FAIL_COLOR = "<pass>", "<fail>"
+    run.summary = {}
+    run.section_id = section_id
+    run.json_output = {"r1": {"show x": []}}
+    run.before_cmd_output, run.after_cmd_output = list(before), list(after)
+    run.pre = run.post = run.delta_value = ""
+    try:
+        run.test_cmd_output()
+        error = None
+    except Exception as e:
+        # The check of the device stops here, the after lines aren't used again
+        error = type(e).__name__
+        run.after_cmd_output = None
+    return list(records), run.summary, run.json_output, run.after_cmd_output, run.section_id, error
+
+
+def _same(records, test_values, before, after, **kwargs):
+    reference = _check(_ReferenceRun, records, test_values, before, after, **kwargs)
+    indexed = _check(the_differentiator.Run, records, test_values, before, after, **kwargs)
+    assert indexed == reference
+    return indexed
+
+
+def test_duplicate_lines_removed_first_equal(records):
+    """Each before line takes the first equal after line, the rest are after-only lines"""
+    before = ["ge-0/0/0 up up", "ge-0/0/0 up up", "ge-0/0/1 up down"]
+    after = ["ge-0/0/1 up up", "ge-0/0/0 up up", "ge-0/0/0 up up", "ge-0/0/0 up up", "ge-0/0/1 up down"]
+    _logged, summary, _json, left, _section, _error = _same(records, _test_values({"no-diff": [0, 1, 2]}), before, after)
+    # 2 passed, ge-0/0/1 changed, and 2 lines are only in the after output
+    assert summary["show x"] == {"PASS": 2, "FAIL": 3}
+    assert left == ["ge-0/0/0 up up", "ge-0/0/1 up down"]
+
+
+def test_exists_removes_first_equal(records):
+    before = ["a 1", "a 1", "b 2"]
+    after = ["b 2", "a 1", "c 3", "a 1", "a 1"]
+    _same(records, _test_values({"exists": [0]}), before, after)
+    _same(records, _test_values({"not-exists": [0]}), before, after)
+
+
+def test_delta_sections(records):
+    """Lines are only matched within the section of the header above them"""
+    section = ["AF: ", "VRF: "]
+    before = ["AF: v4", "10.0.0.1 100", "10.0.0.2 50", "AF: v6", "10.0.0.1 10", "VRF: red", "10.0.0.2 7"]
+    after = ["AF: v6", "10.0.0.1 11", "AF: v4", "10.0.0.2 52", "10.0.0.1 200", "VRF: red", "10.0.0.2 7"]
+    _logged, summary, _json, _after, _section, _error = _same(
+        records, _test_values({"delta": [0, 1, 0.1]}, section), before, after, json=True
+    )
+    assert summary["show x"] == {"PASS": 3, "FAIL": 1}
+
+
+def test_delta_percent_rekeys(records):
+    """Stripping "%" from the compared column changes the key when it is also the key column"""
+    before = ["a 5%", "b 7%"]
+    after = ["5%", "b 5", "c 7", "7"]
+    _same(records, _test_values({"delta": [-1, 1, 0.5]}), before, after)
+    _same(records, _test_values({"delta": [1, 1, 0.5]}), ["x 5%", "y 5%"], ["x 5%", "y 5", "x 5"])
+
+
+def _random_line(r):
+    words = ["a", "b", "c", "1", "2", "10", "5%", "7%", "x", "0", "12", "9"]
+    tokens = [r.choice(words) for _ in range(r.choice([0, 1, 1, 2, 3, 3, 4, 5]))]
+    if r.random() < 0.1:
+        return r.choice(["AF: v4", "AF: v6", "VRF: red"])
+    return " ".join(tokens)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_outputs(records, seed):
+    tests = [
+        {"no-diff": [0, 1, 2]},
+        {"no-diff": [1, 0]},
+        {"no-diff": [-1, 0, 3]},
+        {"delta": [0, 2, 0.1]},
+        {"delta": [1, -1, 0.5]},
+        {"delta": [-1, 1, 0.2]},
+        {"exists": [0]},
+        {"not-exists": [0]},
+    ]
+    r = random.Random(seed)
+    for _case in range(500):
+        section = ["AF: ", "VRF: "] if r.random() < 0.5 else None
+        before = [_random_line(r) for _ in range(r.randint(0, 15))]
+        after = [_random_line(r) for _ in range(r.randint(0, 15))]
+        if r.random() < 0.5:
+            after = before + after[: r.randint(0, 5)]
+            r.shuffle(after)
+        _same(
+            records,
+            _test_values(r.choice(tests), section, ignore_null=r.random() < 0.5),
+            before,
+            after,
+            json=r.random() < 0.5,
+            section_id=r.choice(["", "v4"]),
+        )
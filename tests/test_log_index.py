@@ -0,0 +1,114 @@
+"""
+Logs written by LogWriter, read back through their .idx sidecar, against the full parse of the log
+"""
+
+import os
+from unittest import mock
+
+import pytest
+
+from utils import log_index
+from utils import the_extractorator
+from utils.log_writer import LogWriter
+
+
+class _Config(object):
+    before_kw = "before"
+    after_kw = "after"
+
+
+class _Device(object):
+    def __init__(self, files, os_type="juniper_junos"):
+        self.hostname = "r1"
+        self.os_type = os_type
+        self.files = files
+        self.config = _Config()
+
+
+BLOCKS = [
+    ("show version", "Hostname: r1\nModel: mx480\n\n{master}\nJunos: 21.4R3\n"),
+    ("show interfaces terse", "ge-0/0/0 up up\r\nge-0/0/1 up down\r\n[]\n"),
+    ("show route summary", None),
+    ("deip@r1> ", "Inet.0: 12 destinations\n"),
+    ("show bgp summary", "Peer AS State\n10.0.0.1 65000 Established\n"),
+    ("show bgp summary", "Peer AS State\n10.0.0.1 65000 Active\n"),
+    ("show ospf neighbor", "10.1.1.1 ge-0/0/0 Full\n"),
+    ("deip@r1-re0> ", None),
+    ("show chassis alarms", "No alarms currently active"),
+]
+
+
+def _write_log(path, blocks=BLOCKS, compression=None):
+    writer = LogWriter(str(path), compression)
+    writer.write("[DEVICE_TYPE] juniper_junos\n")
+    for command, output in blocks:
+        if output is None:
+            writer.not_collected(command, "Timed out after 120s\nwaiting for prompt")
+            continue
+        writer.start_command(command)
+        writer.write(output)
+    writer.close()
+    return writer.log_file
+
+
+def _extract(files, full_parse=False):
+    device = _Device(files)
+    if full_parse:
+        with mock.patch.object(the_extractorator, "load_index", lambda log_file: None):
+            output = the_extractorator.run(device)
+    else:
+        output = the_extractorator.run(device)
+    # Read every command so the lazy sections are compared too
+    return {
+        "before": {command: list(lines) for command, lines in output.get("before", {}).items()},
+        "after": {command: list(lines) for command, lines in output.get("after", {}).items()},
+        "not_collected": output["not_collected"],
+    }
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_index_matches_full_parse(tmp_path, compression):
+    before = _write_log(tmp_path / "mop_r1_before_log", compression=compression)
+    after = _write_log(tmp_path / "mop_r1_after_log", BLOCKS[::-1], compression)
+    assert os.path.exists(log_index.index_path(before))
+    indexed = _extract([before, after])
+    assert indexed == _extract([before, after], full_parse=True)
+    assert indexed["before"]["show bgp summary"] == ["Peer AS State", "10.0.0.1 65000 Active"]
+    assert indexed["before"]["show version"] == ["Hostname: r1", "Model: mx480", "Junos: 21.4R3"]
+    # A [NOT_COLLECTED] line after a prompt-like [COMMAND] line marks the command before it
+    assert "show ospf neighbor" not in indexed["before"]
+    assert indexed["not_collected"]["before"]["show ospf neighbor"] == "Timed out after 120s waiting for prompt"
+
+
+def test_build_index_matches_writer(tmp_path):
+    log_file = _write_log(tmp_path / "mop_r1_before_log")
+    written = log_index.load_index(log_file)
+    os.remove(log_index.index_path(log_file))
+    built = log_index.build_index(log_file)
+    assert os.path.exists(log_index.index_path(log_file))
+    # The writer's sections also take the blank lines before the next [COMMAND] line
+    assert [entry[0].rstrip() for entry in built] == [entry[0].rstrip() for entry in written]
+    assert [entry[1] is None for entry in built] == [entry[1] is None for entry in written]
+    assert _extract([log_file]) == _extract([log_file], full_parse=True)
+
+
+def test_edited_log_is_indexed_again(tmp_path):
+    log_file = _write_log(tmp_path / "mop_r1_before_log")
+    stat = os.stat(log_file)
+    # Same size, new contents and modification time
+    with open(log_file, "r+", encoding="utf-8") as f:
+        text = f.read()
+        f.seek(0)
+        f.write(text.replace("Model: mx480", "[COMMAND] ab"))
+    os.utime(log_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert os.stat(log_file).st_size == stat.st_size
+    entries = log_index.load_index(log_file)
+    assert [entry[0] for entry in entries].count("ab") == 1
+    assert _extract([log_file]) == _extract([log_file], full_parse=True)
+
+
+def test_log_without_commands_uses_full_parse(tmp_path):
+    log_file = tmp_path / "mop_r1_before_log"
+    log_file.write_text("deip@r1> show version\nHostname: r1\ndeip@r1> show chassis alarms\nNo alarms\n")
+    assert log_index.load_index(str(log_file)) is None
+    assert _extract([str(log_file)])["before"] == {"show version": ["Hostname: r1"], "show chassis alarms": ["No alarms"]}
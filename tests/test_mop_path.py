@@ -0,0 +1,28 @@
+"""
+A MOP folder that doesn't exist is reported before any device is logged in to
+"""
+
+import pytest
+
+pytest.importorskip("easysnmp")
+
+import baseline_run
+from utils.baseline_utils import log_file_path
+
+
+def test_log_file_path_raises(tmp_path):
+    with pytest.raises(FileNotFoundError, match="MOP folder"):
+        log_file_path({"mop_path": str(tmp_path / "missing")}, "mop", "r1", "before")
+
+
+def test_run_exits_before_login(tmp_path, monkeypatch, capsys):
+    cfg_file = tmp_path / "config.yml"
+    cfg_file.write_text(f"mop_path: {tmp_path / 'missing'}\ntfsm_templates_path: {tmp_path}\n")
+
+    def _no_login(*args, **kwargs):
+        raise AssertionError("logged in")
+
+    monkeypatch.setattr(baseline_run, "_connect", _no_login)
+    with pytest.raises(SystemExit):
+        baseline_run.get_baseline("r1", "before", "mop", str(cfg_file), preflight=False)
+    assert "MOP folder" in capsys.readouterr().out
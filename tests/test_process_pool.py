@@ -0,0 +1,31 @@
+"""
+Handing devices to worker processes that exit while the work queue is full
+"""
+
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("easysnmp")
+
+from utils import process_pool
+
+
+def _exit_worker(local_queue, *args):
+    """A thread worker that takes the process down with it"""
+    local_queue.get()
+    os._exit(3)
+
+
+def test_workers_exit_with_full_queue(tmp_path):
+    cfg = {"mop_path": str(tmp_path), "max_queue": 1, "max_threads": 1}
+    devices = [(f"r{i}", "juniper_junos") for i in range(50)]
+    run = threading.Thread(
+        target=process_pool.collect,
+        args=(devices, cfg, "before", "mop", "threads", 1, None, None, _exit_worker),
+        daemon=True,
+    )
+    run.start()
+    run.join(30)
+    assert not run.is_alive()
@@ -0,0 +1,59 @@
+"""
+Resuming a device's commands on a new session after one fails, against the simulator
+"""
+
+import pytest
+
+pytest.importorskip("easysnmp")
+
+import baseline_run
+from utils.telemetry import device_stats
+from utils.log_index import load_index
+from utils.log_index import LazyCommands
+
+OUTPUTS = {
+    "show version": "TiMOS-B-23.10.R1 both/x86_64 Nokia 7750 SR",
+    "show slow": "slow line 1\nslow line 2",
+    "show router interface": "system 10.0.0.1/32 Up",
+}
+
+
+class _History(object):
+    def __init__(self):
+        self.devices = {}
+
+    def record(self, device, seconds, command_times):
+        pass
+
+
+def test_md_cli_reconnect(tmp_path, simulator, monkeypatch):
+    """An MD-CLI session found on the first login is logged in to again as nokia_sros"""
+    sim = simulator(["nokia_mdcli"], {"nokia_mdcli": OUTPUTS})
+    stream_command, failed = baseline_run.stream_command, []
+
+    def _fail_once(net_connect, command, write, **kwargs):
+        if command == "show slow" and not failed:
+            failed.append(command)
+            raise TimeoutError(f"Timed out waiting for prompt: {command}")
+        return stream_command(net_connect, command, write, **kwargs)
+
+    monkeypatch.setattr(baseline_run, "stream_command", _fail_once)
+    cfg = {
+        "mop_path": str(tmp_path),
+        "ssh_port": sim.port,
+        "retries": 1,
+        "retry_backoff": 0,
+        "commands": {"nokia_mdcli": list(OUTPUTS)},
+        "ping_targets": [],
+    }
+    device = list(sim.devices.values())[0]
+    stats = device_stats(device.address, 0)
+    status = baseline_run._collect_device(device.address, cfg, "before", "mop", _History(), stats, "nokia_sros")
+    assert failed
+    assert status == "complete"
+    assert stats["retries"] == 1
+    log_file = baseline_run.log_file_path(cfg, "mop", device.address, "before")
+    commands = LazyCommands(log_file, load_index(log_file))
+    # MD-CLI's two line prompt leaves its "[/]" line in the output
+    for command, output in OUTPUTS.items():
+        assert commands[command] == output.split("\n") + ["[/]"]
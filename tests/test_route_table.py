@@ -0,0 +1,110 @@
+"""
+Route tables parsed as they stream in, saved as .routes.bin and loaded back
+"""
+
+import os
+
+import pytest
+
+from utils import route_table
+from utils.log_io import compact_folder
+
+JUNOS = """
+inet.0: 5 destinations, 5 routes (5 active, 0 holddown, 0 hidden)
++ = Active Route, - = Last Active, * = Both
+
+A V Destination        P Prf   Metric 1   Metric 2  Next hop        AS path
+* ? 0.0.0.0/0          S   5                        >10.0.0.1
+* ? 10.0.0.0/30        D   0                        >ge-0/0/0.0
+* ? 10.0.0.2/32        L   0                         Local
+* ? 192.168.1.0/24     O  10          2             >10.0.0.1
+                                                     10.0.0.5
+* ? 172.16.0.0/16      B 170        100            >10.0.0.9       65001 I"""
+
+IOS = """Codes: L - local, C - connected, S - static, O - OSPF
+Gateway of last resort is 10.0.0.1 to network 0.0.0.0
+
+S*    0.0.0.0/0 [1/0] via 10.0.0.1
+      10.0.0.0/8 is variably subnetted, 2 subnets, 2 masks
+C        10.0.0.0/30 is directly connected, GigabitEthernet0/0
+L        10.0.0.2/32 is directly connected, GigabitEthernet0/0
+      172.16.0.0/24 is subnetted, 2 subnets
+O E2     172.16.1.0 [110/20] via 10.0.0.1, 00:01:02, GigabitEthernet0/0
+O E2     172.16.2.0 [110/20] via 10.0.0.5, 00:01:02, GigabitEthernet0/1"""
+
+SROS = """===============================================================================
+Route Table (Router: Base)
+===============================================================================
+Dest Prefix[Flags]                            Type    Proto     Age        Pref
+      Next Hop[Interface Name]                                    Metric
+-------------------------------------------------------------------------------
+10.0.0.0/30                                   Local   Local     01d02h03m  0
+       to-r2                                                        0
+192.168.1.0/24                                Remote  OSPF      01d02h03m  10
+       10.0.0.1                                                     2
+-------------------------------------------------------------------------------
+No. of Routes: 2"""
+
+EXPECTED = {
+    "juniper_junos": {
+        "0.0.0.0/0": "10.0.0.1",
+        "10.0.0.0/30": "0.0.0.0",
+        "10.0.0.2/32": "0.0.0.0",
+        "192.168.1.0/24": "10.0.0.1",
+        "172.16.0.0/16": "10.0.0.9",
+    },
+    "cisco_ios": {
+        "0.0.0.0/0": "10.0.0.1",
+        "10.0.0.0/30": "0.0.0.0",
+        "10.0.0.2/32": "0.0.0.0",
+        "172.16.1.0/24": "10.0.0.1",
+        "172.16.2.0/24": "10.0.0.5",
+    },
+    "nokia_sros": {"10.0.0.0/30": "0.0.0.0", "192.168.1.0/24": "10.0.0.1"},
+}
+OUTPUTS = {"juniper_junos": JUNOS, "cisco_ios": IOS, "nokia_sros": SROS}
+
+
+@pytest.mark.parametrize("os_type", list(OUTPUTS))
+@pytest.mark.parametrize("chunk", [1, 7, 100000])
+def test_chunks_round_trip(tmp_path, os_type, chunk):
+    """The routes don't depend on where the stream is split"""
+    path = str(tmp_path / f"mop_r1_before_log{route_table.ROUTES_SUFFIX}")
+    writer = route_table.RouteTableWriter(path)
+    output = OUTPUTS[os_type]
+    for i in range(0, len(output), chunk):
+        writer.write(output[i : i + chunk])
+    assert writer.close() == len(EXPECTED[os_type])
+    assert route_table.load_routes(path) == EXPECTED[os_type]
+    assert not os.path.exists(f"{tmp_path}/.{os.path.basename(path)}.partial")
+
+
+def test_compacted_routes(tmp_path):
+    path = str(tmp_path / f"mop_r1_before_log{route_table.ROUTES_SUFFIX}")
+    writer = route_table.RouteTableWriter(path)
+    writer.write(JUNOS)
+    writer.close()
+    compact_folder(str(tmp_path), "gzip")
+    assert not os.path.exists(path)
+    assert route_table.load_routes(path + ".gz") == EXPECTED["juniper_junos"]
+
+
+def test_not_a_route_table(tmp_path):
+    path = tmp_path / "routes.bin"
+    path.write_bytes(b"not routes")
+    with pytest.raises(ValueError):
+        route_table.load_routes(str(path))
+
+
+def test_capture_routes(tmp_path, simulator, connect):
+    """capture_routes streams the route command from a device into its route table file"""
+    # The command timeout comes from baseline_utils, which needs easysnmp
+    pytest.importorskip("easysnmp")
+    os_type = "juniper_junos"
+    sim = simulator([os_type], {os_type: {route_table.ROUTE_COMMANDS[os_type]: JUNOS}})
+    device = list(sim.devices.values())[0]
+    net_connect = connect(sim, device)
+    log_file = str(tmp_path / "mop_r1_before_log")
+    count = route_table.capture_routes(net_connect, device.address, os_type, {}, log_file)
+    assert count == len(EXPECTED[os_type])
+    assert route_table.load_routes(route_table.routes_file(log_file)) == EXPECTED[os_type]
@@ -0,0 +1,75 @@
+"""
+stream_commands against the serial stream_command on simulated devices
+"""
+
+import pytest
+
+from utils.device_sim import OS_TYPES
+from utils.log_writer import stream_command
+from utils.log_writer import stream_commands
+
+
+class _Blocks(object):
+    """Collects the output of each [COMMAND] block, like LogWriter"""
+
+    def __init__(self):
+        self.blocks = []
+
+    def start_command(self, command):
+        self.blocks.append([command, ""])
+
+    def write(self, text):
+        self.blocks[-1][1] += text
+
+
+COMMANDS = {
+    "show version": "Hostname: r1\nModel: simulated\nshow version is the command\n",
+    "show empty": "",
+    "show big": "\n".join(f"line {i} " + "x" * 60 for i in range(2000)),
+    "show blank lines": "\n\nfirst\n\n\nlast\n\n",
+    "show version detail": "Hostname: r1\nUptime: 1 day",
+}
+
+
+@pytest.mark.parametrize("os_type", OS_TYPES)
+def test_same_as_serial(simulator, connect, os_type):
+    sim = simulator([os_type], {os_type: COMMANDS})
+    device = list(sim.devices.values())[0]
+    net_connect = connect(sim, device)
+    commands = list(COMMANDS) + ["show unrecorded", "show version"]
+    serial = _Blocks()
+    for command in commands:
+        serial.start_command(command)
+        stream_command(net_connect, command, serial.write, read_timeout=10)
+    pipelined = _Blocks()
+    finished = []
+    assert stream_commands(net_connect, commands, pipelined, finished, read_timeout=10)
+    assert pipelined.blocks == serial.blocks
+    assert len(finished) == len(commands)
+    # MD-CLI's two line prompt leaves its "[/]" line in the output, like netmiko's send_command
+    assert serial.blocks[0][1].startswith(COMMANDS["show version"].strip("\n"))
+
+
+@pytest.mark.parametrize("typeahead", ["drop", "early"])
+@pytest.mark.parametrize("os_type", ["juniper_junos", "cisco_ios"])
+def test_falls_back_without_echo(simulator, connect, os_type, typeahead):
+    """Commands the device doesn't echo after the prompt are run again one at a time"""
+    sim = simulator([os_type], {os_type: COMMANDS}, typeahead=typeahead)
+    device = list(sim.devices.values())[0]
+    net_connect = connect(sim, device)
+    commands = list(COMMANDS)
+    serial = _Blocks()
+    for command in commands:
+        serial.start_command(command)
+        stream_command(net_connect, command, serial.write, read_timeout=10)
+    pipelined = _Blocks()
+    finished = []
+    assert not stream_commands(net_connect, commands, pipelined, finished, read_timeout=10)
+    # The last block of each command wins, like a command logged twice
+    assert list(dict(pipelined.blocks).items()) == [tuple(block) for block in serial.blocks]
+    assert len(finished) == len(commands)
+    # The session is back at the prompt
+    after = _Blocks()
+    after.start_command("show version")
+    stream_command(net_connect, "show version", after.write, read_timeout=10)
+    assert after.blocks == serial.blocks[:1]